@@ -6,12 +6,17 @@ import html
 import asyncio
 from datetime import datetime, timedelta
 import logging
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 import io
 import sys
 import subprocess
 import re
+import hashlib
+import bisect
+import heapq
 import threading
+import multiprocessing
+import concurrent.futures
 import traceback
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
@@ -23,6 +28,12 @@ try:
     PIL_AVAILABLE = True
 except ImportError:
     PIL_AVAILABLE = False
+# NumPy необязателен: с ним градиенты считаются массивом, без него — через Image.linear_gradient.
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
@@ -35,6 +46,13 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
+# Полосы приоритета для апдейтов (см. PriorityLaneProcessor) требуют python-telegram-bot >= 20.4.
+try:
+    from telegram.ext import BaseUpdateProcessor
+    UPDATE_LANES_AVAILABLE = True
+except ImportError:
+    BaseUpdateProcessor = object
+    UPDATE_LANES_AVAILABLE = False
 
 async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Логирует любые необработанные ошибки обработчиков и не даёт им бесследно останавливать бота."""
@@ -82,7 +100,10 @@ def _load_bot_token() -> str:
         pass
     return token
 
-TOKEN = _load_bot_token()
+# `python bot.py simulate ...` и его процессы-воркеры работают без Telegram и токена
+HEADLESS_COMMANDS = ("simulate",)
+HEADLESS_RUN = len(sys.argv) > 1 and sys.argv[1] in HEADLESS_COMMANDS
+TOKEN = "" if HEADLESS_RUN else _load_bot_token()
 CHANNEL_ID = "-1002899939309"
 CHANNEL_LINK = "https://t.me/cabakoff"
 EVENTS_CHANNEL_ID = "-1004369187055"
@@ -389,6 +410,35 @@ def update_coins(user_id: int, amount: int) -> int:
     save_data(COINS_FILE, coins_data)
     return new_amount
 
+def update_coins_bulk(changes: dict) -> dict:
+    """Пакетное начисление монет: все изменения применяются в памяти и
+    записываются в coins.json одним save_data. Возвращает {user_id: новый баланс}."""
+    if not changes:
+        return {}
+    coins_data = load_data(COINS_FILE, {})
+    balances = {}
+    for user_id, amount in changes.items():
+        current = coins_data.get(str(user_id), 0)
+        new_amount = max(0, current + int(amount))
+        coins_data[str(user_id)] = new_amount
+        balances[user_id] = new_amount
+    save_data(COINS_FILE, coins_data)
+    return balances
+
+def grant_cards_bulk(grants) -> None:
+    """Пакетная выдача карточек: список (user_id, card_id), одна запись users.json
+    (вместе с отметкой seen_cards), вместо add_one_card на каждую карту."""
+    if not grants:
+        return
+    users = load_data(USERS_FILE, {})
+    for user_id, card_id in grants:
+        user_data = users.setdefault(str(user_id), {"cards": [], "last_drop": 0})
+        user_data.setdefault("cards", []).append(card_id)
+        seen = user_data.setdefault("seen_cards", [])
+        if card_id not in seen:
+            seen.append(card_id)
+    save_data(USERS_FILE, users)
+
 # Streak для казино и монетки
 def get_casino_streak(user_id: int) -> int:
     users = load_data(USERS_FILE, {})
@@ -657,6 +707,7 @@ def set_rating_team(user_id: int, gk_id: int, field_ids: list, coach_id=None, ta
     }
     users[str(user_id)] = user_data
     save_data(USERS_FILE, users)
+    refresh_team_snapshot(user_id, user_data["rating_team"])
 
 # ============================ РЕЙТИНГ: ТРЕНЕР И ТАКТИКА ============================
 TACTIC_LABELS = {"attack": "⚔️ Нападение", "bus": "🚌 Автобус", "balanced": "⚖️ Сбалансировано"}
@@ -765,6 +816,19 @@ def add_trophy_points(user_id: int, pts: int) -> int:
     save_data(TROPHY_POINTS_FILE, data)
     return data[str(user_id)]
 
+def add_trophy_points_bulk(changes: dict) -> dict:
+    """Пакетное начисление трофейных очков. Возвращает {user_id: (было, стало)}."""
+    if not changes:
+        return {}
+    data = load_data(TROPHY_POINTS_FILE, {})
+    result = {}
+    for user_id, pts in changes.items():
+        current = data.get(str(user_id), 0)
+        data[str(user_id)] = current + pts
+        result[user_id] = (current, data[str(user_id)])
+    save_data(TROPHY_POINTS_FILE, data)
+    return result
+
 def get_user_title(user_id: int):
     """Возвращает (name_en, name_ru, emoji) текущего звания."""
     pts = get_trophy_points(user_id)
@@ -1081,6 +1145,64 @@ async def notify_users_in_dm(
             await asyncio.sleep(pause_seconds)
     return {"sent": sent, "failed": failed, "total": len(ids), "category": category}
 
+# Персональные ЛС после выплат (ставки, розыгрыши, сезон) шлются параллельно,
+# но не быстрее лимита Telegram (~30 сообщений в секунду на бота).
+DM_SEND_CONCURRENCY = 8
+DM_SEND_RATE_PER_SEC = 25
+
+async def send_dm_batch(
+    context: ContextTypes.DEFAULT_TYPE,
+    messages,
+    concurrency: int = DM_SEND_CONCURRENCY,
+    rate_per_sec: float = DM_SEND_RATE_PER_SEC,
+):
+    """Рассылка персональных сообщений: messages — список (user_id, text, parse_mode).
+    Вызывать только после того, как все начисления уже сохранены."""
+    messages = [m for m in messages if m and m[0]]
+    if not messages:
+        return {"sent": 0, "failed": 0, "total": 0}
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(max(1, int(concurrency)))
+    interval = 1.0 / max(1.0, float(rate_per_sec))
+    next_slot = [loop.time()]
+    stats = {"sent": 0, "failed": 0, "total": len(messages)}
+
+    async def _wait_slot():
+        now = loop.time()
+        slot = max(now, next_slot[0])
+        next_slot[0] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send_one(uid, text, parse_mode):
+        async with sem:
+            for attempt in range(2):
+                await _wait_slot()
+                try:
+                    await context.bot.send_message(uid, text, parse_mode=parse_mode)
+                    stats["sent"] += 1
+                    return
+                except Exception as e:
+                    retry_after = getattr(e, "retry_after", None)
+                    if attempt == 0 and retry_after:
+                        # Flood control: сдвигаем общее окно, чтобы притормозили все воркеры
+                        delay = float(getattr(retry_after, "total_seconds", lambda: retry_after)())
+                        next_slot[0] = max(next_slot[0], loop.time() + delay)
+                        continue
+                    break
+            stats["failed"] += 1
+
+    await asyncio.gather(*(_send_one(uid, text, parse_mode) for uid, text, parse_mode in messages))
+    return stats
+
+async def _send_dm_batch_logged(context: ContextTypes.DEFAULT_TYPE, messages, label: str) -> None:
+    """Фоновая обёртка над send_dm_batch: пишет итог рассылки в лог."""
+    try:
+        stats = await send_dm_batch(context, messages)
+        logger.info(f"{label}: отправлено {stats['sent']}/{stats['total']}, ошибок {stats['failed']}")
+    except Exception as e:
+        logger.error(f"{label}: ошибка рассылки: {e}")
+
 async def post_to_channel(
     context: ContextTypes.DEFAULT_TYPE,
     text: str,
@@ -1156,6 +1278,9 @@ USER_COMMANDS_TEXT = (
     "⚔️ Рейтинговый режим:\n"
     "/rating_team - собрать состав для рейтингового режима\n"
     "/find_match - найти соперника (рейтинговый режим)\n"
+    "/match_replay [id] - повтор рейтингового матча\n"
+    "/tournament - турнир: запись, сетка, итоги\n"
+    "/tournament_join - записаться на турнир\n"
     "/rating - мой рейтинг и текущий состав\n\n"
     "👤 Профиль, косметика и прочее:\n"
     "/profile - ваш профиль\n"
@@ -1230,10 +1355,16 @@ ADMIN_ONLY_COMMANDS_TEXT = (
     "/end_season - завершить сезон и выдать призы\n"
     "/create_match <команда1> <команда2> <часы> - создать матч (приём ставок N часов)\n"
     "/finish_match <match_id> <счёт> - завершить матч (например 3:1)\n"
-    "/view_matches - список матчей для ставок\n\n"
+    "/view_matches - список матчей для ставок\n"
+    "/tournament_new <участников> [название] - открыть запись на турнир в этом чате\n"
+    "/tournament_start - посеять участников и начать турнир\n"
+    "/tournament_cancel - отменить турнир\n\n"
     "⚙️ Система:\n"
     "/history [user_id] - история игрока\n"
     "/security - логи безопасности\n"
+    "/lanes - загрузка полос обработки и ожидание апдейтов\n"
+    "/bench_render [повторов] - замер рендера картинок\n"
+    "/bench_encode [Мбит/с] - размер и загрузка картинок по кодекам\n"
     "/reply_report <ID> <текст> - ответить на репорт игрока\n"
     "/update - обновить бота (токен + файл bot.py, авто-перезапуск)"
 )
@@ -1395,7 +1526,7 @@ async def get_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             pass
     image_path = os.path.join(CARDS_IMAGE_DIR, card["image"])
     if os.path.exists(image_path):
-        photo = get_framed_card_photo(card) or open(image_path, "rb")
+        photo = await render_image("framed_card", card) or open(image_path, "rb")
         await update.message.reply_photo(photo=photo, caption=caption)
     else:
         logger.warning(f"Изображение карточки не найдено: {image_path}")
@@ -1422,18 +1553,6 @@ async def _reply_long_html(message, text: str, limit: int = 3900) -> None:
     if chunk.strip():
         await message.reply_text(chunk.rstrip(), parse_mode="HTML")
 
-# Показ коллекции
-async def show_collection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if is_banned(user.id):
-        await update.message.reply_text("❌ Вы заблокированы в этом боте.")
-        return
-    if not await is_subscribed(user.id, context):
-        await update.message.reply_text(subscription_required_text())
-        return
-    message = await show_collection_with_ids(user.id)
-    await _reply_long_html(update.message, message)
-
 # Информация о карточке
 async def card_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -1480,7 +1599,7 @@ async def card_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     caption += "\n"
     image_path = os.path.join(CARDS_IMAGE_DIR, card["image"])
     if os.path.exists(image_path):
-        photo = get_framed_card_photo(card) or open(image_path, "rb")
+        photo = await render_image("framed_card", card) or open(image_path, "rb")
         await update.message.reply_photo(photo=photo, caption=caption, parse_mode="HTML")
     else:
         logger.warning(f"Изображение карточки не найдено: {image_path}")
@@ -1988,6 +2107,7 @@ async def admin_card_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     cards.append(new_card)
     save_data(CARDS_FILE, cards)
     await update.message.reply_text(f"✅ Карточка '{new_card['name']}' успешно добавлена!")
+    schedule_framed_card_warmup(context)
     await log_moderator_action(
         context, update.effective_user.id,
         f"Добавил новую карточку: {new_card['name']} (ID: {new_id}, редкость: {new_card.get('rarity')})"
@@ -2156,20 +2276,17 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     message = " ".join(context.args)
     users = load_data(USERS_FILE, {})
-    blacklist = load_data(BLACKLIST_FILE, [])
-    count = 0
-    errors = 0
-    for user_id in users:
-        uid = int(user_id)
-        if uid in blacklist:
-            continue
-        try:
-            await context.bot.send_message(chat_id=uid, text=f"📢 Рассылка от администратора:\n\n{message}")
-            count += 1
-        except Exception as e:
-            logger.error(f"Ошибка рассылки для {user_id}: {e}")
-            errors += 1
-    await update.message.reply_text(f"✅ Рассылка завершена!\nОтправлено: {count} пользователям\nОшибок: {errors}")
+    blacklist = set(load_data(BLACKLIST_FILE, []))
+    text = f"📢 Рассылка от администратора:\n\n{message}"
+    messages = [(int(user_id), text, None) for user_id in users if int(user_id) not in blacklist]
+
+    async def _broadcast():
+        stats = await send_dm_batch(context, messages)
+        return f"✅ Рассылка завершена!\nОтправлено: {stats['sent']} пользователям\nОшибок: {stats['failed']}"
+
+    # Рассылка идёт фоновой задачей: обработчик сразу освобождается, итог придёт отдельным сообщением
+    start_bulk_job(context, "admin_broadcast", _broadcast, report_chat_id=update.effective_chat.id)
+    await update.message.reply_text(f"📨 Рассылка запущена в фоне для {len(messages)} пользователей. Итог пришлю по завершении.")
 
 async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update.effective_user.id):
@@ -2789,6 +2906,7 @@ async def edit_card_value(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             context, update.effective_user.id,
             f"Изменил карточку (ID: {card_id}): поле '{field}' было «{old_value}» -> стало «{new_value}»"
         )
+    schedule_framed_card_warmup(context)
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -2979,7 +3097,7 @@ async def process_craft(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     inc_stat(user.id, 'craft_success', 1)
     log_action(user.id, 'mutated_craft_success', f"{new_card['id']} mutation={not no_mutation}") if 'log_action' in globals() else None
     try:
-        photo = get_framed_card_photo(new_card, mutation_instance) if mutation_instance else get_framed_card_photo(new_card)
+        photo = await render_image("framed_card", new_card, mutation_instance) if mutation_instance else await render_image("framed_card", new_card)
         if photo:
             await update.message.reply_photo(photo=photo, caption=result_text, parse_mode="HTML")
         else:
@@ -3672,9 +3790,22 @@ def _append_limited_json(file_name, item, limit=2000):
     data.append(item)
     save_data(file_name, data[-limit:])
 
+def _append_limited_json_many(file_name, items, limit=2000):
+    """Как _append_limited_json, но несколько записей за одну перезапись файла."""
+    if not items: return
+    data = load_data(file_name, [])
+    if not isinstance(data, list): data = []
+    data.extend(items)
+    save_data(file_name, data[-limit:])
+
 def log_action(user_id:int, action:str, details:str=""):
     _append_limited_json(ACTION_HISTORY_FILE, {"ts":time.time(),"user_id":int(user_id),"action":action,"details":str(details)[:350]})
 
+def log_actions(entries):
+    """Пачка записей истории (user_id, action, details) одной перезаписью action_history.json."""
+    now = time.time()
+    _append_limited_json_many(ACTION_HISTORY_FILE, [{"ts":now,"user_id":int(u),"action":a,"details":str(d)[:350]} for u, a, d in entries])
+
 def log_security(event:str, user_id=None, details:str="", severity:str="info"):
     _append_limited_json(SECURITY_LOG_FILE, {"ts":time.time(),"event":event,"user_id":user_id,"details":str(details)[:600],"severity":severity})
 
@@ -3767,19 +3898,27 @@ QUEST_POOL = [
     {"id":"cosmetic","name":"Купить косметику профиля","stat":"buy_cosmetic","target":1,"reward":150},
     {"id":"profile_style","name":"Изменить стиль профиля","stat":"profile_customized","target":1,"reward":80},
 ]
-def _daily_quest_set(user_id:int):
-    data = load_data(QUESTS_FILE,{})
+def _daily_quest_set_in(data:dict, user_id:int, users=None):
+    """Задания игрока на сегодня внутри уже загруженного quests; при смене дня набор
+    создаётся в data, но не сохраняется. Возвращает (задания, создан_ли_новый_набор)."""
     day = _msk_day_key()  # сброс строго по московской дате, не раньше 00:00 МСК
     ud = data.get(str(user_id),{})
-    if ud.get('day') != day:
-        rng = random.Random(f"{day}:{user_id}")
-        # разнообразие: 5 заданий в день, без дублей по id
-        qs = rng.sample(QUEST_POOL, min(5, len(QUEST_POOL)))
-        # запоминаем базовые значения статов на начало дня, чтобы прогресс шёл только за сегодняшние действия
-        users = load_data(USERS_FILE,{})
-        stats = users.get(str(user_id),{}).get('stats',{})
-        ud = {"day":day,"quests":[{**q,"progress":0,"claimed":False,"base":int(stats.get(q.get('stat'),0))} for q in qs]}
-        data[str(user_id)] = ud
+    if ud.get('day') == day:
+        return ud, False
+    rng = random.Random(f"{day}:{user_id}")
+    # разнообразие: 5 заданий в день, без дублей по id
+    qs = rng.sample(QUEST_POOL, min(5, len(QUEST_POOL)))
+    # запоминаем базовые значения статов на начало дня, чтобы прогресс шёл только за сегодняшние действия
+    users = users if users is not None else load_data(USERS_FILE,{})
+    stats = users.get(str(user_id),{}).get('stats',{})
+    ud = {"day":day,"quests":[{**q,"progress":0,"claimed":False,"base":int(stats.get(q.get('stat'),0))} for q in qs]}
+    data[str(user_id)] = ud
+    return ud, True
+
+def _daily_quest_set(user_id:int):
+    data = load_data(QUESTS_FILE,{})
+    ud, created = _daily_quest_set_in(data, user_id)
+    if created:
         save_data(QUESTS_FILE,data)
     return ud
 
@@ -3791,18 +3930,17 @@ def _title_progress_line(user_id:int, t:dict):
     mark = '✅' if unlocked else '🔒'
     return f"{mark} <code>{t['key']}</code> — {html.escape(t['name'])}" + chr(10) + f"   Нужно: {html.escape(t['need'])}"
 
-def _quest_progress(user_id:int, stat:str, amount:int=1):
-    data = load_data(QUESTS_FILE, {})
-    ud = _daily_quest_set(user_id)
-    changed = False
+def _apply_quest_progress(data:dict, users:dict, user_id:int, stat:str, amount:int=1):
+    """Прогресс заданий по уже загруженным quests и users (users — со свежими статами).
+    Ничего не пишет и монет не начисляет. Возвращает (награда, названия, изменено)."""
+    ud, changed = _daily_quest_set_in(data, user_id, users)
     reward_total = 0
     completed_names = []
     for q in ud.get('quests', []):
         if q.get('stat') == stat and not q.get('claimed'):
             before = int(q.get('progress', 0))
             target = int(q.get('target', 1))
-            users_now = load_data(USERS_FILE,{})
-            stat_now = int(users_now.get(str(user_id),{}).get('stats',{}).get(stat, 0))
+            stat_now = int(users.get(str(user_id),{}).get('stats',{}).get(stat, 0))
             base = int(q.get('base', stat_now - before - int(amount)))
             q['base'] = base
             q['progress'] = min(target, max(before + int(amount), stat_now - base))
@@ -3811,8 +3949,12 @@ def _quest_progress(user_id:int, stat:str, amount:int=1):
                 q['claimed'] = True
                 reward_total += int(q.get('reward', 0))
                 completed_names.append(q.get('name', 'задание'))
+    return reward_total, completed_names, changed
+
+def _quest_progress(user_id:int, stat:str, amount:int=1):
+    data = load_data(QUESTS_FILE, {})
+    reward_total, completed_names, changed = _apply_quest_progress(data, load_data(USERS_FILE,{}), user_id, stat, amount)
     if changed:
-        data[str(user_id)] = ud
         save_data(QUESTS_FILE, data)
     if reward_total > 0:
         update_coins(user_id, reward_total)
@@ -3984,19 +4126,200 @@ async def bot_market_buy_cycle(context):
     try: await context.bot.send_message(ADMIN_ID,f"🤖 Бот выкупил лот #{it.get('id')} за {it.get('price')} монет у {it.get('seller_id')}")
     except Exception: pass
 
-def _profile_font(size:int, bold:bool=False):
-    candidates = [
-        '/usr/share/fonts/google-noto/NotoSans-Bold.ttf' if bold else '/usr/share/fonts/google-noto/NotoSans-Regular.ttf',
-        '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans-Bold.ttf' if bold else '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf',
-        '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf' if bold else '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
-    ]
-    for path in candidates:
+# Кодирование готовых картинок. Telegram всё равно пережимает фото, поэтому
+# большие PNG только удлиняют загрузку: по умолчанию постеры и карточки уходят
+# оптимизированным JPEG с ограничением по длинной стороне. Формат (JPEG/WEBP/PNG),
+# качество и размер настраиваются для каждого построителя; /bench_encode сравнивает.
+IMAGE_OUTPUT = {
+    "profile": {"format": "JPEG", "quality": 88, "max_side": 1600},
+    "rating_team": {"format": "JPEG", "quality": 86, "max_side": 1600},
+    "match_result": {"format": "JPEG", "quality": 86, "max_side": 1600},
+    "framed_card": {"format": "JPEG", "quality": 90, "max_side": 1024},
+}
+IMAGE_OUTPUT_DEFAULT = {"format": "PNG", "quality": 95, "max_side": None}
+IMAGE_FORMAT_EXT = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+
+def _image_output(kind: str, **overrides) -> dict:
+    opts = {**IMAGE_OUTPUT_DEFAULT, **IMAGE_OUTPUT.get(kind, {})}
+    opts.update({k: v for k, v in overrides.items() if v is not None})
+    opts["format"] = str(opts["format"]).upper()
+    if opts["format"] not in IMAGE_FORMAT_EXT:
+        opts["format"] = "PNG"
+    return opts
+
+
+def _image_output_ext(kind: str) -> str:
+    return IMAGE_FORMAT_EXT[_image_output(kind)["format"]]
+
+
+def encode_image(img, kind: str, fmt=None, quality=None, max_side=None):
+    """Кодирует итоговую картинку построителя kind по IMAGE_OUTPUT. Возвращает BytesIO."""
+    opts = _image_output(kind, format=fmt, quality=quality, max_side=max_side)
+    fmt = opts["format"]
+    limit = opts["max_side"]
+    if limit and max(img.size) > limit:
+        scale = limit / max(img.size)
+        img = img.resize((max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale))), Image.LANCZOS)
+    if fmt != "PNG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    out = io.BytesIO()
+    try:
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=int(opts["quality"]), optimize=True, progressive=True)
+        elif fmt == "WEBP":
+            img.save(out, "WEBP", quality=int(opts["quality"]), method=4)
+        else:
+            img.save(out, "PNG")
+    except (OSError, KeyError, ValueError) as e:
+        # Pillow без поддержки WebP и т.п. — отдаём JPEG, чтобы картинка всё равно ушла
+        logger.warning(f"Кодек {fmt} недоступен для {kind} ({e}), сохраняю JPEG")
+        out = io.BytesIO()
+        fmt = "JPEG"
+        img.convert("RGB").save(out, "JPEG", quality=int(opts["quality"]), optimize=True, progressive=True)
+    out.name = f"{kind}.{IMAGE_FORMAT_EXT[fmt]}"
+    out.seek(0)
+    return out
+
+
+# Градиенты фона считаются целиком (NumPy или Image.linear_gradient), а не линией на
+# каждую строку, и кэшируются по (размер, цвета): профили и карточки с одинаковой
+# косметикой/редкостью берут готовую плитку.
+GRADIENT_CACHE_LIMIT = 32
+_GRADIENT_CACHE = {}
+
+
+def _render_vertical_gradient(size, top_color, bottom_color):
+    """RGB-картинка size с вертикальным градиентом; значения как у построчного int(a+(b-a)*t)."""
+    w, h = int(size[0]), int(size[1])
+    top = tuple(int(c) for c in top_color[:3])
+    bottom = tuple(int(c) for c in bottom_color[:3])
+    if NUMPY_AVAILABLE:
+        t = np.arange(h, dtype=np.float64) / max(1, h - 1)
+        col = np.array(top, dtype=np.float64) + np.outer(t, np.array(bottom, dtype=np.float64) - np.array(top, dtype=np.float64))
+        col = np.clip(col, 0, 255).astype(np.uint8).reshape(h, 1, 3)
+        return Image.fromarray(np.ascontiguousarray(np.broadcast_to(col, (h, w, 3))), 'RGB')
+    mask = Image.linear_gradient('L').resize((w, h))
+    return Image.composite(Image.new('RGB', (w, h), bottom), Image.new('RGB', (w, h), top), mask)
+
+
+def _gradient_tile(size, top_color, bottom_color):
+    """Вертикальный градиент из кэша. Возвращает копию — её можно рисовать поверх."""
+    key = (int(size[0]), int(size[1]), tuple(top_color[:3]), tuple(bottom_color[:3]))
+    tile = _GRADIENT_CACHE.get(key)
+    if tile is None:
+        tile = _render_vertical_gradient(size, top_color, bottom_color)
+        if len(_GRADIENT_CACHE) >= GRADIENT_CACHE_LIMIT:
+            _GRADIENT_CACHE.pop(next(iter(_GRADIENT_CACHE)))
+        _GRADIENT_CACHE[key] = tile
+    return tile.copy()
+
+
+def _profile_background(size, top_col, bot_col):
+    """Фон профиля: градиент + диагональная «ледовая» сетка, кэш по цветам фона."""
+    key = ('profile_bg', int(size[0]), int(size[1]), tuple(top_col[:3]), tuple(bot_col[:3]))
+    tile = _GRADIENT_CACHE.get(key)
+    if tile is None:
+        W, H = size
+        tile = _render_vertical_gradient(size, top_col, bot_col)
+        d = ImageDraw.Draw(tile)
+        grid_col = tuple(min(255, c + 28) for c in top_col)
+        for x in range(-W, W * 2, 90):
+            d.line((x, 0, x + W, H), fill=grid_col, width=1)
+        if len(_GRADIENT_CACHE) >= GRADIENT_CACHE_LIMIT:
+            _GRADIENT_CACHE.pop(next(iter(_GRADIENT_CACHE)))
+        _GRADIENT_CACHE[key] = tile
+    return tile.copy()
+
+
+# Кэш фото карточек: исходник из cards_images декодируется и подгоняется под нужный
+# размер один раз, дальше профиль, состав, рамка и GIF берут готовую миниатюру.
+# Ключ — (путь, mtime, размер, кадрирование, режим), так что замена фото карточки
+# сама сбрасывает запись. Ограничение по числу записей и по суммарным пикселям.
+CARD_PHOTO_CACHE_LIMIT = 96
+CARD_PHOTO_CACHE_MAX_PIXELS = 12_000_000
+_CARD_PHOTO_CACHE = OrderedDict()
+_CARD_PHOTO_CACHE_PIXELS = 0
+
+
+def _fitted_photo(path: str, size, centering=(0.5, 0.5), mode: str = 'RGB'):
+    """Декодированное фото, подогнанное ImageOps.fit под size (centering=None — простой
+    resize). Картинка общая для всех вызовов: только вставлять, не рисовать поверх."""
+    global _CARD_PHOTO_CACHE_PIXELS
+    size = (int(size[0]), int(size[1]))
+    key = (path, os.stat(path).st_mtime_ns, size, tuple(centering) if centering else None, mode)
+    photo = _CARD_PHOTO_CACHE.get(key)
+    if photo is not None:
+        _CARD_PHOTO_CACHE.move_to_end(key)
+        return photo
+    with Image.open(path) as src:
+        src = src.convert(mode)
+        photo = ImageOps.fit(src, size, centering=centering) if centering else src.resize(size)
+    _CARD_PHOTO_CACHE[key] = photo
+    _CARD_PHOTO_CACHE_PIXELS += size[0] * size[1]
+    while _CARD_PHOTO_CACHE and (len(_CARD_PHOTO_CACHE) > CARD_PHOTO_CACHE_LIMIT
+                                 or _CARD_PHOTO_CACHE_PIXELS > CARD_PHOTO_CACHE_MAX_PIXELS):
+        _, old = _CARD_PHOTO_CACHE.popitem(last=False)
+        _CARD_PHOTO_CACHE_PIXELS -= old.size[0] * old.size[1]
+    return photo
+
+
+def _clear_card_photo_cache() -> None:
+    global _CARD_PHOTO_CACHE_PIXELS
+    _CARD_PHOTO_CACHE.clear()
+    _CARD_PHOTO_CACHE_PIXELS = 0
+
+
+# Кэш шрифтов: путь к TTF подбирается один раз на семейство, а готовые объекты
+# FreeTypeFont хранятся по (семейство, размер) — постеры больше не открывают файлы
+# шрифтов заново на каждую надпись и каждый шаг подбора размера.
+_FONT_PATH_CACHE = {}
+_FONT_CACHE = {}
+
+
+def _resolve_font_path(family: str, candidates):
+    if family not in _FONT_PATH_CACHE:
+        resolved = None
+        for path in candidates:
+            try:
+                ImageFont.truetype(path, 12)
+                resolved = path
+                break
+            except Exception:
+                continue
+        _FONT_PATH_CACHE[family] = resolved
+    return _FONT_PATH_CACHE[family]
+
+
+def _cached_font(family: str, candidates, size: int):
+    key = (family, size)
+    font = _FONT_CACHE.get(key)
+    if font is None:
+        path = _resolve_font_path(family, candidates)
         try:
-            if path and os.path.exists(path):
-                return ImageFont.truetype(path, size)
+            font = ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
         except Exception:
-            pass
-    return ImageFont.load_default()
+            font = ImageFont.load_default()
+        _FONT_CACHE[key] = font
+    return font
+
+
+PROFILE_FONT_PATHS = {
+    False: (
+        '/usr/share/fonts/google-noto/NotoSans-Regular.ttf',
+        '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf',
+        '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    ),
+    True: (
+        '/usr/share/fonts/google-noto/NotoSans-Bold.ttf',
+        '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans-Bold.ttf',
+        '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    ),
+}
+
+
+def _profile_font(size:int, bold:bool=False):
+    return _cached_font('profile_bold' if bold else 'profile', PROFILE_FONT_PATHS[bool(bold)], int(size))
 
 def _draw_fit_text(draw, xy, text, font, fill, max_width):
     text = str(text)
@@ -4006,40 +4329,157 @@ def _draw_fit_text(draw, xy, text, font, fill, max_width):
         text = text[:-1] + '…'
     draw.text(xy, text, font=font, fill=fill)
 
+# Профиль рисуется слоями. Статичная подложка (фон, рамка, все панели без текста)
+# кэшируется по сочетанию косметики, а готовая картинка — на диске по хэшу того, что
+# на ней показано: неизменившийся профиль отдаётся файлом без рендера. При изменении
+# рисунка профиля увеличьте PROFILE_RENDER_VERSION.
+PROFILE_RENDER_VERSION = 1
+PROFILE_RENDER_CACHE_DIR = os.path.join("render_cache", "profiles")
+PROFILE_BASE_CACHE_LIMIT = 16
+_PROFILE_BASE_CACHE = {}
+PROFILE_SIZE = (1600, 1050)
+PROFILE_STAT_BOXES = [(82 + (i % 2) * 374, 288 + (i // 2) * 142, 82 + (i % 2) * 374 + 350, 288 + (i // 2) * 142 + 118) for i in range(8)]
+PROFILE_SHOWCASE_BOX = (855, 288, 1518, 843)
+PROFILE_CARD_BOXES = [(883, 396, 1070, 776), (1093, 396, 1280, 776), (1303, 396, 1490, 776)]
+PROFILE_RARITY_COLORS = {'Обычная':(150,165,185),'Редкая':(80,160,255),'Эпическая':(185,95,255),'Легендарная':(255,205,72),'Мифическая':(120,240,255),'Эксклюзивная':(255,105,190)}
+
+
+def _profile_panel(img, box, fill=(16,31,60,235), outline=(75,155,255,190), radius=28, width=2):
+    """Полупрозрачная панель с бликом: смешивается только область box, а не весь холст."""
+    x1, y1, x2, y2 = box
+    region = img.crop((x1, y1, x2 + 1, y2 + 1)).convert('RGBA')
+    layer = Image.new('RGBA', region.size, (0, 0, 0, 0)); ld = ImageDraw.Draw(layer)
+    ld.rounded_rectangle((0, 0, x2 - x1, y2 - y1), radius=radius, fill=fill, outline=outline, width=width)
+    # top highlight
+    ld.rounded_rectangle((8, 8, x2 - x1 - 8, 45), radius=radius // 2, fill=(255, 255, 255, 18))
+    img.paste(Image.alpha_composite(region, layer).convert('RGB'), (x1, y1))
+
+
+def _profile_base_layer(top_col, bot_col, frame_col):
+    """Статичная подложка профиля для сочетания фона и рамки (копия из кэша)."""
+    key = (tuple(top_col[:3]), tuple(bot_col[:3]), tuple(frame_col[:3]))
+    base = _PROFILE_BASE_CACHE.get(key)
+    if base is None:
+        W, H = PROFILE_SIZE
+        base = _profile_background((W, H), top_col, bot_col)
+        # dark overlay panels
+        overlay = Image.new('RGBA', (W, H), (0, 0, 0, 0)); od = ImageDraw.Draw(overlay)
+        for pad, alpha in [(22,65),(34,45),(48,30)]:
+            od.rounded_rectangle((pad,pad,W-pad,H-pad), radius=46, outline=(*frame_col,alpha), width=3)
+        od.rounded_rectangle((48,48,W-48,H-48), radius=42, fill=(9,18,36,210), outline=(*frame_col,255), width=5)
+        base = Image.alpha_composite(base.convert('RGBA'), overlay).convert('RGB')
+        edge = (*frame_col, 190)
+        _profile_panel(base, (82,78,W-82,252), fill=(22,48,88,230), outline=edge, radius=34, width=3)
+        _profile_panel(base, (1195,108,1438,218), fill=(10,20,38,235), outline=(255,222,92,230), radius=24, width=3)
+        for box in PROFILE_STAT_BOXES:
+            _profile_panel(base, box, fill=(16,31,60,225), outline=edge, radius=22, width=2)
+        _profile_panel(base, PROFILE_SHOWCASE_BOX, fill=(13,27,54,230), outline=edge, radius=30, width=3)
+        _profile_panel(base, (82,880,W-82,970), fill=(10,22,42,235), outline=edge, radius=24, width=2)
+        if len(_PROFILE_BASE_CACHE) >= PROFILE_BASE_CACHE_LIMIT:
+            _PROFILE_BASE_CACHE.pop(next(iter(_PROFILE_BASE_CACHE)))
+        _PROFILE_BASE_CACHE[key] = base
+    return base.copy()
+
+
+def _profile_view(user_id:int, name:str) -> dict:
+    """Всё, что показывает картинка профиля, — по этим данным считается ключ кэша."""
+    users = load_data(USERS_FILE,{})
+    u = users.get(str(user_id),{})
+    st = u.get('stats',{})
+    custom = _profile_custom(user_id) if '_profile_custom' in globals() else {}
+    bg = PROFILE_BACKGROUNDS.get(custom.get('background', 'ice'), PROFILE_BACKGROUNDS['ice']) if 'PROFILE_BACKGROUNDS' in globals() else {'colors': ((7,12,24),(22,55,95)), 'emoji':'🧊'}
+    fr = PROFILE_FRAMES.get(custom.get('frame', 'blue'), PROFILE_FRAMES['blue']) if 'PROFILE_FRAMES' in globals() else {'color': (75,155,255)}
+    badge = PROFILE_BADGES.get(custom.get('badge', 'none'), PROFILE_BADGES['none']) if 'PROFILE_BADGES' in globals() else {'emoji':'▫️'}
+    top_col, bot_col = bg.get('colors', ((7,12,24),(22,55,95)))
+    title = active_title(user_id)[1] if 'active_title' in globals() else '🆕 Новичок'
+    elo = get_rating_elo(user_id); rank = get_rating_rank(elo)
+    cards_all = load_data(CARDS_FILE, []); cmap = {int(c.get('id')):c for c in cards_all if 'id' in c}
+    coins = get_coins(user_id); normal = len(u.get('cards',[])); seen = len(u.get('seen_cards',[])); total = len(cards_all)
+    matches = int(st.get('rating_matches',0)); wins = int(st.get('rating_wins',0)); wr = round(wins/max(1,matches)*100,1)
+    stats = [('💰 Баланс',_fmt_coins(coins)),('🃏 Карты',str(normal)),('📚 Уникальные',f'{seen}/{total}'),('🏒 Матчи',str(matches)),('🏆 Победы',str(wins)),('📈 Винрейт',f'{wr}%'),('⚔️ Дуэли',f"{st.get('duel_wins',0)} побед"),('🛠 Крафты',f"{st.get('craft_success',0)} успешных")]
+    showcase = [int(x) for x in custom.get('showcase',[])[:3] if str(x).isdigit()]
+    if not showcase:
+        # fallback: 3 strongest/first available cards so profile never looks empty
+        owned = list(dict.fromkeys(u.get('cards',[])))[:3]
+        showcase = [int(x) for x in owned if int(x) in cmap][:3]
+    slots = []
+    for cid in showcase[:3]:
+        card = cmap.get(cid)
+        if not card:
+            slots.append(None)
+            continue
+        path = os.path.join(CARDS_IMAGE_DIR, card.get('image','')) if card.get('image') else ''
+        slots.append({
+            'name': card.get('name','?'),
+            'rarity': str(card.get('rarity','')),
+            'power': get_card_power(card) if 'get_card_power' in globals() else 0,
+            'image': path,
+            'mtime': int(os.path.getmtime(path)) if path and os.path.exists(path) else 0,
+        })
+    return {
+        'v': PROFILE_RENDER_VERSION,
+        'name': name, 'title': title, 'badge': badge.get('emoji','▫️'),
+        'top_col': list(top_col), 'bot_col': list(bot_col), 'frame_col': list(fr.get('color', (75,155,255))),
+        'elo': elo, 'stats': stats, 'slots': slots,
+        'style_line': f"{bg.get('emoji','')} {bg.get('name','Фон')}  •  {fr.get('emoji','')} {fr.get('name','Рамка')}  •  {rank[1]} {rank[2]}",
+    }
+
+
+def _profile_cache_path(user_id:int, view:dict) -> str:
+    key = {'view': view, 'output': _image_output('profile')}
+    digest = hashlib.sha1(json.dumps(key, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(PROFILE_RENDER_CACHE_DIR, f"profile_{int(user_id)}_{digest}.{_image_output_ext('profile')}")
+
+
+def _cached_profile_card(user_id:int, name:str):
+    """Готовая картинка профиля из кэша (BytesIO) или None, если что-то изменилось."""
+    try:
+        path = _profile_cache_path(user_id, _profile_view(user_id, name))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                bio = io.BytesIO(f.read())
+            bio.name = os.path.basename(path)
+            return bio
+    except Exception as e:
+        logger.warning(f'profile cache read error: {e}')
+    return None
+
+
+def _store_profile_card(user_id:int, path:str, data:bytes) -> None:
+    """Кладёт картинку в кэш; прежние версии профиля этого игрока удаляются."""
+    try:
+        os.makedirs(PROFILE_RENDER_CACHE_DIR, exist_ok=True)
+        prefix = f"profile_{int(user_id)}_"
+        for fn in os.listdir(PROFILE_RENDER_CACHE_DIR):
+            if fn.startswith(prefix) and os.path.join(PROFILE_RENDER_CACHE_DIR, fn) != path:
+                try: os.remove(os.path.join(PROFILE_RENDER_CACHE_DIR, fn))
+                except OSError: pass
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning(f'profile cache write error: {e}')
+
+
 def build_profile_card(user_id:int, name:str):
     """Новый премиум-профиль: кастомный фон/рамка/значок + настоящая витрина с фото карт."""
     if not PIL_AVAILABLE:
         return None
     try:
-        W, H = 1600, 1050
-        users = load_data(USERS_FILE,{})
-        u = users.get(str(user_id),{})
-        st = u.get('stats',{})
-        custom = _profile_custom(user_id) if '_profile_custom' in globals() else {}
-        bg = PROFILE_BACKGROUNDS.get(custom.get('background', 'ice'), PROFILE_BACKGROUNDS['ice']) if 'PROFILE_BACKGROUNDS' in globals() else {'colors': ((7,12,24),(22,55,95)), 'emoji':'🧊'}
-        fr = PROFILE_FRAMES.get(custom.get('frame', 'blue'), PROFILE_FRAMES['blue']) if 'PROFILE_FRAMES' in globals() else {'color': (75,155,255)}
-        badge = PROFILE_BADGES.get(custom.get('badge', 'none'), PROFILE_BADGES['none']) if 'PROFILE_BADGES' in globals() else {'emoji':'▫️'}
-        frame_col = tuple(fr.get('color', (75,155,255)))
-        top_col, bot_col = bg.get('colors', ((7,12,24),(22,55,95)))
+        view = _profile_view(user_id, name)
+        cache_path = _profile_cache_path(user_id, view)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return io.BytesIO(f.read())
+        W, H = PROFILE_SIZE
+        frame_col = tuple(view['frame_col'])
 
         def font(sz, bold=False): return _profile_font(int(sz), bold)
         f_name=font(64, True); f_title=font(36, True); f_big=font(42, True); f_mid=font(30, True); f_lab=font(24); f_small=font(21); f_tiny=font(18)
-        img = Image.new('RGB', (W,H), top_col)
+        # фон, рамка и все панели без текста — готовая подложка из кэша
+        img = _profile_base_layer(view['top_col'], view['bot_col'], frame_col)
         d = ImageDraw.Draw(img)
-        # cinematic gradient background
-        for y in range(H):
-            t=y/max(1,H-1)
-            col=tuple(int(a+(b-a)*t) for a,b in zip(top_col, bot_col))
-            d.line((0,y,W,y), fill=col)
-        # subtle diagonal grid / ice lines
-        for x in range(-W, W*2, 90):
-            d.line((x,0,x+W,H), fill=tuple(min(255,c+28) for c in top_col), width=1)
-        # dark overlay panels
-        overlay = Image.new('RGBA',(W,H),(0,0,0,0)); od=ImageDraw.Draw(overlay)
-        for pad,alpha in [(22,65),(34,45),(48,30)]:
-            od.rounded_rectangle((pad,pad,W-pad,H-pad), radius=46, outline=(*frame_col,alpha), width=3)
-        od.rounded_rectangle((48,48,W-48,H-48), radius=42, fill=(9,18,36,210), outline=(*frame_col,255), width=5)
-        img = Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB'); d=ImageDraw.Draw(img)
 
         # helpers
         def text_w(txt, f):
@@ -4052,62 +4492,34 @@ def build_profile_card(user_id:int, name:str):
         def center_text(box, txt, f, fill):
             x1,y1,x2,y2=box; bb=d.textbbox((0,0),str(txt),font=f); tw=bb[2]-bb[0]; th=bb[3]-bb[1]
             d.text((x1+(x2-x1-tw)/2,y1+(y2-y1-th)/2-2),str(txt),font=f,fill=fill)
-        def panel(box, fill=(16,31,60,235), outline=None, radius=28, width=2):
-            x1,y1,x2,y2=box; outline=outline or (*frame_col,190)
-            layer=Image.new('RGBA',(W,H),(0,0,0,0)); ld=ImageDraw.Draw(layer)
-            ld.rounded_rectangle(box, radius=radius, fill=fill, outline=outline, width=width)
-            # top highlight
-            ld.rounded_rectangle((x1+8,y1+8,x2-8,y1+45), radius=radius//2, fill=(255,255,255,18))
-            return Image.alpha_composite(img.convert('RGBA'), layer).convert('RGB')
 
         # header
-        img2=panel((82,78,W-82,252), fill=(22,48,88,230), radius=34, width=3); img.paste(img2); d=ImageDraw.Draw(img)
         d.ellipse((122,112,218,208), fill=frame_col, outline=(235,248,255), width=4)
         initials=(name or 'U')[:1].upper(); center_text((122,112,218,208), initials, font(54,True), (8,18,35))
         fit_text(250,105,name,f_name,(248,252,255),760)
-        title = active_title(user_id)[1] if 'active_title' in globals() else '🆕 Новичок'
-        fit_text(252,178,f"{badge.get('emoji','▫️')} {title}",f_title,(255,222,92),760)
-        elo=get_rating_elo(user_id); rank=get_rating_rank(elo)
-        img2=panel((1195,108,1438,218), fill=(10,20,38,235), outline=(255,222,92,230), radius=24, width=3); img.paste(img2); d=ImageDraw.Draw(img)
-        d.text((1230,126),'⭐ Рейтинг',font=f_lab,fill=(180,205,235)); d.text((1230,158),str(elo),font=f_big,fill=(255,255,255))
+        fit_text(252,178,f"{view['badge']} {view['title']}",f_title,(255,222,92),760)
+        d.text((1230,126),'⭐ Рейтинг',font=f_lab,fill=(180,205,235)); d.text((1230,158),str(view['elo']),font=f_big,fill=(255,255,255))
 
         # stats left 2 columns
-        coins=get_coins(user_id); normal=len(u.get('cards',[])); seen=len(u.get('seen_cards',[])); total=len(load_data(CARDS_FILE, []))
-        matches=int(st.get('rating_matches',0)); wins=int(st.get('rating_wins',0)); wr=round(wins/max(1,matches)*100,1)
-        stats=[('💰 Баланс',_fmt_coins(coins)),('🃏 Карты',str(normal)),('📚 Уникальные',f'{seen}/{total}'),('🏒 Матчи',str(matches)),('🏆 Победы',str(wins)),('📈 Винрейт',f'{wr}%'),('⚔️ Дуэли',f"{st.get('duel_wins',0)} побед"),('🛠 Крафты',f"{st.get('craft_success',0)} успешных")]
-        x0,y0=82,288; cw,ch,gap=350,118,24
-        for i,(lab,val) in enumerate(stats):
-            x=x0+(i%2)*(cw+gap); y=y0+(i//2)*(ch+gap)
-            img2=panel((x,y,x+cw,y+ch), fill=(16,31,60,225), radius=22, width=2); img.paste(img2); d=ImageDraw.Draw(img)
+        for (x,y,x2,y2),(lab,val) in zip(PROFILE_STAT_BOXES, view['stats']):
+            cw=x2-x
             fit_text(x+24,y+18,lab,f_lab,(177,202,232),cw-48)
             fit_text(x+24,y+57,val,f_mid,(255,255,255),cw-48)
 
         # showcase section right
-        sx,sy,sw,sh=855,288,663,555
-        img2=panel((sx,sy,sx+sw,sy+sh), fill=(13,27,54,230), radius=30, width=3); img.paste(img2); d=ImageDraw.Draw(img)
+        sx,sy=PROFILE_SHOWCASE_BOX[:2]
         d.text((sx+30,sy+24),'⭐ ВИТРИНА КАРТ',font=f_mid,fill=(255,245,210))
         d.text((sx+30,sy+60),'любимые карты игрока',font=f_small,fill=(170,195,225))
-        cards_all=load_data(CARDS_FILE, []); cmap={int(c.get('id')):c for c in cards_all if 'id' in c}
-        showcase=[int(x) for x in custom.get('showcase',[])[:3] if str(x).isdigit()]
-        if not showcase:
-            # fallback: 3 strongest/first available cards so profile never looks empty
-            owned=list(dict.fromkeys(u.get('cards',[])))[:3]
-            showcase=[int(x) for x in owned if int(x) in cmap][:3]
-        card_boxes=[(sx+28, sy+108, sx+215, sy+488),(sx+238, sy+108, sx+425, sy+488),(sx+448, sy+108, sx+635, sy+488)]
-        rarity_colors={'Обычная':(150,165,185),'Редкая':(80,160,255),'Эпическая':(185,95,255),'Легендарная':(255,205,72),'Мифическая':(120,240,255),'Эксклюзивная':(255,105,190)}
-        for idx,box in enumerate(card_boxes):
+        for idx,box in enumerate(PROFILE_CARD_BOXES):
             x1,y1,x2,y2=box
-            cid=showcase[idx] if idx < len(showcase) else None
-            card=cmap.get(cid,{}) if cid else {}
-            rarity=str(card.get('rarity',''))
-            rc=rarity_colors.get(rarity, frame_col)
-            img2=panel(box, fill=(10,20,40,235), outline=(*rc,230), radius=22, width=3); img.paste(img2); d=ImageDraw.Draw(img)
+            card=view['slots'][idx] if idx < len(view['slots']) else None
+            rarity=card['rarity'] if card else ''
+            rc=PROFILE_RARITY_COLORS.get(rarity, frame_col)
+            _profile_panel(img, box, fill=(10,20,40,235), outline=(*rc,230), radius=22, width=3)
             photo_box=(x1+13,y1+14,x2-13,y1+220)
-            if card and card.get('image'):
-                path=os.path.join(CARDS_IMAGE_DIR, card.get('image',''))
+            if card and card['image']:
                 try:
-                    ph=Image.open(path).convert('RGB')
-                    ph=ImageOps.fit(ph,(photo_box[2]-photo_box[0],photo_box[3]-photo_box[1]),centering=(0.5,0.25))
+                    ph=_fitted_photo(card['image'],(photo_box[2]-photo_box[0],photo_box[3]-photo_box[1]),centering=(0.5,0.25))
                     mask=Image.new('L',ph.size,0); md=ImageDraw.Draw(mask); md.rounded_rectangle((0,0,ph.size[0],ph.size[1]),radius=16,fill=255)
                     img.paste(ph,photo_box[:2],mask)
                 except Exception:
@@ -4115,20 +4527,19 @@ def build_profile_card(user_id:int, name:str):
             else:
                 d.rounded_rectangle(photo_box,radius=16,fill=(28,42,72)); center_text(photo_box,'ПУСТО',f_lab,(170,190,220))
             if card:
-                fit_text(x1+16,y1+248,card.get('name','?'),font(22,True),(255,255,255),x2-x1-32)
+                fit_text(x1+16,y1+248,card['name'],font(22,True),(255,255,255),x2-x1-32)
                 fit_text(x1+16,y1+282,rarity,font(18),rc,x2-x1-32)
-                pwr=get_card_power(card) if 'get_card_power' in globals() else 0
                 d.rounded_rectangle((x1+16,y2-58,x2-16,y2-18),radius=13,fill=(0,0,0,90),outline=(*rc,180),width=1)
-                center_text((x1+16,y2-58,x2-16,y2-18),f'СИЛА {pwr}',font(20,True),(255,255,255))
+                center_text((x1+16,y2-58,x2-16,y2-18),f"СИЛА {card['power']}",font(20,True),(255,255,255))
 
         # footer strip
-        img2=panel((82,880,W-82,970), fill=(10,22,42,235), radius=24, width=2); img.paste(img2); d=ImageDraw.Draw(img)
-        style_line=f"{bg.get('emoji','')} {bg.get('name','Фон')}  •  {fr.get('emoji','')} {fr.get('name','Рамка')}  •  {rank[1]} {rank[2]}"
-        fit_text(118,900,style_line,f_lab,(215,235,255),920)
+        fit_text(118,900,view['style_line'],f_lab,(215,235,255),920)
         fit_text(118,934,'/profile_custom • /cosmetic_shop • /my_cosmetics • /quests',f_small,(170,195,225),1100)
         # watermark
         d.text((W-390,925),'@RUSHOCKEYCARDS_BOT',font=font(28,True),fill=(*frame_col,))
-        out=io.BytesIO(); img.save(out,'PNG',quality=95); out.seek(0); return out
+        out=encode_image(img, "profile")
+        _store_profile_card(user_id, cache_path, out.getvalue())
+        out.seek(0); return out
     except Exception as e:
         logger.warning(f'profile card error: {e}')
         return None
@@ -4172,7 +4583,9 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"🏷 Титулы: /titles\n📋 Задания: /quests\n🎯 Гарант: /pity\n🏥 Лазарет: /injuries"
     )
     try:
-        img = build_profile_card(user.id, user.first_name or f"Игрок {user.id}") if 'build_profile_card' in globals() else None
+        profile_name = user.first_name or f"Игрок {user.id}"
+        # неизменившийся профиль отдаётся из кэша без похода в пул рендера
+        img = _cached_profile_card(user.id, profile_name) or await render_image("profile", user.id, profile_name)
         if img:
             await update.message.reply_photo(photo=img, caption=msg, parse_mode="HTML")
             return
@@ -5413,18 +5826,15 @@ async def process_channel_events(context: ContextTypes.DEFAULT_TYPE) -> None:
             pass
     # Завершение розыгрышей (по времени или по числу участников)
     try:
+        _flush_giveaway_participants()
         giveaways = load_data(GIVEAWAYS_FILE, [])
-        gw_changed = False
         for gw in giveaways:
             if gw.get("status") != "active":
                 continue
             by_time = gw.get("end_type") == "time" and now_ts >= (gw.get("end_at") or 0)
             by_count = gw.get("end_type") == "participants" and len(gw.get("participants", [])) >= gw.get("end_value", 0)
             if by_time or by_count:
-                await _finish_giveaway(gw, context)
-                gw_changed = True
-        if gw_changed:
-            save_data(GIVEAWAYS_FILE, giveaways)
+                _finish_giveaway_later(gw, context)
     except Exception as e:
         logger.error(f"Ошибка завершения розыгрышей: {e}")
 
@@ -5448,34 +5858,61 @@ async def _event_worker(application: Application) -> None:
             break
 
 
+async def _post_shutdown(application: Application) -> None:
+    """Перед остановкой сохраняем участников розыгрышей и гасим пул рендера картинок."""
+    try:
+        _flush_giveaway_participants()
+    except Exception as e:
+        logger.error(f"Не удалось сохранить участников розыгрышей при остановке: {e}")
+    try:
+        _flush_match_state(application.bot_data, force=True)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить состояние матчмейкинга при остановке: {e}")
+    _shutdown_render_pool()
+
+
 async def _post_init(application: Application) -> None:
     """Запускает фоновый воркер + добиваем просроченные розыгрыши сразу после старта."""
     application.bot_data["mc_loop"] = asyncio.get_running_loop()
     application.create_task(_event_worker(application))
+    application.create_task(_giveaway_flush_worker(application))
+    _restore_match_state(application)
+    application.create_task(_matchmaking_worker(application))
+    application.create_task(_match_state_flush_worker(application))
+    application.create_task(_duel_expiry_worker(application))
+    application.create_task(_resolve_interrupted_matches(application))
+    if _load_tournament().get("status") == "running":
+        _ensure_tournament_runner(application)
     # Если бот перезапустился через /update, розыгрыши которые уже истекли — подводимся сразу
     async def _startup_giveaway_check():
         await asyncio.sleep(5)  # ждём пока Telegram-соединение установится
         try:
+            _flush_giveaway_participants()
             giveaways = load_data(GIVEAWAYS_FILE, [])
             now = time.time()
             changed = False
             ctx = CallbackContext(application)
             for gw in giveaways:
-                if gw.get("status") != "active":
+                # «finishing» — итоги были отданы фоновой задаче, но призы до перезапуска не выданы
+                if gw.get("status") not in ("active", "finishing"):
                     continue
                 by_time = gw.get("end_type") == "time" and gw.get("end_at") and now >= gw["end_at"]
                 by_count = (gw.get("end_type") == "participants" and
                             len(gw.get("participants", [])) >= gw.get("end_value", 0))
-                if by_time or by_count:
-                    await _finish_giveaway(gw, ctx)
+                if by_time or by_count or gw.get("status") == "finishing":
+                    _finish_giveaway_later(gw, ctx)
                     changed = True
             if changed:
-                save_data(GIVEAWAYS_FILE, giveaways)
                 logger.info(f"Startup: добиты просроченные розыгрыши.")
         except Exception as e:
             logger.error(f"Startup giveaway check error: {e}")
     application.create_task(_startup_giveaway_check())
 
+    async def _startup_framed_warmup():
+        await asyncio.sleep(FRAMED_WARMUP_START_DELAY)
+        schedule_framed_card_warmup(CallbackContext(application))
+    application.create_task(_startup_framed_warmup())
+
 # ============================ СЕЗОНЫ РЕЙТИНГА ============================
 async def start_season_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
@@ -5549,15 +5986,16 @@ async def season_prize_3(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "prizes": prizes,
         "started_at": time.time(),
     })
-    await post_to_channel(
-        context,
+    announce = (
         f"🏆 <b>Начался рейтинговый сезон #{num}!</b>\n\n"
         f"Рейтинг всех игроков сброшен до {DEFAULT_RATING_ELO}.\n"
         f"🥇 1 место: {prizes[0]} монет\n"
         f"🥈 2 место: {prizes[1]} монет\n"
         f"🥉 3 место: {prizes[2]} монет\n\n"
-        f"⚔️ Играйте: /find_match",
+        f"⚔️ Играйте: /find_match"
     )
+    # Пост в канал и ЛС подписчикам — фоновой задачей, команда отвечает сразу
+    start_bulk_job(context, f"Анонс сезона #{num}", lambda: post_to_channel(context, announce))
     await update.message.reply_text(f"✅ Сезон #{num} начался! Рейтинг сброшен.")
     context.user_data.clear()
     return ConversationHandler.END
@@ -5588,52 +6026,60 @@ async def end_season_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     prizes = season.get("prizes", [0, 0, 0])
     medals = ["🥇", "🥈", "🥉"]
     result_lines = [f"🏁 <b>Сезон #{season.get('number')} завершён!</b>\n"]
+    # Имена призёров запрашиваем параллельно, а не по одному get_chat на место
+    names = await asyncio.gather(*(_get_display_name(context, uid) for uid, _ in top3))
+    coin_changes = {}
+    dm_messages = []
     for i, (uid, elo) in enumerate(top3):
         prize = prizes[i] if i < len(prizes) else 0
-        name = html.escape(await _get_display_name(context, uid))
+        name = html.escape(names[i])
         if prize > 0:
-            update_coins(uid, prize)
-            try:
-                await context.bot.send_message(
-                    uid,
-                    f"{medals[i]} Вы заняли {i + 1} место в сезоне #{season.get('number')}!\n"
-                    f"💰 Награда: {prize} монет\n⭐ Рейтинг: {elo}",
-                )
-            except Exception:
-                pass
+            coin_changes[uid] = coin_changes.get(uid, 0) + prize
+            dm_messages.append((
+                uid,
+                f"{medals[i]} Вы заняли {i + 1} место в сезоне #{season.get('number')}!\n"
+                f"💰 Награда: {prize} монет\n⭐ Рейтинг: {elo}",
+                None,
+            ))
         result_lines.append(f"{medals[i]} {name} — ⭐ {elo} (+{prize} монет)")
     # Начисляем трофейные очки за топ-10
     trophy_pts_map = {1: 10, 2: 5, 3: 3}
     all_top10 = leaders[:10]
-    for _rank_i, (_uid, _elo) in enumerate(all_top10, start=1):
-        _pts = trophy_pts_map.get(_rank_i, 1)
-        _old_pts = get_trophy_points(_uid)
-        _new_pts = add_trophy_points(_uid, _pts)
+    trophy_changes = {_uid: trophy_pts_map.get(_rank_i, 1) for _rank_i, (_uid, _elo) in enumerate(all_top10, start=1)}
+    rank_by_uid = {_uid: _rank_i for _rank_i, (_uid, _elo) in enumerate(all_top10, start=1)}
+    # Все начисления фиксируются одной записью на файл, уведомления — уже после
+    update_coins_bulk(coin_changes)
+    trophy_result = add_trophy_points_bulk(trophy_changes)
+
+    def _t(p):
+        for thr, en, ru, em in TITLES:
+            if p >= thr:
+                return en, ru, em
+        return "Average", "Обыватель", "👥"
+    for _uid, (_old_pts, _new_pts) in trophy_result.items():
         # Проверяем смену звания
-        def _t(p):
-            for thr, en, ru, em in TITLES:
-                if p >= thr:
-                    return en, ru, em
-            return "Average", "Обыватель", "👥"
         _old_t = _t(_old_pts)
         _new_t = _t(_new_pts)
         if _new_t[0] != _old_t[0]:
-            try:
-                await context.bot.send_message(
-                    _uid,
-                    f"🏆 <b>Новое звание!</b>\n\n"
-                    f"{_new_t[2]} <b>{_new_t[0]}</b> — {_new_t[1]}\n"
-                    f"Трофейных очков: {_new_pts}\n\n"
-                    f"Заработано за топ-{_rank_i} в сезоне #{season.get('number')}!",
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
+            dm_messages.append((
+                _uid,
+                f"🏆 <b>Новое звание!</b>\n\n"
+                f"{_new_t[2]} <b>{_new_t[0]}</b> — {_new_t[1]}\n"
+                f"Трофейных очков: {_new_pts}\n\n"
+                f"Заработано за топ-{rank_by_uid[_uid]} в сезоне #{season.get('number')}!",
+                "HTML",
+            ))
     season["active"] = False
     season["ended_at"] = time.time()
     save_data(SEASON_FILE, season)
-    await post_to_channel(context, "\n".join(result_lines), notification_category="giveaways")
-    await update.message.reply_text("✅ Сезон завершён, призы выданы!")
+
+    # Призы уже сохранены — ЛС призёрам и итоги в канал уходят фоновой задачей
+    async def _announce():
+        await send_dm_batch(context, dm_messages)
+        await post_to_channel(context, "\n".join(result_lines), notification_category="giveaways")
+
+    start_bulk_job(context, f"Итоги сезона #{season.get('number')}", _announce)
+    await update.message.reply_text("✅ Сезон завершён, призы выданы! Уведомления рассылаются в фоне.")
 
 # ============================ РОЗЫГРЫШИ (АДМИН) ============================
 GIVEAWAYS_FILE = "giveaways.json"
@@ -5799,6 +6245,107 @@ async def giveaway_end_condition(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data.pop("new_giveaway", None)
     return ConversationHandler.END
 
+# Участники активных розыгрышей держатся в памяти: нажатие «Участвовать» подтверждается
+# сразу, без перезаписи giveaways.json. Новые участники сбрасываются в файл пачкой
+# (раз в GIVEAWAY_FLUSH_INTERVAL секунд, перед подведением итогов и при остановке бота),
+# а счётчик на кнопке обновляется не чаще одного раза в GIVEAWAY_MARKUP_EDIT_INTERVAL секунд.
+GIVEAWAY_FLUSH_INTERVAL = 10
+GIVEAWAY_MARKUP_EDIT_INTERVAL = 5
+_GIVEAWAY_LIVE = {}  # gid -> {"gw": метаданные, "ids": set, "pending": [...], "count": int, ...}
+
+
+def _giveaway_live_state(gid: int):
+    """Состояние розыгрыша в памяти; при первом обращении подгружается из файла."""
+    state = _GIVEAWAY_LIVE.get(gid)
+    if state is not None:
+        return state
+    gw = next((x for x in load_data(GIVEAWAYS_FILE, []) if x.get("id") == gid), None)
+    if not gw or gw.get("status") != "active":
+        return None
+    participants = gw.get("participants", [])
+    state = {
+        "gw": {k: v for k, v in gw.items() if k != "participants"},
+        "ids": {p.get("id") for p in participants},
+        "pending": [],
+        "count": len(participants),
+        "edited_at": 0.0,
+        "edit_task": None,
+        "message": None,
+    }
+    _GIVEAWAY_LIVE[gid] = state
+    return state
+
+
+def _flush_giveaway_participants() -> None:
+    """Дописывает накопленных в памяти участников в giveaways.json одной записью."""
+    dirty = {gid: st for gid, st in _GIVEAWAY_LIVE.items() if st["pending"]}
+    if not dirty:
+        return
+    giveaways = load_data(GIVEAWAYS_FILE, [])
+    for gw in giveaways:
+        state = dirty.get(gw.get("id"))
+        if not state:
+            continue
+        participants = gw.setdefault("participants", [])
+        known = {p.get("id") for p in participants}
+        participants.extend(p for p in state["pending"] if p.get("id") not in known)
+    save_data(GIVEAWAYS_FILE, giveaways)
+    for state in dirty.values():
+        state["pending"] = []
+
+
+def _close_giveaway_live(gw: dict) -> None:
+    """При подведении итогов: забирает ещё не сохранённых участников в gw и закрывает приём.
+    Закрытая запись остаётся в памяти, чтобы запоздалые нажатия не подгрузили розыгрыш
+    из файла, который вызывающая сторона ещё не успела сохранить."""
+    gid = gw.get("id")
+    state = _GIVEAWAY_LIVE.get(gid)
+    if state:
+        participants = gw.setdefault("participants", [])
+        known = {p.get("id") for p in participants}
+        participants.extend(p for p in state["pending"] if p.get("id") not in known)
+        task = state.get("edit_task")
+        if task and not task.done():
+            task.cancel()
+    _GIVEAWAY_LIVE[gid] = {"gw": {"id": gid, "status": "finished"}, "ids": set(), "pending": [], "count": 0,
+                           "edited_at": 0.0, "edit_task": None, "message": None}
+
+
+async def _giveaway_flush_worker(application: Application) -> None:
+    """Периодически сохраняет участников розыгрышей, накопленных в памяти."""
+    while True:
+        try:
+            await asyncio.sleep(GIVEAWAY_FLUSH_INTERVAL)
+            _flush_giveaway_participants()
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("Ошибка сохранения участников розыгрышей")
+
+
+def _schedule_giveaway_markup_edit(gid: int, state: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отложенное обновление счётчика на кнопке: одна правка на окно GIVEAWAY_MARKUP_EDIT_INTERVAL."""
+    if state["message"] is None or (state["edit_task"] and not state["edit_task"].done()):
+        return
+
+    async def _edit():
+        delay = state["edited_at"] + GIVEAWAY_MARKUP_EDIT_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        chat_id, message_id = state["message"]
+        try:
+            await context.bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"🎉 Участвовать ({state['count']})", callback_data=f"gw_join_{gid}")]]),
+            )
+        except Exception:
+            pass
+        state["edited_at"] = time.monotonic()
+
+    state["edit_task"] = asyncio.create_task(_edit())
+
+
 async def giveaway_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user = query.from_user
@@ -5810,37 +6357,76 @@ async def giveaway_join_callback(update: Update, context: ContextTypes.DEFAULT_T
     if is_banned(user.id):
         await query.answer("❌ Вы заблокированы в этом боте.", show_alert=True)
         return
-    giveaways = load_data(GIVEAWAYS_FILE, [])
-    gw = next((x for x in giveaways if x.get("id") == gid), None)
-    if not gw or gw.get("status") != "active":
+    state = _giveaway_live_state(gid)
+    if not state or state["gw"].get("status") != "active":
         await query.answer("⏹ Этот розыгрыш уже завершён.", show_alert=True)
         return
-    if any(p.get("id") == user.id for p in gw.get("participants", [])):
+    if user.id in state["ids"]:
         await query.answer("✅ Вы уже участвуете в этом розыгрыше!", show_alert=True)
         return
-    gw.setdefault("participants", []).append({"id": user.id, "username": user.username, "first_name": user.first_name})
+    state["ids"].add(user.id)
+    state["pending"].append({"id": user.id, "username": user.username, "first_name": user.first_name})
+    state["count"] += 1
+    if query.message is not None:
+        state["message"] = (query.message.chat_id, query.message.message_id)
     await query.answer("🎉 Вы участвуете в розыгрыше! Удачи!", show_alert=True)
-    # Обновляем счётчик на кнопке
-    try:
-        await query.edit_message_reply_markup(
-            InlineKeyboardMarkup([[InlineKeyboardButton(f"🎉 Участвовать ({len(gw['participants'])})", callback_data=f"gw_join_{gid}")]])
-        )
-    except Exception:
-        pass
-    # Достигнуто нужное число участников — сразу подводим итоги
-    if gw.get("end_type") == "participants" and len(gw["participants"]) >= gw.get("end_value", 0):
-        await _finish_giveaway(gw, context)
+    gw_meta = state["gw"]
+    # Достигнуто нужное число участников — сохраняем и отдаём итоги фоновой задаче:
+    # призы, ЛС и пост в канал не держат нажатие последнего участника
+    if gw_meta.get("end_type") == "participants" and state["count"] >= gw_meta.get("end_value", 0):
+        gw_meta["status"] = "finishing"
+        _flush_giveaway_participants()
+        gw = next((x for x in load_data(GIVEAWAYS_FILE, []) if x.get("id") == gid), None)
+        if not gw or gw.get("status") != "active":
+            # Итоги уже подвели в другом месте — не оставляем «finishing» навсегда
+            gw_meta["status"] = gw.get("status", "finished") if gw else "finished"
+            return
+        _finish_giveaway_later(gw, context)
+        return
+    # Обновляем счётчик на кнопке (с задержкой, пачкой)
+    _schedule_giveaway_markup_edit(gid, state, context)
+
+def _store_giveaway_record(gw: dict) -> None:
+    """Записывает один розыгрыш: файл перечитывается и меняется только его запись.
+    Пока шли await в _finish_giveaway, воркер мог дописать участников других розыгрышей —
+    старый список, загруженный до итогов, их бы затёр."""
+    giveaways = load_data(GIVEAWAYS_FILE, [])
+    for i, item in enumerate(giveaways):
+        if item.get("id") == gw.get("id"):
+            giveaways[i] = gw
+            break
+    else:
+        giveaways.append(gw)
     save_data(GIVEAWAYS_FILE, giveaways)
 
+
+def _finish_giveaway_later(gw: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отдаёт итоги розыгрыша полосе массовых задач. Запись сразу помечается «finishing»,
+    чтобы воркер событий и /giveaways не подвели итоги второй раз; если бот перезапустится
+    до выдачи призов, такие записи добиваются при старте."""
+    gw["status"] = "finishing"
+    _close_giveaway_live(gw)
+    _store_giveaway_record(gw)
+
+    async def _run():
+        await _finish_giveaway(gw, context)
+        return None
+
+    start_bulk_job(context, f"Итоги розыгрыша #{gw.get('id')}", _run)
+
+
 async def _finish_giveaway(gw: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Подводит итоги: выдаёт призы, публикует результаты в канал,
-    шлёт лог админу и ЛС победителям. Сохранение файла — на вызывающей стороне."""
+    шлёт лог админу и ЛС победителям. Запись сохраняется сразу после выдачи призов,
+    до рассылок, — перезапуск во время рассылки не выдаст призы повторно."""
     gw["status"] = "finished"
     gw["finished_at"] = time.time()
+    _close_giveaway_live(gw)
     participants = gw.get("participants", [])
     card_map = {c["id"]: c for c in load_data(CARDS_FILE, [])}
     if not participants:
         gw["winners"] = []
+        _store_giveaway_record(gw)
         try:
             await post_to_channel(context, f"🎭 Розыгрыш #{gw['id']} завершён: участников не было, призы не разыграны.", notification_category="giveaways")
         except Exception:
@@ -5855,38 +6441,50 @@ async def _finish_giveaway(gw: dict, context: ContextTypes.DEFAULT_TYPE) -> None
     result_lines = [f"🎉 <b>ИТОГИ РОЗЫГРЫША #{gw['id']} • Хоккейные карточки</b>\n"]
     log_lines = []
     gw["winners"] = []
+    coin_changes = {}
+    card_grants = []
+    reset_ids = []
+    dm_messages = []
     for i, winner in enumerate(winners):
         prize = gw["prizes"][i]
         label = _prize_label(prize, card_map)
-        # Выдаём приз автоматически
-        try:
-            if prize["type"] == "coins":
-                update_coins(winner["id"], prize["amount"])
-            elif prize["type"] == "card":
-                add_one_card(winner["id"], prize["card_id"])
-            elif prize["type"] == "reset":
-                users = load_data(USERS_FILE, {})
-                udata = users.get(str(winner["id"]), {})
-                udata["last_drop"] = 0
-                udata["last_work"] = 0
-                users[str(winner["id"])] = udata
-                save_data(USERS_FILE, users)
-        except Exception as e:
-            logger.error(f"Не удалось выдать приз победителю {winner.get('id')}: {e}")
+        # Призы сначала собираются в памяти и выдаются одним пакетом ниже
+        if prize["type"] == "coins":
+            coin_changes[winner["id"]] = coin_changes.get(winner["id"], 0) + prize["amount"]
+        elif prize["type"] == "card":
+            card_grants.append((winner["id"], prize["card_id"]))
+        elif prize["type"] == "reset":
+            reset_ids.append(winner["id"])
         name = _gw_display(winner)
         result_lines.append(f"{_gw_place(i)}: {html.escape(name)} — {html.escape(label)}")
         log_lines.append(f"{i + 1} место: {name} (ID {winner.get('id')}) — {label}")
         gw["winners"].append({"id": winner.get("id"), "prize": prize})
-        # Уведомляем победителя в ЛС
-        try:
-            await context.bot.send_message(
-                winner["id"],
-                f"🎉 <b>Поздравляем!</b> Вы победили в розыгрыше #{gw['id']} ({_gw_place(i)})!\n"
-                f"🎁 Ваш приз: <b>{html.escape(label)}</b>\nПриз уже начислен!",
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
+        dm_messages.append((
+            winner["id"],
+            f"🎉 <b>Поздравляем!</b> Вы победили в розыгрыше #{gw['id']} ({_gw_place(i)})!\n"
+            f"🎁 Ваш приз: <b>{html.escape(label)}</b>\nПриз уже начислен!",
+            "HTML",
+        ))
+    # Выдаём призы автоматически: одна запись coins.json и одна users.json на весь розыгрыш
+    try:
+        update_coins_bulk(coin_changes)
+    except Exception as e:
+        logger.error(f"Не удалось выдать монеты победителям розыгрыша #{gw.get('id')}: {e}")
+    try:
+        grant_cards_bulk(card_grants)
+        if reset_ids:
+            users = load_data(USERS_FILE, {})
+            for uid in reset_ids:
+                udata = users.get(str(uid), {})
+                udata["last_drop"] = 0
+                udata["last_work"] = 0
+                users[str(uid)] = udata
+            save_data(USERS_FILE, users)
+    except Exception as e:
+        logger.error(f"Не удалось выдать призы победителям розыгрыша #{gw.get('id')}: {e}")
+    _store_giveaway_record(gw)
+    # Уведомляем победителей в ЛС
+    await send_dm_batch(context, dm_messages)
     result_lines.append(f"\n👥 Участников: {len(participants)}. Спасибо всем за участие!")
     try:
         await post_to_channel(context, "\n".join(result_lines), notification_category="giveaways")
@@ -5907,16 +6505,13 @@ async def giveaways_list(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ Эта команда доступна только администратору!")
         return
     # При просмотре — также добиваем просроченные старые розыгрыши
+    _flush_giveaway_participants()
     _gws_all = load_data(GIVEAWAYS_FILE, [])
     _gw_now = time.time()
-    _gw_changed = False
     for _gw in _gws_all:
         if _gw.get("status") != "active": continue
         if _gw.get("end_type") == "time" and _gw.get("end_at") and _gw_now >= _gw["end_at"]:
-            await _finish_giveaway(_gw, context)
-            _gw_changed = True
-    if _gw_changed:
-        save_data(GIVEAWAYS_FILE, _gws_all)
+            _finish_giveaway_later(_gw, context)
     active = [g for g in _gws_all if g.get("status") == "active"]
     if not active:
         await update.message.reply_text("📭 Активных розыгрышей нет. Создать: /giveaway")
@@ -6180,6 +6775,8 @@ async def finish_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     bets = load_data(BETS_FILE, [])
     total_wins = 0
     total_loses = 0
+    coin_changes = {}
+    dm_messages = []
     for bet in bets:
         if bet["match_id"] == match_id and bet["status"] == "pending":
             outcome = next((o for o in event["outcomes"] if o["id"] == bet["outcome_id"]), None)
@@ -6205,27 +6802,28 @@ async def finish_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             if win:
                 bet["status"] = "win"
                 win_amount = int(bet["amount"] * outcome["coefficient"])
-                update_coins(bet["user_id"], win_amount)
+                coin_changes[bet["user_id"]] = coin_changes.get(bet["user_id"], 0) + win_amount
                 total_wins += 1
-                try:
-                    await context.bot.send_message(
-                        bet["user_id"],
-                        f"🎉 Ваша ставка на матч {event['team1']} - {event['team2']} выиграла!\n"
-                        f"Исход: {outcome['label']}\nСумма выигрыша: {win_amount} монет."
-                    )
-                except:
-                    pass
+                dm_messages.append((
+                    bet["user_id"],
+                    f"🎉 Ваша ставка на матч {event['team1']} - {event['team2']} выиграла!\n"
+                    f"Исход: {outcome['label']}\nСумма выигрыша: {win_amount} монет.",
+                    None,
+                ))
             else:
                 bet["status"] = "lose"
                 total_loses += 1
-                try:
-                    await context.bot.send_message(
-                        bet["user_id"],
-                        f"❌ Ваша ставка на матч {event['team1']} - {event['team2']} проиграла.\nИсход: {outcome['label']}"
-                    )
-                except:
-                    pass
+                dm_messages.append((
+                    bet["user_id"],
+                    f"❌ Ваша ставка на матч {event['team1']} - {event['team2']} проиграла.\nИсход: {outcome['label']}",
+                    None,
+                ))
+    # Расчёт целиком в памяти: одна запись coins.json и одна bets.json на весь матч
+    update_coins_bulk(coin_changes)
     save_data(BETS_FILE, bets)
+    # Уведомления по ставкам уходят в фоне с ограничением скорости — админ не ждёт рассылку
+    if dm_messages:
+        start_bulk_job(context, f"Ставки матча #{match_id}", lambda: _send_dm_batch_logged(context, dm_messages, f"Ставки матча #{match_id}"))
 
     await update.message.reply_text(f"✅ Матч '{event['team1']} - {event['team2']}' завершён со счётом {score}.\n"
                                     f"Обработано ставок: выигрышных - {total_wins}, проигрышных - {total_loses}.")
@@ -6577,36 +7175,25 @@ async def cancel_rating_team(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data.pop(key, None)
     return ConversationHandler.END
 
+TEAM_FONT_PATHS = (
+    "/usr/share/fonts/google-droid-sans-fonts/DroidSans-Bold.ttf",
+    "/usr/share/fonts/google-noto-vf/NotoSans[wght].ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+    "DejaVuSans-Bold.ttf",
+    "C:/Windows/Fonts/arialbd.ttf",
+    "arialbd.ttf",
+    "arial.ttf",
+)
+
+
 def _load_team_font(size: int):
-    """Шрифт с кириллицей. DroidSans-Bold -> NotoSans -> fallback."""
-    _size = max(8, int(size))
-    for path in (
-        "/usr/share/fonts/google-droid-sans-fonts/DroidSans-Bold.ttf",
-        "/usr/share/fonts/google-noto-vf/NotoSans[wght].ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-        "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
-        "DejaVuSans-Bold.ttf",
-        "C:/Windows/Fonts/arialbd.ttf",
-        "arialbd.ttf",
-        "arial.ttf",
-    ):
-        try:
-            return ImageFont.truetype(path, _size)
-        except Exception:
-            continue
-    try:
-        return ImageFont.load_default(_size)
-    except Exception:
-        return ImageFont.load_default()
+    """Шрифт с кириллицей. DroidSans-Bold -> NotoSans -> fallback (из кэша шрифтов)."""
+    return _cached_font('team', TEAM_FONT_PATHS, max(8, int(size)))
 
 def _draw_vertical_gradient(img, top_color, bottom_color):
-    """Вертикальный градиент фона (1px колонка, растянутая на всю ширину)."""
-    w, h = img.size
-    col = Image.new("RGB", (1, h))
-    for y in range(h):
-        t = y / max(1, h - 1)
-        col.putpixel((0, y), tuple(int(a + (b - a) * t) for a, b in zip(top_color, bottom_color)))
-    img.paste(col.resize((w, h)))
+    """Вертикальный градиент фона (готовая плитка из кэша градиентов)."""
+    img.paste(_gradient_tile(img.size, top_color, bottom_color))
 
 def _short_card_name(name: str, max_len: int = 14) -> str:
     """Умное обрезание длинного имени карточки. Убирает скобки если длинно."""
@@ -6626,7 +7213,41 @@ def _short_card_name(name: str, max_len: int = 14) -> str:
 # HUD HELPERS — arena background, glassmorphism, glow text
 # ═══════════════════════════════════════════════════════════════════════
 
+# Фон арены детерминирован (фиксированный seed частиц), поэтому он рисуется один раз
+# на размер: готовая картинка кэшируется в памяти процесса и на диске, а постеры
+# берут себе копию. При изменении рисунка фона увеличьте ARENA_BG_VERSION.
+ARENA_BG_CACHE_DIR = "render_cache"
+ARENA_BG_VERSION = 1
+_ARENA_BG_CACHE = {}
+
+
 def _arena_bg_2k(W: int = 2048, H: int = 2048):
+    """Фон стадиона W×H из кэша (память -> диск -> отрисовка). Возвращает копию RGB."""
+    key = (int(W), int(H))
+    cached = _ARENA_BG_CACHE.get(key)
+    if cached is None:
+        path = os.path.join(ARENA_BG_CACHE_DIR, f"arena_{key[0]}x{key[1]}_v{ARENA_BG_VERSION}.png")
+        try:
+            with Image.open(path) as disk_img:
+                cached = disk_img.convert('RGB')
+            if cached.size != key:
+                cached = None
+        except Exception:
+            cached = None
+        if cached is None:
+            cached = _render_arena_bg_2k(*key)
+            try:
+                os.makedirs(ARENA_BG_CACHE_DIR, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                cached.save(tmp_path, 'PNG')
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить кэш фона арены: {e}")
+        _ARENA_BG_CACHE[key] = cached
+    return cached.copy()
+
+
+def _render_arena_bg_2k(W: int = 2048, H: int = 2048):
     """Тёмный ледовый стадион 2048×2048: прожекторы, лёд, частицы, трибуны."""
     img = Image.new('RGBA', (W, H), (4, 8, 20, 255))
     draw = ImageDraw.Draw(img)
@@ -6794,7 +7415,7 @@ def build_rating_team_image(user_id: int):
     coach_ref = team.get("coach")
 
     W, H = 1800, 2200
-    img = _arena_bg_2k(W, H).convert('RGB')
+    img = _arena_bg_2k(W, H)
     draw = ImageDraw.Draw(img)
 
     def F(sz): return _load_team_font(sz)
@@ -6871,12 +7492,11 @@ def build_rating_team_image(user_id: int):
         fn=str(card.get('image','')); fp=os.path.join(CARDS_IMAGE_DIR,fn)
         if fn and os.path.exists(fp):
             try:
-                photo=Image.open(fp).convert('RGBA')
-                photo=ImageOps.fit(photo,(art[2]-art[0],art[3]-art[1]),centering=(0.5,0.32))
+                photo=_fitted_photo(fp,(art[2]-art[0],art[3]-art[1]),centering=(0.5,0.32),mode='RGBA')
                 mask=Image.new('L',photo.size,0); md=ImageDraw.Draw(mask); md.rounded_rectangle((0,0,*photo.size),radius=22,fill=255)
                 img.paste(photo,(art[0],art[1]),mask)
                 if meta:
-                    frame=Image.open(meta['frame_path']).convert('RGBA').resize(photo.size)
+                    frame=_fitted_photo(meta['frame_path'],photo.size,centering=None,mode='RGBA')
                     img.paste(frame,(art[0],art[1]),frame)
             except Exception:
                 draw.rounded_rectangle(art,radius=22,fill=(26,39,75))
@@ -6904,7 +7524,104 @@ def build_rating_team_image(user_id: int):
     coach_name=_team_ref_name(user_id, coach_ref, card_map, html_safe=False) if coach_ref else 'без тренера'
     footer=f'Тренер: {coach_name}  •  Тактика: {tactic}'
     center(trim(footer, fit(footer,W-300,30,16), W-300), W//2, 2114, fit(footer,W-300,30,16), (245,247,252))
-    out=io.BytesIO(); img.save(out,'PNG'); out.seek(0); return out
+    return encode_image(img, "rating_team")
+
+
+# ============================ ПРОГНОЗ ШАНСА ПОБЕДЫ ============================
+# Шанс победы по той же модели, что и simulate_match_core, но сразу для N матчей
+# одним проходом по массивам NumPy (без NumPy — обычным циклом на меньшей выборке).
+# /rating показывает шанс против «среднего соперника» своего ранга: средние сила,
+# ELO и тактика всех игроков этого ранга с собранным составом. Результат кэшируется
+# по сигнатуре (сила, тактика, ELO, соперник) — пересчёт только когда состав изменился.
+WIN_ESTIMATE_SAMPLES = 20000
+WIN_ESTIMATE_SAMPLES_NO_NUMPY = 3000
+WIN_ESTIMATE_CACHE_LIMIT = 512
+RANK_OPPONENTS_TTL = 600  # секунд; средний соперник ранга пересчитывается не чаще
+_WIN_ESTIMATE_CACHE = OrderedDict()
+_RANK_OPPONENTS = {"at": 0.0, "ranks": {}}
+
+
+def estimate_win_probability(sa: float, sb: float, ea: float, eb: float,
+                             mods_a=(0.0, 0.0), mods_b=(0.0, 0.0), samples: int = WIN_ESTIMATE_SAMPLES,
+                             seed=None) -> float:
+    """Доля побед стороны A (с учётом ОТ и буллитов) по модели simulate_match_core."""
+    atk_a, give_a = mods_a
+    atk_b, give_b = mods_b
+    if not NUMPY_AVAILABLE:
+        rng = random.Random(seed)
+        n = min(int(samples), WIN_ESTIMATE_SAMPLES_NO_NUMPY)
+        wins = 0
+        for _ in range(n):
+            r = simulate_match_core(sa, sb, ea, eb, mods_a, mods_b, rng, narrate=False)
+            wins += r['ga'] > r['gb']
+        return wins / max(1, n)
+    rng = np.random.default_rng(seed)
+    n = int(samples)
+    p_a = np.clip(.50 + (sa - sb) / 1000 + (ea - eb) / 3600 + rng.uniform(-0.025, 0.025, n), .28, .72)
+    edge = (p_a - .5) * .30
+    ga = np.zeros(n, dtype=np.int16)
+    gb = np.zeros(n, dtype=np.int16)
+    for _ in range(3):
+        comeback = np.clip((gb - ga) * 0.05, -0.10, 0.10)
+        draws = rng.random((4, n))
+        pa = (draws[0] < .30 + edge + comeback + atk_a + give_b).astype(np.int16) + (draws[2] < .10)
+        pb = (draws[1] < .30 - edge - comeback + atk_b + give_a).astype(np.int16) + (draws[3] < .10)
+        ga += pa
+        gb += pb
+    # ничья — ОТ или буллиты, победителя решает ot_pa
+    tie_win = rng.random(n) < np.clip(p_a, .44, .56)
+    return float(np.mean((ga > gb) | ((ga == gb) & tie_win)))
+
+
+async def _cached_win_probability(sa, sb, ea, eb, mods_a, mods_b) -> float:
+    """Кэш живёт в потоке event loop; в пул уходит только чистый расчёт estimate_win_probability."""
+    key = (round(sa), round(sb), round(ea), round(eb),
+           tuple(round(m, 4) for m in mods_a), tuple(round(m, 4) for m in mods_b))
+    value = _WIN_ESTIMATE_CACHE.get(key)
+    if value is not None:
+        _WIN_ESTIMATE_CACHE.move_to_end(key)
+        return value
+    value = await asyncio.to_thread(estimate_win_probability, sa, sb, ea, eb, mods_a, mods_b)
+    _WIN_ESTIMATE_CACHE[key] = value
+    while len(_WIN_ESTIMATE_CACHE) > WIN_ESTIMATE_CACHE_LIMIT:
+        _WIN_ESTIMATE_CACHE.popitem(last=False)
+    return value
+
+
+def _rank_opponent_profiles(card_map: dict) -> dict:
+    """номер ранга -> (средняя сила, средний ELO, средние mods, игроков). Кэш на RANK_OPPONENTS_TTL."""
+    if time.time() - _RANK_OPPONENTS["at"] < RANK_OPPONENTS_TTL:
+        return _RANK_OPPONENTS["ranks"]
+    sums = {}
+    for uid, data in load_data(USERS_FILE, {}).items():
+        team = data.get("rating_team")
+        if not team or not team.get("gk"):
+            continue
+        try:
+            strength = _team_strength(team, card_map, int(uid))
+        except Exception:
+            continue
+        elo = int(data.get("rating_elo", DEFAULT_RATING_ELO))
+        atk, give = _team_tactic_mods(team, card_map)
+        acc = sums.setdefault(get_rating_rank(elo)[0], [0.0, 0.0, 0.0, 0.0, 0])
+        acc[0] += strength; acc[1] += elo; acc[2] += atk; acc[3] += give; acc[4] += 1
+    ranks = {rank: (s / n, e / n, (a / n, g / n), n) for rank, (s, e, a, g, n) in sums.items()}
+    _RANK_OPPONENTS.update(at=time.time(), ranks=ranks)
+    return ranks
+
+
+async def rating_win_preview(user_id: int, team: dict, card_map: dict):
+    """Строка для /rating: шанс против среднего соперника своего ранга (или None).
+    Снимки составов (_TEAM_SNAPSHOTS) читаются и обновляются только здесь, в event loop."""
+    elo = get_rating_elo(user_id)
+    rank_no = get_rating_rank(elo)[0]
+    profile = _rank_opponent_profiles(card_map).get(rank_no)
+    if not profile:
+        return None
+    sb, eb, mods_b, count = profile
+    sa = _team_strength(team, card_map, user_id)
+    chance = await _cached_win_probability(sa, sb, elo, eb, _team_tactic_mods(team, card_map), mods_b)
+    return f"📊 Против среднего соперника вашего ранга: {chance:.0%} (игроков в ранге: {count})"
 
 
 async def rating_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -6939,10 +7656,15 @@ async def rating_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     team_name = team.get("name")
     header = f"🏒 Команда: «{team_name}»\n" if team_name else ""
     _, rank_emoji, rank_name = get_rating_rank(elo)
-    caption = header + f"⭐ Ваш рейтинг: {elo}\n{rank_emoji} Ранг: {rank_name}\n💪 Сила состава: {strength}\n\n" + "\n".join(lines)
+    try:
+        preview = await rating_win_preview(user.id, team, card_map)
+    except Exception as e:
+        logger.warning(f"Не удалось оценить шанс победы: {e}")
+        preview = None
+    caption = header + f"⭐ Ваш рейтинг: {elo}\n{rank_emoji} Ранг: {rank_name}\n💪 Сила состава: {strength}\n" + (f"{preview}\n" if preview else "") + "\n" + "\n".join(lines)
     photo = None
     try:
-        photo = build_rating_team_image(user.id)
+        photo = await render_image("rating_team", user.id)
     except Exception as e:
         logger.warning(f"Не удалось построить картинку состава: {e}")
     if photo:
@@ -6952,11 +7674,96 @@ async def rating_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 def _team_strength(team: dict, card_map: dict, owner_id=None) -> float:
-    """Сила состава. Для карт учитывается бонус именно выбранного экземпляра."""
-    def _power(card_ref):
-        return _team_ref_power(owner_id, card_ref, card_map)
-    gk_ref = team.get('gk')
-    return _power(gk_ref) * 1.5 + sum(_power(ref) for ref in team.get('field', []))
+    """Сила состава. Для карт учитывается бонус именно выбранного экземпляра.
+    Берётся из снимка состава (get_team_snapshot)."""
+    return get_team_snapshot(owner_id, team, card_map)['strength']
+
+
+# ============================ СНИМОК СОСТАВА ============================
+# Сила каждой позиции, общая сила, тактика и имена карт состава считаются один раз
+# и хранятся в памяти. Снимок пересобирается в set_rating_team и upgrade_card, а
+# также сам, если поменялся состав или база карточек/редкостей. Движок матча берёт
+# силы и имена только из снимка — без чтения users.json на каждую карту.
+_TEAM_SNAPSHOTS = {}
+
+
+def _team_snapshot_signature(team: dict) -> tuple:
+    mtimes = []
+    for path in (CARDS_FILE, RARITIES_FILE):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(0)
+    return (json.dumps(team, sort_keys=True, ensure_ascii=False, default=str), *mtimes)
+
+
+def build_team_snapshot(owner_id, team: dict, card_map: dict) -> dict:
+    """Снимок состава: позиции {ref, power, name, name_html}, сила, mods тактики, тренер."""
+    def slot(ref):
+        try:
+            power = int(_team_ref_power(owner_id, ref, card_map))
+        except Exception:
+            card = card_map.get(ref) or {}
+            power = int(get_card_power(card)) if card else 0
+        return {
+            'ref': ref,
+            'power': power,
+            'name': _team_ref_name(owner_id, ref, card_map, html_safe=False),
+            'name_html': _team_ref_name(owner_id, ref, card_map, html_safe=True),
+        }
+    gk = slot(team.get('gk')) if team.get('gk') else {'ref': None, 'power': 0, 'name': '?', 'name_html': '?'}
+    field = [slot(ref) for ref in team.get('field', [])]
+    coach = None
+    coach_bonus = 0
+    if team.get('coach'):
+        coach = slot(team['coach'])
+        coach_card = _team_ref_card(owner_id, team['coach'], card_map)
+        coach_bonus = round(get_coach_bonus(coach_card.get('rarity', '')) * 100) if coach_card else 3
+        if not coach_card:
+            coach['name'] = coach['name_html'] = f"Тренер {team['coach']}"
+    return {
+        'sig': _team_snapshot_signature(team),
+        'owner': owner_id,
+        'gk': gk,
+        'field': field,
+        'coach': coach,
+        'coach_bonus': coach_bonus,
+        'tactic': team.get('tactic', 'balanced'),
+        'strength': gk['power'] * 1.5 + sum(s['power'] for s in field),
+        'mods': _team_tactic_mods(team, card_map),
+    }
+
+
+def refresh_team_snapshot(user_id: int, team=None, card_map=None):
+    """Пересобирает снимок рейтингового состава игрока (None — состава нет)."""
+    team = team if team is not None else get_rating_team(user_id)
+    if not team:
+        _TEAM_SNAPSHOTS.pop(user_id, None)
+        return None
+    card_map = card_map if card_map is not None else {c['id']: c for c in load_data(CARDS_FILE, [])}
+    snap = build_team_snapshot(user_id, team, card_map)
+    _TEAM_SNAPSHOTS[user_id] = snap
+    return snap
+
+
+def get_team_snapshot(owner_id, team=None, card_map=None):
+    """Снимок состава из кэша. owner_id=None (бот-команда) — собирается без кэша."""
+    if owner_id is None:
+        card_map = card_map if card_map is not None else {c['id']: c for c in load_data(CARDS_FILE, [])}
+        return build_team_snapshot(None, team or {}, card_map)
+    team = team if team is not None else get_rating_team(owner_id)
+    if not team:
+        return None
+    snap = _TEAM_SNAPSHOTS.get(owner_id)
+    if snap is not None and snap['sig'] == _team_snapshot_signature(team):
+        return snap
+    return refresh_team_snapshot(owner_id, team, card_map)
+
+
+def _snapshot_pick_field(snap: dict, rng=None) -> dict:
+    """Полевой игрок из снимка; шанс пропорционален силе, как в _pick_field_player."""
+    field = snap['field'] or [snap['gk']]
+    return (rng or random).choices(field, weights=[max(1, s['power']) for s in field], k=1)[0]
 
 
 async def _get_display_name(context: ContextTypes.DEFAULT_TYPE, user_id) -> str:
@@ -6991,12 +7798,98 @@ def _generate_bot_team() -> dict:
         "name": bot_name,
     }
 
-HIT_EVENTS = [
-    "🖥 {player} ({team}) бросает в упор... НЕ РЕГНУЛО! Сервер не засчитал бросок!",
-    "🌀 ФЛИНГ! Шайбу от {player} ({team}) отменяют после видеопросмотра — аномальная физика!",
-    "📶 Лаг-гол от {player} ({team})? Судья идёт смотреть повтор... взятие ворот ОТМЕНЕНО!",
-    "🧤 ЛАГ-СЕЙВ! Шайба телепортируется прямо в ловушку {gk} — скамейка {team} в шоке!",
-    "💥 {player} ({team}) впечатывает соперника в борт — хит зарегистрирован сервером!",
+
+# ============================ ПУЛ БОТ-КОМАНД ============================
+# Бот-соперники берутся из заранее собранного пула, разложенного по ярусам силы
+# (шаг BOT_POOL_TIER_WIDTH). Пул пересобирается, только когда меняются cards.json
+# или rarities.json; выбор команды под силу игрока — индекс яруса и random.choice.
+BOT_POOL_RANDOM_TEAMS = 400      # случайные составы — «типичные» боты
+BOT_POOL_LADDER_STEPS = 40       # составы по квантилям силы — закрывают края шкалы
+BOT_POOL_LADDER_PER_STEP = 8
+BOT_POOL_TIER_WIDTH = 20
+BOT_POOL_PER_TIER = 40
+_BOT_TEAM_POOL = {"sig": None, "tiers": {}, "nearest": [], "base": 0}
+
+
+def _bot_pool_signature() -> tuple:
+    sig = []
+    for path in (CARDS_FILE, RARITIES_FILE):
+        try:
+            sig.append(os.path.getmtime(path))
+        except OSError:
+            sig.append(0)
+    return tuple(sig)
+
+
+def _build_bot_team_pool(all_cards: list) -> dict:
+    """Собирает ярусы {номер яруса: [(состав, сила)]} и таблицу ближайшего непустого яруса."""
+    rarity_power = {}
+    powered = []
+    for card in all_cards:
+        rarity = card.get("rarity", "Обычная")
+        if rarity not in rarity_power:
+            rarity_power[rarity] = int(get_card_power(card))
+        powered.append((rarity_power[rarity], card["id"]))
+    powered.sort()
+    tiers = {}
+
+    def add(sample):
+        """sample — пять (сила, id): вратарь, трое полевых, тренер."""
+        (gk_power, gk), field, (_, coach) = sample[0], sample[1:4], sample[4]
+        strength = gk_power * 1.5 + sum(p for p, _ in field)
+        bucket = tiers.setdefault(int(strength // BOT_POOL_TIER_WIDTH), [])
+        if len(bucket) < BOT_POOL_PER_TIER:
+            team = {"gk": gk, "field": [cid for _, cid in field], "coach": coach,
+                    "tactic": random.choice(["attack", "bus", "balanced"])}
+            bucket.append((team, strength))
+
+    for _ in range(BOT_POOL_RANDOM_TEAMS):
+        add(random.sample(powered, 5))
+    # «Лесенка»: пятёрки из соседних по силе карт — от самых слабых до самых сильных
+    window = max(5, len(powered) // BOT_POOL_LADDER_STEPS)
+    for step in range(BOT_POOL_LADDER_STEPS + 1):
+        start = min(len(powered) - window, round(step * (len(powered) - window) / BOT_POOL_LADDER_STEPS))
+        for _ in range(BOT_POOL_LADDER_PER_STEP):
+            add(random.sample(powered[start:start + window], 5))
+
+    base, top = min(tiers), max(tiers)
+    nearest = []
+    for tier in range(base, top + 1):
+        nearest.append(min(tiers, key=lambda t: (abs(t - tier), t)))
+    return {"tiers": tiers, "nearest": nearest, "base": base}
+
+
+def _bot_team_pool():
+    """Актуальный пул (пересборка при смене базы карточек); None — карточек меньше пяти."""
+    sig = _bot_pool_signature()
+    if _BOT_TEAM_POOL["sig"] != sig:
+        all_cards = load_data(CARDS_FILE, [])
+        pool = _build_bot_team_pool(all_cards) if len(all_cards) >= 5 else None
+        _BOT_TEAM_POOL.update(pool or {"tiers": {}, "nearest": [], "base": 0})
+        _BOT_TEAM_POOL["sig"] = sig
+    return _BOT_TEAM_POOL if _BOT_TEAM_POOL["tiers"] else None
+
+
+def pick_bot_team(target_strength=None) -> dict:
+    """Бот-команда с силой, близкой к target_strength (None — из любого яруса)."""
+    pool = _bot_team_pool()
+    if pool is None:
+        return _generate_bot_team()
+    nearest = pool["nearest"]
+    if target_strength is None:
+        tier = random.choice(nearest)
+    else:
+        index = int(target_strength // BOT_POOL_TIER_WIDTH) - pool["base"]
+        tier = nearest[max(0, min(len(nearest) - 1, index))]
+    team, _strength = random.choice(pool["tiers"][tier])
+    return {**team, "field": list(team["field"]), "name": random.choice(BOT_TEAM_NAMES)}
+
+HIT_EVENTS = [
+    "🖥 {player} ({team}) бросает в упор... НЕ РЕГНУЛО! Сервер не засчитал бросок!",
+    "🌀 ФЛИНГ! Шайбу от {player} ({team}) отменяют после видеопросмотра — аномальная физика!",
+    "📶 Лаг-гол от {player} ({team})? Судья идёт смотреть повтор... взятие ворот ОТМЕНЕНО!",
+    "🧤 ЛАГ-СЕЙВ! Шайба телепортируется прямо в ловушку {gk} — скамейка {team} в шоке!",
+    "💥 {player} ({team}) впечатывает соперника в борт — хит зарегистрирован сервером!",
     "🥊 {player} ({team}) получает 2 минуты за неспортивное поведение в чате!",
     "⚠️ У {player} ({team}) скакнул пинг до 900 — техническое предупреждение от судьи!",
     "🪑 {player} ({team}) ловит АФК посреди атаки — стопроцентный момент упущен!",
@@ -7114,97 +8007,11 @@ def _generate_period_events(team_a: dict, team_b: dict, card_map: dict, name_a:
 
 FIND_MATCH_COOLDOWN = 30  # секунд между запусками поиска (антиспам)
 FIND_MATCH_TIMEOUT = 90   # секунд до отмены поиска
-
-async def _search_timeout_cancel(context: ContextTypes.DEFAULT_TYPE, user_id: int, wait_seconds: int = FIND_MATCH_TIMEOUT):
-    """Если за отведённое время соперник того же ранга не найден — поиск отменяется."""
-    await asyncio.sleep(wait_seconds)
-    queue = context.bot_data.setdefault("rating_queue", [])
-    entry = next((q for q in queue if q["user_id"] == user_id), None)
-    if not entry:
-        return  # уже нашли соперника
-    queue.remove(entry)
-    try:
-        await context.bot.send_message(
-            user_id,
-            "😔 <b>Поиск отменён.</b>\n\n"
-            "За 90 секунд не нашлось соперника вашего ранга.\n"
-            "Попробуйте позже — возможно, игроки вашего уровня сейчас офлайн: /find_match",
-            parse_mode="HTML",
-        )
-    except Exception:
-        pass
-
-async def find_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if is_banned(user.id):
-        await update.message.reply_text("❌ Вы заблокированы в этом боте.")
-        return
-    if not await is_subscribed(user.id, context):
-        await update.message.reply_text(subscription_required_text())
-        return
-    if not get_rating_team(user.id):
-        await update.message.reply_text("❌ У вас нет состава. Сначала используйте /rating_team.")
-        return
-    ok_team, team_reason = validate_rating_team(user.id)
-    if not ok_team:
-        await update.message.reply_text(f"❌ Ваш состав устарел: {team_reason}. Пересоберите его через /rating_team.")
-        return
-    inj = team_injury(user.id)
-    if inj:
-        left=int((inj.get('until',0)-time.time())//60)+1
-        await update.message.reply_text(f"🏥 Карта в составе травмирована: {inj.get('name','карта')}. Осталось {left} мин.")
-        return
-
-    queue = context.bot_data.setdefault("rating_queue", [])
-    active_matches = context.bot_data.setdefault("active_matches", set())
-
-    # Блок: уже идёт матч
-    if user.id in active_matches:
-        await update.message.reply_text("⚽ У вас уже идёт матч! Дождитесь его окончания, затем ищите снова.")
-        return
-
-    # Антиспам №1: уже в поиске — повторный запуск запрещён
-    if any(q["user_id"] == user.id for q in queue):
-        await update.message.reply_text("⏳ Вы уже ищете соперника. Дождитесь результата поиска.")
-        return
-
-    # Антиспам №2: кулдаун между запусками поиска
-    cooldowns = context.bot_data.setdefault("find_match_cooldowns", {})
-    now = time.time()
-    elapsed = now - cooldowns.get(user.id, 0)
-    if elapsed < FIND_MATCH_COOLDOWN:
-        wait_left = int(FIND_MATCH_COOLDOWN - elapsed) + 1
-        await update.message.reply_text(f"🕒 Не так быстро! Повторный поиск будет доступен через {wait_left} сек.")
-        return
-    cooldowns[user.id] = now
-
-    my_elo = get_rating_elo(user.id)
-    my_rank, rank_emoji, rank_name = get_rating_rank(my_elo)
-
-    # Подбираем соперника ТОЛЬКО своего ранга
-    opponent_entry = next((q for q in queue if q.get("rank") == my_rank), None)
-    if opponent_entry:
-        queue.remove(opponent_entry)
-        await update.message.reply_text(f"⚔️ Соперник найден! Ранг: {rank_emoji} {rank_name}. Матч начинается прямо сейчас...")
-        try:
-            await context.bot.send_message(opponent_entry["user_id"], f"⚔️ Соперник найден! Ранг: {rank_emoji} {rank_name}. Матч начинается прямо сейчас...")
-        except Exception:
-            pass
-        # Определяем чат для результата: если оба игрока вызывали из одного чата — используем его
-        curr_chat = update.effective_chat.id if update.effective_chat and update.effective_chat.id != user.id else None
-        opp_chat  = opponent_entry.get("chat_id")
-        result_chat = curr_chat if curr_chat == opp_chat and curr_chat else (curr_chat or opp_chat)
-        asyncio.create_task(_simulate_match(context, user.id, opponent_entry["user_id"], result_chat_id=result_chat))
-    else:
-        chat_id_of_call = update.effective_chat.id if update.effective_chat and update.effective_chat.id != user.id else None
-        queue.append({"user_id": user.id, "joined": now, "rank": my_rank, "chat_id": chat_id_of_call})
-        await update.message.reply_text(
-            f"🔍 Ищем соперника вашего ранга: {rank_emoji} <b>{rank_name}</b> (рейтинг {my_elo})...\n\n"
-            "⚖️ Подбираются только игроки того же ранга.\n"
-            "⏳ Если за 90 секунд никто не найдётся — поиск отменится.",
-            parse_mode="HTML",
-        )
-        asyncio.create_task(_search_timeout_cancel(context, user.id, FIND_MATCH_TIMEOUT))
+# Живое табло матча: одно сообщение на игрока, которое дополняется правками
+# вместо нового сообщения на каждый период. False — старый режим «сообщение на период».
+MATCH_LIVE_FEED = True
+MATCH_LIVE_EDIT_INTERVAL = 1.1  # секунд между правками одного чата (лимит Telegram на edit)
+MATCH_LIVE_FEED_MAX_LEN = 3900  # запас до лимита 4096 символов на сообщение
 
 # ============================ КОМАНДА /id ============================
 async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -7284,6 +8091,122 @@ def _duel_power(user_id: int):
     labels = [html.escape(c['name']) for c in top]
     return power, labels
 
+
+# Открытые вызовы живут в DuelRegistry: словарь по id и куча сроков для уборки
+# просроченных фоновым воркером (без перебора на каждое нажатие). Ставка автора
+# списывается сразу при вызове и лежит «в банке» дуэли: отмена и истечение её
+# возвращают, принятие списывает ставку соперника и разыгрывает банк. Реестр
+# сохраняется вместе с состоянием матчмейкинга (MATCH_STATE_FILE) сразу после
+# каждого изменения, поэтому удержанные ставки переживают перезапуск.
+DUEL_MAX_OPEN_PER_USER = 3
+DUEL_SWEEP_INTERVAL = 5
+
+
+class DuelRegistry:
+    """Открытые дуэли: {id: дуэль} + куча (истекает, id) с ленивым удалением."""
+
+    def __init__(self):
+        self.duels = {}
+        self._expiry = []
+        self._open_by_user = Counter()
+
+    def __len__(self):
+        return len(self.duels)
+
+    def get(self, duel_id: str):
+        return self.duels.get(duel_id)
+
+    def open_count(self, user_id: int) -> int:
+        return self._open_by_user[user_id]
+
+    def add(self, duel: dict, duel_id: str | None = None) -> str:
+        if duel_id is None:
+            duel_id = str(int(time.time() * 1000))
+            while duel_id in self.duels:
+                duel_id = str(int(duel_id) + 1)
+        self.duels[duel_id] = duel
+        self._open_by_user[duel["challenger"]] += 1
+        heapq.heappush(self._expiry, (duel["expires"], duel_id))
+        # Куча чистится лениво; если в ней накопились снятые дуэли — пересобираем
+        if len(self._expiry) > 2 * len(self.duels) + 64:
+            self._expiry = [(d["expires"], did) for did, d in self.duels.items()]
+            heapq.heapify(self._expiry)
+        return duel_id
+
+    def remove(self, duel_id: str):
+        duel = self.duels.pop(duel_id, None)
+        if duel is not None:
+            self._open_by_user[duel["challenger"]] -= 1
+            if self._open_by_user[duel["challenger"]] <= 0:
+                del self._open_by_user[duel["challenger"]]
+        return duel
+
+    def pop_expired(self, now: float) -> list:
+        """Снимает и возвращает [(id, дуэль)] с истёкшим сроком."""
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, duel_id = heapq.heappop(self._expiry)
+            duel = self.duels.get(duel_id)
+            if duel is not None and duel["expires"] == expires:
+                expired.append((duel_id, self.remove(duel_id)))
+        return expired
+
+
+def _duel_registry(bot_data: dict) -> DuelRegistry:
+    registry = bot_data.get("duel_registry")
+    if registry is None:
+        registry = bot_data["duel_registry"] = DuelRegistry()
+    return registry
+
+
+def _escrow_take(user_id: int, amount: int) -> bool:
+    """Проверка баланса и списание одной записью coins.json (без await между ними)."""
+    coins_data = load_data(COINS_FILE, {})
+    current = coins_data.get(str(user_id), 0)
+    if current < amount:
+        return False
+    coins_data[str(user_id)] = current - amount
+    save_data(COINS_FILE, coins_data)
+    return True
+
+
+def _duel_state_changed(bot_data: dict) -> None:
+    try:
+        _flush_match_state(bot_data)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить реестр дуэлей: {e}")
+
+
+async def _duel_expiry_worker(application: Application) -> None:
+    """Убирает истёкшие вызовы: возвращает удержанные ставки одной записью и правит сообщения."""
+    context = CallbackContext(application)
+    while True:
+        try:
+            await asyncio.sleep(DUEL_SWEEP_INTERVAL)
+            expired = _duel_registry(application.bot_data).pop_expired(time.time())
+            if not expired:
+                continue
+            refunds = Counter()
+            for _, duel in expired:
+                refunds[duel["challenger"]] += duel["bet"]
+            update_coins_bulk(dict(refunds))
+            _duel_state_changed(application.bot_data)
+            for _, duel in expired:
+                if not duel.get("message_id"):
+                    continue
+                try:
+                    await context.bot.edit_message_text(
+                        "⌛ Дуэль истекла - никто не принял вызов. Ставка возвращена автору.",
+                        chat_id=duel["chat_id"], message_id=duel["message_id"],
+                    )
+                except Exception:
+                    pass
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("Ошибка уборки истёкших дуэлей")
+
+
 async def duel_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if is_banned(user.id):
@@ -7299,8 +8222,9 @@ async def duel_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             f"💰 Ставка: от {DUEL_MIN_BET} до {DUEL_MAX_BET} монет. Комиссия с банка: {int(DUEL_COMMISSION * 100)}%."
         )
         return
-    mode = context.args[1].lower() if len(context.args)>1 else "random"
-    if mode not in ("random","bestof3","coin"): mode="random"
+    mode = context.args[1].lower() if len(context.args) > 1 else "random"
+    if mode not in ("random", "bestof3", "coin"):
+        mode = "random"
     try:
         bet = int(context.args[0])
     except ValueError:
@@ -7309,55 +8233,75 @@ async def duel_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if bet < DUEL_MIN_BET or bet > DUEL_MAX_BET:
         await update.message.reply_text(f"❌ Ставка должна быть от {DUEL_MIN_BET} до {DUEL_MAX_BET} монет.")
         return
-    if get_coins(user.id) < bet:
-        await update.message.reply_text(f"❌ Недостаточно монет. У вас: {_fmt_coins(get_coins(user.id))}.")
+    registry = _duel_registry(context.bot_data)
+    if registry.open_count(user.id) >= DUEL_MAX_OPEN_PER_USER:
+        await update.message.reply_text(f"❌ У вас уже {DUEL_MAX_OPEN_PER_USER} открытых вызова. Дождитесь ответа или отмените один.")
         return
     power, _labels = _duel_power(user.id)
     if power <= 0:
         await update.message.reply_text("❌ У вас нет карточек для дуэли. Сначала получите карточки.")
         return
+    if not _escrow_take(user.id, bet):
+        await update.message.reply_text(f"❌ Недостаточно монет. У вас: {_fmt_coins(get_coins(user.id))}.")
+        return
 
-    duels = context.bot_data.setdefault("duels", {})
-    duel_id = str(int(time.time() * 1000))
-    duels[duel_id] = {
+    now = time.time()
+    duel_id = registry.add({
         "challenger": user.id,
         "challenger_name": user.first_name or f"Игрок {user.id}",
         "bet": bet,
         "mode": mode,
-        "created": time.time(),
-    }
+        "created": now,
+        "expires": now + DUEL_EXPIRE_SECONDS,
+        "escrow": True,
+        "chat_id": None,
+        "message_id": None,
+    })
+    _duel_state_changed(context.bot_data)
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("⚔️ Принять дуэль", callback_data=f"duel_accept_{duel_id}")],
         [InlineKeyboardButton("❌ Отменить", callback_data=f"duel_cancel_{duel_id}")],
     ])
-    await update.message.reply_text(
-        f"⚔️ <b>{html.escape(user.first_name or 'Игрок')} бросает вызов на дуэль на монеты!</b>\n\n"
-        f"💰 Ставка: <b>{_fmt_coins(bet)}</b> монет с каждого\n"
-        f"🎲 Победитель определяется честным рандомом 50/50\n"
-        f"🏆 Победитель забирает банк (комиссия {int(DUEL_COMMISSION * 100)}%)\n\n"
-        f"⏳ Вызов действует {DUEL_EXPIRE_SECONDS // 60} минут.",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
+    try:
+        msg = await update.message.reply_text(
+            f"⚔️ <b>{html.escape(user.first_name or 'Игрок')} бросает вызов на дуэль на монеты!</b>\n\n"
+            f"💰 Ставка: <b>{_fmt_coins(bet)}</b> монет с каждого (ставка автора уже в банке)\n"
+            f"🎲 Победитель определяется честным рандомом 50/50\n"
+            f"🏆 Победитель забирает банк (комиссия {int(DUEL_COMMISSION * 100)}%)\n\n"
+            f"⏳ Вызов действует {DUEL_EXPIRE_SECONDS // 60} минут, потом ставка вернётся.",
+            parse_mode="HTML",
+            reply_markup=keyboard
+        )
+    except Exception:
+        if registry.remove(duel_id):
+            update_coins(user.id, bet)
+            _duel_state_changed(context.bot_data)
+        raise
+    duel = registry.get(duel_id)
+    if duel is not None:
+        duel["chat_id"], duel["message_id"] = msg.chat_id, msg.message_id
 
-async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+async def _duel_callback_registry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     data = query.data
-    duels = context.bot_data.setdefault("duels", {})
+    registry = _duel_registry(context.bot_data)
 
     if data.startswith("duel_cancel_"):
         duel_id = data[len("duel_cancel_"):]
-        duel = duels.get(duel_id)
+        duel = registry.get(duel_id)
         if not duel:
             await query.answer("Дуэль уже неактуальна.", show_alert=True)
             return
         if query.from_user.id != duel["challenger"]:
             await query.answer("Отменить вызов может только его автор.", show_alert=True)
             return
-        duels.pop(duel_id, None)
+        registry.remove(duel_id)
+        update_coins(duel["challenger"], duel["bet"])
+        _duel_state_changed(context.bot_data)
         await query.answer()
         try:
-            await query.edit_message_text("❌ Дуэль отменена.")
+            await query.edit_message_text("❌ Дуэль отменена. Ставка возвращена.")
         except Exception:
             pass
         return
@@ -7367,93 +8311,100 @@ async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     duel_id = data[len("duel_accept_"):]
-    duel = duels.get(duel_id)
+    duel = registry.get(duel_id)
     if not duel:
         await query.answer("Дуэль уже неактуальна.", show_alert=True)
         return
     acceptor = query.from_user
     challenger_id = duel["challenger"]
     bet = duel["bet"]
-    mode = duel.get("mode","random")
     if acceptor.id == challenger_id:
         await query.answer("Нельзя принять собственный вызов.", show_alert=True)
         return
     if is_banned(acceptor.id):
         await query.answer("Вы заблокированы в этом боте.", show_alert=True)
         return
-    if time.time() - duel["created"] > DUEL_EXPIRE_SECONDS:
-        duels.pop(duel_id, None)
+    if time.time() >= duel["expires"]:
+        # Истёкший вызов уберёт воркер (он же вернёт ставку); здесь только сообщаем
         await query.answer("Вызов истёк.", show_alert=True)
-        try:
-            await query.edit_message_text("⌛ Дуэль истекла - никто не принял вызов.")
-        except Exception:
-            pass
-        return
-    if get_coins(acceptor.id) < bet:
-        await query.answer(f"Недостаточно монет: нужно {bet}.", show_alert=True)
-        return
-    if get_coins(challenger_id) < bet:
-        duels.pop(duel_id, None)
-        await query.answer("У автора вызова уже не хватает монет - дуэль отменена.", show_alert=True)
-        try:
-            await query.edit_message_text("❌ Дуэль отменена: у автора вызова не хватает монет.")
-        except Exception:
-            pass
         return
-    power_b, cards_b = _duel_power(acceptor.id)
+    power_b, _cards_b = _duel_power(acceptor.id)
     if power_b <= 0:
         await query.answer("У вас нет карточек для дуэли.", show_alert=True)
         return
+    # Списание ставки соперника и снятие вызова — без await между ними (защита от двойного клика)
+    if not _escrow_take(acceptor.id, bet):
+        await query.answer(f"Недостаточно монет: нужно {bet}.", show_alert=True)
+        return
+    registry.remove(duel_id)
 
-    # Снимаем дуэль из списка до расчётов (защита от двойного клика)
-    duels.pop(duel_id, None)
-    await query.answer()
-
-    power_a, cards_a = _duel_power(challenger_id)
-    update_coins(challenger_id, -bet)
-    update_coins(acceptor.id, -bet)
-
-    name_a = html.escape(duel.get("challenger_name") or f"Игрок {challenger_id}")
-    name_b = html.escape(acceptor.first_name or f"Игрок {acceptor.id}")
-
-    try:
-        await query.edit_message_text(
-            f"⚔️ <b>{name_a} 🆚 {name_b}</b>\n\n⏳ Определяем победителя...",
-            parse_mode="HTML"
-        )
-    except Exception:
-        pass
-    await asyncio.sleep(2)
-
-    # Дуэль: строго 50/50, карточки не дают преимуществ
+    # Дуэль: строго 50/50, карточки не дают преимуществ. Победитель и выплата банка —
+    # до первого await: ставки уже сняты с реестра, и перезапуск после этой точки
+    # не должен их потерять. Пауза «Определяем победителя» — только для вида и идёт
+    # отдельной задачей, чтобы не держать экономическую полосу.
     challenger_wins = random.random() < 0.5
     winner_id = challenger_id if challenger_wins else acceptor.id
-    winner_name = name_a if challenger_wins else name_b
-
     pot = bet * 2
     commission = int(pot * DUEL_COMMISSION)
     win_amount = pot - commission
     update_coins(winner_id, win_amount)
+    _duel_state_changed(context.bot_data)
     # квесты и статистика дуэлей
+    quest_rewards = []
     try:
-        r1 = inc_stat(challenger_id, 'duel_played', 1)
-        r2 = inc_stat(acceptor.id, 'duel_played', 1)
-        r3 = inc_stat(winner_id, 'duel_wins', 1)
-        await _notify_quest_rewards(context, challenger_id, r1)
-        await _notify_quest_rewards(context, acceptor.id, r2)
-        await _notify_quest_rewards(context, winner_id, r3)
+        quest_rewards = [
+            (challenger_id, inc_stat(challenger_id, 'duel_played', 1)),
+            (acceptor.id, inc_stat(acceptor.id, 'duel_played', 1)),
+            (winner_id, inc_stat(winner_id, 'duel_wins', 1)),
+        ]
     except Exception as _qe:
         logger.warning(f'quest duel stat error: {_qe}')
+    await query.answer()
 
+    name_a = html.escape(duel.get("challenger_name") or f"Игрок {challenger_id}")
+    name_b = html.escape(acceptor.first_name or f"Игрок {acceptor.id}")
+    winner_name = name_a if challenger_wins else name_b
     result_text = (
         f"⚔️ <b>Дуэль: {name_a} 🆚 {name_b}</b>\n\n"
         f"🏆 <b>Победитель: {winner_name}!</b>\n"
         f"💰 Выигрыш: <b>{_fmt_coins(win_amount)}</b> монет (банк {_fmt_coins(pot)}, комиссия {_fmt_coins(commission)})"
     )
-    try:
-        await query.edit_message_text(result_text, parse_mode="HTML")
-    except Exception as e:
-        logger.error(f"Не удалось отправить результат дуэли: {e}")
+
+    async def _reveal():
+        try:
+            await query.edit_message_text(
+                f"⚔️ <b>{name_a} 🆚 {name_b}</b>\n\n⏳ Определяем победителя...",
+                parse_mode="HTML"
+            )
+        except Exception:
+            pass
+        await asyncio.sleep(2)
+        try:
+            for uid, rewards in quest_rewards:
+                await _notify_quest_rewards(context, uid, rewards)
+        except Exception as _qe:
+            logger.warning(f'quest duel stat error: {_qe}')
+        try:
+            await query.edit_message_text(result_text, parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"Не удалось отправить результат дуэли: {e}")
+
+    context.application.create_task(_reveal())
+
+
+async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user = query.from_user if query else None
+    if not user:
+        return await _duel_callback_registry(update, context)
+    async def _busy():
+        try:
+            await query.answer("Дуэль уже обрабатывается", show_alert=True)
+        except Exception:
+            pass
+    # Ключ блокировки — только игрок: повторные клики по той же дуэли отсекает реестр
+    await _run_locked_action(context, user.id, "duel_callback", lambda: _duel_callback_registry(update, context), "", on_busy=_busy)
+
 
 # ============================ СИСТЕМА КЛАНОВ ============================
 async def create_clan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -7907,6 +8858,191 @@ async def clans_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 
+# ============================ ПРИОРИТЕТНЫЕ ПОЛОСЫ ОБРАБОТКИ ============================
+# Апдейты раскладываются по «полосам» с отдельным бюджетом параллельности, чтобы
+# тяжёлые админские операции и поток сообщений бонусного чата не задерживали
+# игровые команды (/get_card, кнопки маркета и т.п.). Апдейты одного пользователя
+# по-прежнему обрабатываются строго по очереди — на этом держатся ConversationHandler'ы.
+# Полосы interactive и passive идут параллельно (между разными игроками): их
+# обработчики меняют файлы через синхронные load_data → save_data без await между
+# ними (update_coins, _save_chat_activity и т.п.), поэтому event loop их не перемешивает.
+# Экономика (монеты, маркет, ставки, обмены, дуэли, розыгрыши) читает и пишет общие
+# файлы через await, поэтому её бюджет — 1: такие апдейты по всему боту идут по одному,
+# как до появления полос. Обработчик, которому нужен такой же read-modify-write,
+# добавляется в списки экономической полосы. Админские массовые команды идут своей
+# полосой и не ждут экономику: рассылки из них уходят в start_bulk_job.
+UPDATE_LANES = {
+    "interactive": 24,  # игровые команды и кнопки
+    "economy": 1,       # покупки, ставки, казино, дуэли, обмены — строго по одному
+    "admin_bulk": 2,    # рассылки, подведение итогов, завершение сезона
+    "passive": 4,       # сообщения бонусного чата, опросы
+}
+UPDATE_LANE_ECONOMY_COMMANDS = {
+    "buy", "sell", "offer_sell", "unlist", "market", "casino", "coin", "slots",
+    "duel", "bet", "trade", "daily", "work", "upgrade_card", "buy_cosmetic", "redeem",
+}
+UPDATE_LANE_ADMIN_BULK_COMMANDS = {
+    "admin_broadcast", "end_season", "finish_match", "giveaways", "start_season", "update",
+}
+UPDATE_LANE_ECONOMY_CALLBACKS = ("market_buy_", "duel_", "trade_", "bet_", "gw_join_")
+UPDATE_LANE_WAIT_WARN = 2.0  # секунд ожидания в очереди полосы, после которых пишем предупреждение
+UPDATE_LANE_STATS_WINDOW = 500
+
+
+def _update_lane(update) -> str:
+    """Определяет полосу для апдейта по типу, команде и чату."""
+    if not isinstance(update, Update):
+        return "interactive"
+    if update.poll or update.poll_answer:
+        return "passive"
+    query = update.callback_query
+    if query is not None:
+        return "economy" if str(query.data or "").startswith(UPDATE_LANE_ECONOMY_CALLBACKS) else "interactive"
+    msg = update.effective_message
+    text = (msg.text or msg.caption or "") if msg else ""
+    if text.startswith("/"):
+        command = text[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(text) > 1 else ""
+        if command in UPDATE_LANE_ADMIN_BULK_COMMANDS:
+            return "admin_bulk"
+        if command in UPDATE_LANE_ECONOMY_COMMANDS:
+            return "economy"
+        return "interactive"
+    if update.effective_chat and update.effective_chat.id == BONUS_CHAT_ID:
+        return "passive"
+    return "interactive"
+
+
+class PriorityLaneProcessor(BaseUpdateProcessor):
+    """Обработчик апдейтов с полосами приоритета и статистикой ожидания по каждой полосе."""
+
+    def __init__(self, lanes: dict | None = None):
+        self.lanes = dict(lanes or UPDATE_LANES)
+        # Общий лимит PTB делаем заведомо больше суммы полос: реально ограничивают полосы,
+        # а ждущий в «пассивной» полосе апдейт не должен занимать общий слот игровых команд.
+        super().__init__(max_concurrent_updates=max(256, sum(self.lanes.values()) * 8))
+        self._semaphores = {name: asyncio.Semaphore(max(1, limit)) for name, limit in self.lanes.items()}
+        self._user_locks = {}
+        self.stats = {
+            name: {"processed": 0, "waiting": 0, "running": 0, "wait_max": 0.0, "recent": deque(maxlen=UPDATE_LANE_STATS_WINDOW)}
+            for name in self.lanes
+        }
+
+    def _user_lock(self, user_id):
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry
+
+    def _release_user_lock(self, user_id):
+        entry = self._user_locks.get(user_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                self._user_locks.pop(user_id, None)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        lane = _update_lane(update)
+        if lane not in self._semaphores:
+            lane = "interactive"
+        stats = self.stats[lane]
+        user = update.effective_user if isinstance(update, Update) else None
+        user_id = user.id if user else None
+        queued_at = time.monotonic()
+        stats["waiting"] += 1
+        started = False
+        entry = self._user_lock(user_id) if user_id is not None else None
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self._semaphores[lane]:
+                    waited = time.monotonic() - queued_at
+                    started = True
+                    stats["waiting"] -= 1
+                    stats["running"] += 1
+                    stats["recent"].append(waited)
+                    stats["wait_max"] = max(stats["wait_max"], waited)
+                    if waited >= UPDATE_LANE_WAIT_WARN:
+                        logger.warning(f"Полоса {lane}: апдейт ждал в очереди {waited:.2f} сек.")
+                    try:
+                        await coroutine
+                    finally:
+                        stats["running"] -= 1
+                        stats["processed"] += 1
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if not started:
+                stats["waiting"] -= 1
+            if user_id is not None:
+                self._release_user_lock(user_id)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def lane_report(self) -> list:
+        """Строки (полоса, лимит, в работе, в очереди, обработано, среднее/p95/макс ожидание)."""
+        rows = []
+        for name, limit in self.lanes.items():
+            st = self.stats[name]
+            recent = sorted(st["recent"])
+            avg = sum(recent) / len(recent) if recent else 0.0
+            p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+            rows.append((name, limit, st["running"], st["waiting"], st["processed"], avg, p95, st["wait_max"]))
+        return rows
+
+
+# Фоновые массовые задачи (рассылки, уведомления по ставкам) не держат обработчик
+# и выполняются не больше чем по UPDATE_LANES["admin_bulk"] одновременно.
+_BULK_JOB_SEMAPHORE = asyncio.Semaphore(max(1, UPDATE_LANES["admin_bulk"]))
+
+
+def start_bulk_job(context: ContextTypes.DEFAULT_TYPE, label: str, coro_factory, report_chat_id=None):
+    """Запускает массовую операцию фоновой задачей. coro_factory() -> корутина, которая
+    возвращает текст итога (или None); итог отправляется в report_chat_id."""
+    async def _job():
+        queued_at = time.monotonic()
+        async with _BULK_JOB_SEMAPHORE:
+            waited = time.monotonic() - queued_at
+            started = time.monotonic()
+            try:
+                summary = await coro_factory()
+            except Exception as e:
+                logger.error(f"Фоновая задача «{label}» упала: {e}")
+                summary = f"❌ {label}: ошибка {e}"
+            logger.info(f"Фоновая задача «{label}»: ожидание {waited:.1f} сек, выполнение {time.monotonic() - started:.1f} сек")
+        if report_chat_id and summary:
+            try:
+                await context.bot.send_message(report_chat_id, summary)
+            except Exception:
+                pass
+    # application.create_task держит ссылку на задачу и дожидается её при остановке бота
+    return context.application.create_task(_job())
+
+
+async def lanes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ: загрузка полос обработки и время ожидания апдейтов в очереди."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    processor = context.bot_data.get("lane_processor")
+    if processor is None:
+        await update.message.reply_text("ℹ️ Полосы приоритета выключены (нужен python-telegram-bot ≥ 20.4).")
+        return
+    lines = ["🚦 <b>Полосы обработки апдейтов</b>\n"]
+    for name, limit, running, waiting, processed, avg, p95, wmax in processor.lane_report():
+        lines.append(
+            f"<b>{name}</b>: {running}/{limit} в работе, в очереди {waiting}, обработано {processed}\n"
+            f"   ⏱ ожидание: ср. {avg * 1000:.0f} мс • p95 {p95 * 1000:.0f} мс • макс {wmax * 1000:.0f} мс"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
 # ============================ MAIN ============================
 def main() -> None:
     os.makedirs(CARDS_IMAGE_DIR, exist_ok=True)
@@ -7958,7 +9094,12 @@ def main() -> None:
             save_data(RARITIES_FILE, default_rarities)
             logger.warning("Файл редкостей был пуст или не содержал выпадаемых – пересоздан.")
 
-    application = Application.builder().token(TOKEN).post_init(_post_init).build()
+    builder = Application.builder().token(TOKEN).post_init(_post_init).post_shutdown(_post_shutdown)
+    lane_processor = PriorityLaneProcessor() if UPDATE_LANES_AVAILABLE else None
+    if lane_processor is not None:
+        builder = builder.concurrent_updates(lane_processor)
+    application = builder.build()
+    application.bot_data["lane_processor"] = lane_processor
     application.add_error_handler(global_error_handler)
 
     # Периодическая фоновая задача запускается через post_init, не зависит от наличия JobQueue
@@ -8108,6 +9249,12 @@ def main() -> None:
     application.add_handler(CommandHandler("ref", referral_info))
     application.add_handler(CommandHandler("upgrade_card", upgrade_card))
     application.add_handler(CommandHandler("find_match", find_match))
+    application.add_handler(CommandHandler("match_replay", match_replay_cmd))
+    application.add_handler(CommandHandler("tournament", tournament_cmd))
+    application.add_handler(CommandHandler("tournament_join", tournament_join_cmd))
+    application.add_handler(CommandHandler("tournament_new", tournament_new_cmd))
+    application.add_handler(CommandHandler("tournament_start", tournament_start_cmd))
+    application.add_handler(CommandHandler("tournament_cancel", tournament_cancel_cmd))
     application.add_handler(CommandHandler("id", id_command))
     application.add_handler(CommandHandler("duel", duel_start))
     application.add_handler(CommandHandler("cancel_trade", cancel_trade))
@@ -8131,6 +9278,9 @@ def main() -> None:
     application.add_handler(CommandHandler("reply_report", reply_report_cmd))
     application.add_handler(CommandHandler("admin", admin_commands_list))
     application.add_handler(CommandHandler("giveaways", giveaways_list))
+    application.add_handler(CommandHandler("lanes", lanes_cmd))
+    application.add_handler(CommandHandler("bench_render", bench_render_cmd))
+    application.add_handler(CommandHandler("bench_encode", bench_encode_cmd))
 
     # CallbackQueryHandler'ы
     application.add_handler(CallbackQueryHandler(admin_shop_type, pattern=r"^(reset|pack)"))
@@ -8142,6 +9292,7 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(trade_callbacks, pattern=r"^trade_"))
     application.add_handler(CallbackQueryHandler(market_buy_callback, pattern=r"^market_buy_"))
     application.add_handler(CallbackQueryHandler(market_page_callback, pattern=r"^market_page_"))
+    application.add_handler(CallbackQueryHandler(my_cards_page_callback, pattern=r"^mycards_"))
     application.add_handler(CallbackQueryHandler(events_callbacks, pattern=r"^evt_"))
     application.add_handler(CallbackQueryHandler(giveaway_join_callback, pattern=r"^gw_join_"))
 
@@ -8363,6 +9514,7 @@ async def upgrade_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     # Уровень хранится отдельно в card_upgrades — размножение карт невозможно.
     for _ in range(cost): cards.remove(cid)
     data['cards']=cards; data.setdefault('card_upgrades',{})[str(cid)]=level+1; users[str(user.id)]=data; save_data(USERS_FILE,users)
+    refresh_team_snapshot(user.id, data.get('rating_team'))
     new_power=min(cap,base+(level+1)*2)
     await update.message.reply_text(
         f"⬆️ <b>{html.escape(card['name'])}</b> улучшена до уровня <b>{level + 1}</b>!\n"
@@ -8374,6 +9526,109 @@ async def upgrade_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 
+# Постер матча: общее «тело» (табло, периоды, MVP, голы, статистика) одинаково для
+# обоих игроков и для чата, отличается только полоса в зарезервированном месте: у
+# игрока — его ELO, в чате — итог матча. Тело рисуется один раз на матч и кладётся в
+# render_cache/matches по хэшу входных данных матча; картинка — копия тела + полоса.
+# Готовые картинки тоже адресуются по содержимому, так что повторная отправка ничего не рисует.
+MATCH_POSTER_VERSION = 2
+MATCH_POSTER_CACHE_DIR = os.path.join("render_cache", "matches")
+MATCH_POSTER_CACHE_TTL = 6 * 3600
+MATCH_POSTER_BODY_CACHE_LIMIT = 4
+MATCH_POSTER_ELO_Y = 800
+MATCH_POSTER_ELO_STEP = 155
+_MATCH_POSTER_BODIES = OrderedDict()
+_MATCH_POSTER_GC = {"last": 0.0}
+
+
+def _match_poster_digest(name_a, name_b, goals_a, goals_b, periods, scorers, coaches, stats) -> str:
+    key = [MATCH_POSTER_VERSION, name_a, name_b, goals_a, goals_b, periods, scorers, coaches, stats]
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()[:20]
+
+
+def _gc_match_posters() -> None:
+    """Раз в час удаляет из кэша постеров файлы старше MATCH_POSTER_CACHE_TTL."""
+    now = time.time()
+    if now - _MATCH_POSTER_GC["last"] < 3600 or not os.path.isdir(MATCH_POSTER_CACHE_DIR):
+        return
+    _MATCH_POSTER_GC["last"] = now
+    for fn in os.listdir(MATCH_POSTER_CACHE_DIR):
+        path = os.path.join(MATCH_POSTER_CACHE_DIR, fn)
+        try:
+            if now - os.path.getmtime(path) > MATCH_POSTER_CACHE_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_match_poster_file(path: str, data: bytes) -> None:
+    try:
+        os.makedirs(MATCH_POSTER_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f'match poster cache write error: {e}')
+
+
+def _match_poster_body(digest, name_a, name_b, goals_a, goals_b, periods, scorers, stats):
+    """Тело постера (RGB) из памяти процесса, с диска или свежий рендер. Не изменять."""
+    body = _MATCH_POSTER_BODIES.get(digest)
+    if body is not None:
+        _MATCH_POSTER_BODIES.move_to_end(digest)
+        return body
+    path = os.path.join(MATCH_POSTER_CACHE_DIR, f"body_{digest}.png")
+    try:
+        with Image.open(path) as cached:
+            body = cached.convert('RGB')
+    except (OSError, ValueError):
+        body = _render_match_poster_body(name_a, name_b, goals_a, goals_b, periods, scorers, stats)
+        out = io.BytesIO()
+        body.save(out, 'PNG', compress_level=1)
+        _write_match_poster_file(path, out.getvalue())
+    _MATCH_POSTER_BODIES[digest] = body
+    while len(_MATCH_POSTER_BODIES) > MATCH_POSTER_BODY_CACHE_LIMIT:
+        _MATCH_POSTER_BODIES.popitem(last=False)
+    return body
+
+
+def _draw_match_chat_strip(img, goals_a, goals_b, periods):
+    """Полоса итога для постера в чате — на месте, где у игроков полоса ELO."""
+    W = img.size[0]
+    y = MATCH_POSTER_ELO_Y
+    def F(sz): return _load_team_font(sz)
+    tail = [str(p).upper() for p in (periods or [])]
+    finish = 'ПО БУЛЛИТАМ' if 'БУЛ' in tail else ('В ОВЕРТАЙМЕ' if 'ОТ' in tail else 'В ОСНОВНОЕ ВРЕМЯ')
+    img=_hud_glass(img,95,y,W-95,y+125,radius=28,fill=(12,25,55,220),border=(80,135,245,220),glow=(0,160,255))
+    draw=ImageDraw.Draw(img)
+    def center(t,cx,yy,f,fill):
+        try: tw=draw.textlength(str(t),font=f)
+        except Exception: tw=len(str(t))*getattr(f,'size',24)*.55
+        draw.text((cx-tw/2,yy),str(t),font=f,fill=fill)
+    center(str(goals_a+goals_b),330,y+18,F(56),(255,255,255)); center('ШАЙБ ЗА МАТЧ',330,y+78,F(22),(165,180,210))
+    center('МАТЧ ЗАВЕРШЁН',1150,y+22,F(40),(255,205,70)); center(finish,1150,y+76,F(26),(165,180,210))
+    return img
+
+
+def _draw_match_elo_strip(img, elo_old, elo_new, won):
+    """Полоса ELO игрока поверх готового тела постера (место под неё зарезервировано)."""
+    W = img.size[0]
+    y = MATCH_POSTER_ELO_Y
+    def F(sz): return _load_team_font(sz)
+    delta=elo_new-elo_old; dtext=f'+{delta}' if delta>=0 else str(delta)
+    img=_hud_glass(img,95,y,W-95,y+125,radius=28,fill=(12,25,55,220),border=(80,210,130,230) if delta>=0 else (255,100,110,230),glow=(80,210,130) if delta>=0 else (255,80,90))
+    draw=ImageDraw.Draw(img)
+    def center(t,cx,yy,f,fill):
+        try: tw=draw.textlength(str(t),font=f)
+        except Exception: tw=len(str(t))*getattr(f,'size',24)*.55
+        draw.text((cx-tw/2,yy),str(t),font=f,fill=fill)
+    center(dtext,320,y+18,F(56),(95,235,130) if delta>=0 else (255,115,120)); center('ИЗМЕНЕНИЕ',320,y+78,F(22),(165,180,210))
+    center(str(elo_new),W//2,y+18,F(56),(255,255,255)); center('ELO',W//2,y+78,F(22),(165,180,210))
+    center('ПОБЕДА' if won else 'ПОРАЖЕНИЕ',1470,y+34,F(36),(255,205,70) if won else (255,115,120))
+    return img
+
+
 def build_match_result_image(name_a, name_b, goals_a, goals_b, periods,
                              scorers=None, coaches=None, stats=None,
                              elo_old=None, elo_new=None, won=None):
@@ -8381,8 +9636,29 @@ def build_match_result_image(name_a, name_b, goals_a, goals_b, periods,
     if not PIL_AVAILABLE:
         return None
     scorers=scorers or []; stats=stats or []
+    with_elo = elo_old is not None and elo_new is not None
+    digest = _match_poster_digest(name_a, name_b, goals_a, goals_b, periods, scorers, coaches, stats)
+    variant = f"elo_{int(elo_old)}_{int(elo_new)}_{int(bool(won))}" if with_elo else "chat"
+    out_sig = hashlib.sha1(json.dumps(_image_output("match_result"), sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    final_path = os.path.join(MATCH_POSTER_CACHE_DIR, f"match_{digest}_{variant}_{out_sig}.{_image_output_ext('match_result')}")
+    if os.path.exists(final_path):
+        with open(final_path, 'rb') as f:
+            return io.BytesIO(f.read())
+    _gc_match_posters()
+    body = _match_poster_body(digest, name_a, name_b, goals_a, goals_b, periods, scorers, stats)
+    if with_elo:
+        img = _draw_match_elo_strip(body.copy(), elo_old, elo_new, won)
+    else:
+        img = _draw_match_chat_strip(body.copy(), goals_a, goals_b, periods)
+    out = encode_image(img, "match_result")
+    _write_match_poster_file(final_path, out.getvalue())
+    return out
+
+
+def _render_match_poster_body(name_a, name_b, goals_a, goals_b, periods, scorers, stats):
+    """Всё, кроме полосы ELO/итога: под неё всегда оставляется место."""
     W,H=1800,2200
-    img=_arena_bg_2k(W,H).convert('RGB')
+    img=_arena_bg_2k(W,H)
     draw=ImageDraw.Draw(img)
     def F(sz): return _load_team_font(sz)
     def wtxt(t,f):
@@ -8419,15 +9695,8 @@ def build_match_result_image(name_a, name_b, goals_a, goals_b, periods,
     res='НИЧЬЯ' if goals_a==goals_b else f'ПОБЕДА • {win_name}'
     center(trim(res,fit(res,W-260,54,24),W-260),W//2,665,fit(res,W-260,54,24),(255,205,70))
 
-    y=800
-    if elo_old is not None and elo_new is not None:
-        delta=elo_new-elo_old; dtext=f'+{delta}' if delta>=0 else str(delta)
-        img=_hud_glass(img,95,y,W-95,y+125,radius=28,fill=(12,25,55,220),border=(80,210,130,230) if delta>=0 else (255,100,110,230),glow=(80,210,130) if delta>=0 else (255,80,90))
-        draw=ImageDraw.Draw(img)
-        center(dtext,320,y+18,F(56),(95,235,130) if delta>=0 else (255,115,120)); center('ИЗМЕНЕНИЕ',320,y+78,F(22),(165,180,210))
-        center(str(elo_new),W//2,y+18,F(56),(255,255,255)); center('ELO',W//2,y+78,F(22),(165,180,210))
-        center('ПОБЕДА' if won else 'ПОРАЖЕНИЕ',1470,y+34,F(36),(255,205,70) if won else (255,115,120))
-        y+=155
+    # полосу ELO или итога дорисует _draw_match_elo_strip/_draw_match_chat_strip поверх копии тела
+    y=MATCH_POSTER_ELO_Y+MATCH_POSTER_ELO_STEP
     period_line=[]; tags=['П1','П2','П3','ОТ','БУЛ']
     for i,p in enumerate(periods or []): period_line.append(str(p) if str(p).upper() in ('ОТ','БУЛ') else f'{tags[i] if i<len(tags) else "П"+str(i+1)} {p}')
     pl=' • '.join(period_line[:6]) or 'Периоды недоступны'
@@ -8463,29 +9732,25 @@ def build_match_result_image(name_a, name_b, goals_a, goals_b, periods,
             draw.rounded_rectangle((780-left,yy+38,780,yy+51),radius=7,fill=(78,210,255)); draw.rounded_rectangle((1020,yy+38,1020+right,yy+51),radius=7,fill=(255,112,126))
     img=_hud_glass(img,95,2070,W-95,2150,radius=24,fill=(12,25,55,220),border=(80,135,245,220),glow=(0,160,255)); draw=ImageDraw.Draw(img)
     center('Хоккейные карточки',W//2,2085,F(38),(255,205,70)); center('Every Card Matters',W//2,2125,F(22),(255,255,255))
-    out=io.BytesIO(); img.save(out,'PNG'); out.seek(0); return out
+    return img
 
 
-async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_b, result_chat_id=None):
-    """Симуляция рейтингового матча. Вместо «глухой заглушки» со счётом периода
-    игрокам отправляются важные события периода (голы с минутами, сэйвы, удаления).
-    Прокачка карт (/upgrade_card) учитывается в силе составов."""
-    # Помечаем игроков как занятых — нельзя начать второй матч
-    _active = context.bot_data.setdefault("active_matches", set())
-    _active.add(user_a)
-    if user_b:
-        _active.add(user_b)
-    try:
-     _sim_placeholder = None  # try-block открыт; finally снимет метку
-    except Exception:
-        pass
-    team_a = get_rating_team(user_a)
-    team_b = get_rating_team(user_b) if user_b else _generate_bot_team()
-    card_map = {c['id']: c for c in load_data(CARDS_FILE, [])}
-    sa = _team_strength(team_a, card_map, user_a)
-    sb = _team_strength(team_b, card_map, user_b)
-    ea = get_rating_elo(user_a)
-    eb = get_rating_elo(user_b) if user_b else DEFAULT_RATING_ELO
+# ============================ ДВИЖОК МАТЧА ============================
+# Модель исхода рейтингового матча без Telegram, файлов и пауз: на входе силы
+# составов, ELO и тактические модификаторы, на выходе счёт по периодам, события и
+# способ победы. _simulate_match рассказывает матч по этому результату, а
+# `python bot.py simulate ...` гоняет модель миллионами для проверки баланса.
+RATING_ELO_K = 24
+
+
+def simulate_match_core(sa: float, sb: float, ea: float, eb: float,
+                        mods_a=(0.0, 0.0), mods_b=(0.0, 0.0), rng=None, narrate: bool = True) -> dict:
+    """Разыгрывает матч. mods_x — (бонус к своему шансу забить, бонус к шансу соперника)
+    из _team_tactic_mods. narrate=False пропускает минуты и «прочие» события — для
+    массовой симуляции, на счёт это не влияет."""
+    rng = rng or random
+    atk_a, give_a = mods_a
+    atk_b, give_b = mods_b
     # РЕБАЛАНС: сила состава и ELO теперь чуть заметнее влияют на исход,
     # но апсеты всё ещё возможны. Рандом ослаблен, чтобы сильная команда
     # чаще подтверждала статус, а не выигрывала только из-за «формы дня».
@@ -8493,229 +9758,158 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
     # ELO оставлен как дополнительный фактор, а рандом уменьшен — апсеты возможны, но сильный состав чаще побеждает.
     strength_edge = (sa - sb) / 1000
     elo_edge = (ea - eb) / 3600
-    form = random.uniform(-0.025, 0.025)
+    form = rng.uniform(-0.025, 0.025)
     p_a = max(.28, min(.72, .50 + strength_edge + elo_edge + form))
-    # Тактики тренеров: (бонус к своему шансу забить, бонус к шансу соперника забить)
-    atk_a, give_a = _team_tactic_mods(team_a, card_map)
-    atk_b, give_b = _team_tactic_mods(team_b, card_map)
-    name_a_raw = _team_title(team_a, await _get_display_name(context, user_a))
-    name_b_raw = _team_title(team_b, await _get_display_name(context, user_b))
-    na, nb = html.escape(name_a_raw), html.escape(name_b_raw)
-    recipients = [user_a] + ([user_b] if user_b else [])
-
-    async def send(uid, text):
-        try:
-            await context.bot.send_message(uid, text, parse_mode='HTML')
-        except Exception:
-            pass
-
-    def raw_name(cid, owner_id=None):
-        return _team_ref_name(owner_id, cid, card_map, html_safe=False)
-
-    def _coach_info(team, plain=False):
-        """Строка «Тренер — тактика (бафф N%)». plain=True — без эмодзи (для картинки)."""
-        coach_id = (team or {}).get('coach')
-        if not coach_id:
-            return 'без тренера'
-        card = _team_ref_card(user_a if team is team_a else user_b, coach_id, card_map)
-        cname = _team_ref_name(user_a if team is team_a else user_b, coach_id, card_map, html_safe=False) if card else f'Тренер {coach_id}'
-        bonus = round(get_coach_bonus(card.get('rarity', '')) * 100) if card else 3
-        tactic = (team or {}).get('tactic', 'balanced')
-        if plain:
-            return f"{cname} ({TACTIC_PLAIN.get(tactic, 'Баланс')}, +{bonus}%)"
-        return f"{cname} - {TACTIC_LABELS.get(tactic, '⚖️ Сбалансировано')} (бафф {bonus}%)"
-
-    coach_a_text, coach_b_text = _coach_info(team_a), _coach_info(team_b)
-
-    # Короткое имя команды для текста событий (без @username части)
-    def _short_team(s: str) -> str:
-        return re.sub(r'\s*\(@[^)]*\)', '', s).strip()
-    short_na = html.escape(_short_team(name_a_raw))
-    short_nb = html.escape(_short_team(name_b_raw))
-
-    def _safe_power(owner_id, cid):
-        try:
-            if owner_id is not None:
-                return int(_team_ref_power(owner_id, cid, card_map))
-        except Exception:
-            pass
-        card = card_map.get(cid) or {}
-        return int(get_card_power(card)) if card else 0
-
-    def _lineup_text(team, owner_id):
-        if not team:
-            return 'Состав недоступен'
-        lines = []
-        gk_id = team.get('gk')
-        if gk_id:
-            lines.append(f"🥅 Вратарь: {_card_name(gk_id, card_map, owner_id)} - сила {_safe_power(owner_id, gk_id)}")
-        for fid in team.get('field', []):
-            lines.append(f"⚔️ Полевой игрок: {_card_name(fid, card_map, owner_id)} - сила {_safe_power(owner_id, fid)}")
-        coach_id = team.get('coach')
-        tactic = team.get('tactic', 'balanced')
-        if coach_id:
-            coach_card = _team_ref_card(owner_id, coach_id, card_map)
-            bonus = round(get_coach_bonus(coach_card.get('rarity', '')) * 100) if coach_card else 3
-            coach_name = _card_name(coach_id, card_map, owner_id)
-            lines.append(f"🧠 Тренер: {coach_name} - {TACTIC_PLAIN.get(tactic, 'Баланс')} (бафф {bonus}%)")
-        else:
-            lines.append("🧠 Тренер: без тренера")
-        return '\n'.join(lines)
+    ga = gb = 0
+    periods = []
+    # Малорезультативный хоккей: 0–2 гола на команду за период.
+    for period in range(1, 4):
+        # Камбек-механика: проигрывающая команда прибавляет (+5% к шансу
+        # гола за каждый гол отставания), поэтому забивший первым
+        # больше не выигрывает почти всегда — отыгрыши случаются регулярно.
+        comeback = max(-0.10, min(0.10, (gb - ga) * 0.05))
+        # Тактики тренеров: atk_x — свой бонус атаки, give_x — насколько команда «открывается» сопернику
+        pa = 1 if rng.random() < (.30 + (p_a - .5) * .30 + comeback + atk_a + give_b) else 0
+        pb = 1 if rng.random() < (.30 - (p_a - .5) * .30 - comeback + atk_b + give_a) else 0
+        if rng.random() < .10:
+            pa += 1
+        if rng.random() < .10:
+            pb += 1
+        events = []
+        if narrate:
+            extra = rng.randint(2, 3)  # важные события без гола (сэйвы, удаления, штанги)
+            minutes = sorted(rng.sample(range((period - 1) * 20 + 1, period * 20 + 1), pa + pb + extra))
+            kinds = ['goal_a'] * pa + ['goal_b'] * pb + ['other'] * extra
+            rng.shuffle(kinds)
+            for minute, kind in zip(minutes, kinds):
+                if kind == 'other':
+                    kind = 'other_a' if rng.random() < p_a else 'other_b'
+                events.append((minute, kind))
+        ga += pa
+        gb += pb
+        periods.append({'score': (pa, pb), 'events': events})
+    finish = finish_side = ot_minute = None
+    if ga == gb:
+        # В хоккее матч не заканчивается ничьей: сначала овертайм,
+        # а если в овертайме без гола — серия буллитов.
+        ot_pa = max(.44, min(.56, p_a))
+        if rng.random() < 0.58:
+            finish = 'ot'
+            ot_minute = 60 + rng.randint(1, 5)
+        else:
+            finish = 'so'
+        finish_side = 'a' if rng.random() < ot_pa else 'b'
+        if finish_side == 'a':
+            ga += 1
+        else:
+            gb += 1
+    return {'p_a': p_a, 'periods': periods, 'ga': ga, 'gb': gb,
+            'finish': finish, 'finish_side': finish_side, 'ot_minute': ot_minute}
 
-    lineup_a = _lineup_text(team_a, user_a)
-    lineup_b = _lineup_text(team_b, user_b)
 
-    for uid in recipients:
-        if uid == user_a:
-            opponent_name, opponent_lineup = nb, lineup_b
-            my_name, my_lineup = na, lineup_a
-        else:
-            opponent_name, opponent_lineup = na, lineup_a
-            my_name, my_lineup = nb, lineup_b
-        await send(
-            uid,
-            f'🏒 <b>Матч начался:</b> {na} 🆚 {nb}\n'
-            f'💪 Сила составов: {int(sa)} 🆚 {int(sb)}\n\n'
-            f'👀 <b>Состав соперника — {opponent_name}:</b>\n{opponent_lineup}\n\n'
-            f'🧊 <b>Ваш состав — {my_name}:</b>\n{my_lineup}\n\n'
-            f'🧠 <b>Тренеры:</b>\n▪️ {na}: {html.escape(coach_a_text)}\n▪️ {nb}: {html.escape(coach_b_text)}'
-        )
-    await asyncio.sleep(2.4)
+def rating_elo_update(ea: float, eb: float, a_won: bool, k: int = RATING_ELO_K):
+    """Новые ELO обеих сторон после матча."""
+    expected = 1 / (1 + 10 ** ((eb - ea) / 400))
+    score = 1.0 if a_won else 0.0
+    return round(ea + k * (score - expected)), round(eb + k * ((1 - score) - (1 - expected)))
 
+
+def _short_team_name(s: str) -> str:
+    """Имя команды без «(@username)» — для текста событий и картинки."""
+    return re.sub(r'\s*\(@[^)]*\)', '', s).strip()
+
+
+def _snapshot_coach_info(snap, plain=False):
+    """Строка «Тренер — тактика (бафф N%)». plain=True — без эмодзи (для картинки)."""
+    if not snap['coach']:
+        return 'без тренера'
+    cname, bonus, tactic = snap['coach']['name'], snap['coach_bonus'], snap['tactic']
+    if plain:
+        return f"{cname} ({TACTIC_PLAIN.get(tactic, 'Баланс')}, +{bonus}%)"
+    return f"{cname} - {TACTIC_LABELS.get(tactic, '⚖️ Сбалансировано')} (бафф {bonus}%)"
+
+
+def narrate_match(outcome: dict, snap_a: dict, snap_b: dict, name_a_raw: str, name_b_raw: str, rng) -> dict:
+    """Рассказ матча по исходу движка: строки событий по периодам, авторы голов,
+    счёт периодов и статистика. Случайность берётся только из rng, поэтому тот же
+    сид даёт тот же текст — на этом держится /match_replay."""
+    short_na = html.escape(_short_team_name(name_a_raw))
+    short_nb = html.escape(_short_team_name(name_b_raw))
+    label_a, label_b = name_a_raw.lstrip('@'), name_b_raw.lstrip('@')
     ga = gb = 0
-    period_scores = []
     scorers = []  # (минута, имя игрока, команда, счёт после гола) — без HTML-экранирования
 
-    def _goal_event(minute, side):
+    def goal(minute, side):
         """Оформляет гол: обновляет счёт, запоминает автора, возвращает строку события."""
         nonlocal ga, gb
-        att_team, def_team = (team_a, team_b) if side == 'a' else (team_b, team_a)
-        att_name = na if side == 'a' else nb
-        pid = _pick_field_player(att_team, card_map, user_a if side == 'a' else user_b)
+        att_snap, def_snap = (snap_a, snap_b) if side == 'a' else (snap_b, snap_a)
+        scorer = _snapshot_pick_field(att_snap, rng)
         if side == 'a':
             ga += 1
         else:
             gb += 1
-        scorers.append((minute, raw_name(pid, user_a if side == 'a' else user_b), (name_a_raw if side == 'a' else name_b_raw).lstrip('@'), f'{ga}:{gb}'))
-        _evt_team = short_na if side == 'a' else short_nb
-        text = random.choice(GOAL_EVENTS).format(team=_evt_team, player=_card_name(pid, card_map, user_a if side == 'a' else user_b), gk=_card_name(def_team['gk'], card_map, user_b if side == 'a' else user_a))
+        scorers.append((minute, scorer['name'], label_a if side == 'a' else label_b, f'{ga}:{gb}'))
+        text = rng.choice(GOAL_EVENTS).format(team=short_na if side == 'a' else short_nb,
+                                              player=scorer['name_html'], gk=def_snap['gk']['name_html'])
         return f"⏱ {minute:02d}' — {text} <b>{ga}:{gb}</b>"
 
-    # Малорезультативный хоккей: 0–2 гола на команду за период.
-    for period in range(1, 4):
-        # Камбек-механика: проигрывающая команда прибавляет (+5% к шансу
-        # гола за каждый гол отставания), поэтому забивший первым
-        # больше не выигрывает почти всегда — отыгрыши случаются регулярно.
-        comeback = max(-0.10, min(0.10, (gb - ga) * 0.05))
-        # Тактики тренеров: atk_x — свой бонус атаки, give_x — насколько команда «открывается» сопернику
-        pa = 1 if random.random() < (.30 + (p_a - .5) * .30 + comeback + atk_a + give_b) else 0
-        pb = 1 if random.random() < (.30 - (p_a - .5) * .30 - comeback + atk_b + give_a) else 0
-        if random.random() < .10:
-            pa += 1
-        if random.random() < .10:
-            pb += 1
-        extra = random.randint(2, 3)  # важные события без гола (сэйвы, удаления, штанги)
-        minutes = sorted(random.sample(range((period - 1) * 20 + 1, period * 20 + 1), pa + pb + extra))
-        kinds = ['goal_a'] * pa + ['goal_b'] * pb + ['other'] * extra
-        random.shuffle(kinds)
+    periods = []
+    period_scores = []
+    for period_result in outcome['periods']:
+        pa, pb = period_result['score']
         lines = []
-        for minute, kind in zip(minutes, kinds):
+        for minute, kind in period_result['events']:
             if kind == 'goal_a':
-                lines.append(_goal_event(minute, 'a'))
+                lines.append(goal(minute, 'a'))
             elif kind == 'goal_b':
-                lines.append(_goal_event(minute, 'b'))
+                lines.append(goal(minute, 'b'))
             else:
-                side = 'a' if random.random() < p_a else 'b'
-                att_team, def_team = (team_a, team_b) if side == 'a' else (team_b, team_a)
-                att_name = na if side == 'a' else nb
-                pool = HIT_EVENTS if random.random() < .75 else NEUTRAL_EVENTS
-                _evt_side_team = short_na if side == 'a' else short_nb
-                text = random.choice(pool).format(
-                    team=_evt_side_team,
-                    player=_card_name(_pick_field_player(att_team, card_map, user_a if side == 'a' else user_b), card_map),
-                    gk=_card_name(def_team['gk'], card_map),
+                side = kind[-1]
+                att_snap, def_snap = (snap_a, snap_b) if side == 'a' else (snap_b, snap_a)
+                pool = HIT_EVENTS if rng.random() < .75 else NEUTRAL_EVENTS
+                text = rng.choice(pool).format(
+                    team=short_na if side == 'a' else short_nb,
+                    player=_snapshot_pick_field(att_snap, rng)['name_html'],
+                    gk=def_snap['gk']['name_html'],
                 )
                 lines.append(f"⏱ {minute:02d}' — {text}")
         period_scores.append(f'{pa}:{pb}')
-        for uid in recipients:
-            await send(uid, f'🏒 <b>Период {period}</b>\n' + '\n'.join(lines) + f'\n\n📊 Счёт после периода: <b>{ga}:{gb}</b>')
-        await asyncio.sleep(3.0)
+        periods.append({'lines': lines, 'score': (ga, gb)})
 
+    finish = None
     finish_suffix = ''
-    if ga == gb:
-        # В хоккее матч не заканчивается ничьей: сначала овертайм,
-        # а если в овертайме без гола — серия буллитов.
+    if outcome['finish']:
         period_scores.append('ОТ')
-        ot_pa = max(.44, min(.56, p_a))
-        ot_goal = random.random() < 0.58
-        if ot_goal:
-            ot_minute = 60 + random.randint(1, 5)
-            line = _goal_event(ot_minute, 'a' if random.random() < ot_pa else 'b')
+        if outcome['finish'] == 'ot':
             finish_suffix = ' (ОТ)'
-            for uid in recipients:
-                await send(uid, f'🚨 <b>ОВЕРТАЙМ!</b>\n{line}')
-            await asyncio.sleep(1.4)
+            finish = {'text': f"🚨 <b>ОВЕРТАЙМ!</b>\n{goal(outcome['ot_minute'], outcome['finish_side'])}", 'pause': 1.4}
         else:
             finish_suffix = ' (БУЛ)'
             period_scores.append('БУЛ')
-            shootout_side = 'a' if random.random() < ot_pa else 'b'
-            shootout_player = _card_name(_pick_field_player(team_a if shootout_side == 'a' else team_b, card_map), card_map)
-            if shootout_side == 'a':
+            side = outcome['finish_side']
+            shooter = _snapshot_pick_field(snap_a if side == 'a' else snap_b, rng)
+            if side == 'a':
                 ga += 1
-                win_team = short_na
-                lose_gk = _card_name(team_b['gk'], card_map)
+                win_team, lose_gk = short_na, snap_b['gk']['name_html']
             else:
                 gb += 1
-                win_team = short_nb
-                lose_gk = _card_name(team_a['gk'], card_map)
-            scorers.append((65, shootout_player, (name_a_raw if shootout_side == 'a' else name_b_raw).lstrip('@'), f'{ga}:{gb}'))
-            shootout_text = f"🎯 <b>Серия буллитов!</b> {shootout_player} приносит победу команде {win_team}. Вратарь {lose_gk} не выручает. <b>{ga}:{gb}</b>"
-            for uid in recipients:
-                await send(uid, f'🥅 <b>ОВЕРТАЙМ БЕЗ ГОЛОВ.</b>\n{shootout_text}')
-            await asyncio.sleep(1.8)
+                win_team, lose_gk = short_nb, snap_a['gk']['name_html']
+            scorers.append((65, shooter['name'], label_a if side == 'a' else label_b, f'{ga}:{gb}'))
+            finish = {
+                'text': (f"🥅 <b>ОВЕРТАЙМ БЕЗ ГОЛОВ.</b>\n🎯 <b>Серия буллитов!</b> {shooter['name_html']} приносит "
+                         f"победу команде {win_team}. Вратарь {lose_gk} не выручает. <b>{ga}:{gb}</b>"),
+                'pause': 1.8,
+            }
+        finish['score'] = (ga, gb)
 
-    ea = get_rating_elo(user_a)
-    eb = get_rating_elo(user_b) if user_b else DEFAULT_RATING_ELO
-    expected = 1 / (1 + 10 ** ((eb - ea) / 400))
-    score = 1.0 if ga > gb else 0.0
-    newa = round(ea + 24 * (score - expected))
-    set_rating_elo(user_a, newa)
-    newb = None
-    if user_b:
-        newb = round(eb + 24 * ((1 - score) - (1 - expected)))
-        set_rating_elo(user_b, newb)
-    add_rating_result(user_a, 'win' if ga > gb else 'loss')
-    inc_stat(user_a,'rating_matches',1)
-    if ga>gb: inc_stat(user_a,'rating_wins',1)
-    if user_b:
-        add_rating_result(user_b, 'win' if gb > ga else 'loss')
-        inc_stat(user_b,'rating_matches',1)
-        if gb>ga: inc_stat(user_b,'rating_wins',1)
-    for _uid,_team in [(user_a,team_a),(user_b,team_b if user_b else None)]:
-        if _uid and _team and random.random()<0.08:
-            refs=[_team.get('gk')]+list(_team.get('field',[]))
-            ref=random.choice([r for r in refs if r])
-            name=_card_name(ref, card_map)
-            data=load_data(INJURIES_FILE,{}) ; arr=data.setdefault(str(_uid),[])
-            arr.append({'ref':ref,'name':name,'until':time.time()+random.randint(60,180)*60})
-            save_data(INJURIES_FILE,data); log_action(_uid,'injury',name)
-    # Контролируемая награда: только 35% шанс, меньше за победу над слабым составом.
-    winner = user_a if ga > gb else user_b
-    ws, ls = (sa, sb) if ga > gb else (sb, sa)
-    reward = 0
-    if winner and random.random() < .35:
-        reward = 6 if ws > ls + 35 else (12 if ws >= ls - 35 else 18)
-        update_coins(winner, reward)
-    goals_text = '\n'.join(
-        f"⏱ {m:02d}' — {html.escape(p)} ({html.escape(t)}) — {s}" for m, p, t, s in scorers
-    ) or '—'
     # Статистика «как в реальном хоккее»: время в атаке, броски, броски в створ, хиты, удаления.
-    sog_a, sog_b = ga + random.randint(14, 24), gb + random.randint(14, 24)
-    shots_a, shots_b = sog_a + random.randint(7, 15), sog_b + random.randint(7, 15)
-    hits_a, hits_b = random.randint(8, 24), random.randint(8, 24)
-    pim_a, pim_b = 2 * random.randint(0, 4), 2 * random.randint(0, 4)
-    atk_share = max(.35, min(.65, p_a + atk_a - atk_b + random.uniform(-.06, .06)))
-    atk_total = random.randint(1100, 1500)
+    atk_a, atk_b = snap_a['mods'][0], snap_b['mods'][0]
+    sog_a, sog_b = ga + rng.randint(14, 24), gb + rng.randint(14, 24)
+    shots_a, shots_b = sog_a + rng.randint(7, 15), sog_b + rng.randint(7, 15)
+    hits_a, hits_b = rng.randint(8, 24), rng.randint(8, 24)
+    pim_a, pim_b = 2 * rng.randint(0, 4), 2 * rng.randint(0, 4)
+    atk_share = max(.35, min(.65, outcome['p_a'] + atk_a - atk_b + rng.uniform(-.06, .06)))
+    atk_total = rng.randint(1100, 1500)
     atk_sec_a = int(atk_total * atk_share)
     atk_sec_b = atk_total - atk_sec_a
     stats_rows = [
@@ -8725,6 +9919,167 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
         ('Хиты', str(hits_a), str(hits_b)),
         ('Штрафные минуты', str(pim_a), str(pim_b)),
     ]
+    return {
+        'periods': periods,
+        'finish': finish,
+        'finish_suffix': finish_suffix,
+        'period_scores': period_scores,
+        'scorers': scorers,
+        'stats': stats_rows,
+        'ga': ga,
+        'gb': gb,
+    }
+
+
+async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_b, result_chat_id=None):
+    """Симуляция рейтингового матча. Вместо «глухой заглушки» со счётом периода
+    игрокам отправляются важные события периода (голы с минутами, сэйвы, удаления).
+    Прокачка карт (/upgrade_card) учитывается в силе составов."""
+    # Помечаем игроков как занятых — нельзя начать второй матч
+    _active = context.bot_data.setdefault("active_matches", set())
+    _active.add(user_a)
+    if user_b:
+        _active.add(user_b)
+    try:
+     _sim_placeholder = None  # try-block открыт; finally снимет метку
+    except Exception:
+        pass
+    team_a = get_rating_team(user_a)
+    card_map = {c['id']: c for c in load_data(CARDS_FILE, [])}
+    # Силы, тактики и имена карт — из снимков составов
+    snap_a = get_team_snapshot(user_a, team_a, card_map)
+    # Бот-соперник — из пула, ярус по силе состава игрока
+    team_b = get_rating_team(user_b) if user_b else pick_bot_team(snap_a['strength'])
+    snap_b = get_team_snapshot(user_b, team_b, card_map)
+    sa, sb = snap_a['strength'], snap_b['strength']
+    ea = get_rating_elo(user_a)
+    eb = get_rating_elo(user_b) if user_b else DEFAULT_RATING_ELO
+    # Тактики тренеров: (бонус к своему шансу забить, бонус к шансу соперника забить)
+    atk_a, give_a = snap_a['mods']
+    atk_b, give_b = snap_b['mods']
+    # Исход разыгрывается сразу целиком, дальше матч только «показывается» по событиям
+    # Свой сид у каждого матча: после перезапуска исход восстанавливается тем же
+    match_seed = random.getrandbits(48)
+    match_rng = random.Random(match_seed)
+    outcome = simulate_match_core(sa, sb, ea, eb, (atk_a, give_a), (atk_b, give_b), rng=match_rng)
+    outcome_ea, outcome_eb = ea, eb
+    name_a_raw = _team_title(team_a, await _get_display_name(context, user_a))
+    name_b_raw = _team_title(team_b, await _get_display_name(context, user_b))
+    match_id = _register_live_match(
+        context, user_a, user_b, match_seed, (sa, sb, ea, eb, snap_a['mods'], snap_b['mods']),
+        name_a_raw, name_b_raw, result_chat_id, snaps=(snap_a, snap_b),
+        teams=(team_a, team_b if user_b else None),
+    )
+    na, nb = html.escape(name_a_raw), html.escape(name_b_raw)
+    recipients = [user_a] + ([user_b] if user_b else [])
+
+    async def send(uid, text):
+        try:
+            await context.bot.send_message(uid, text, parse_mode='HTML')
+        except Exception:
+            pass
+
+    # Живое табло: uid -> {"message_id", "log", "edited_at"}
+    live_feed = {}
+
+    def _scoreboard():
+        return f'📺 <b>{na} {ga}:{gb} {nb}</b>'
+
+    async def feed(uid, block):
+        """Событие матча: в режиме живого табло дописывается в одно сообщение через
+        edit_message_text (не чаще MATCH_LIVE_EDIT_INTERVAL), иначе — новое сообщение.
+        Если правка не прошла, табло продолжается новым сообщением."""
+        if not MATCH_LIVE_FEED:
+            await send(uid, block)
+            return
+        state = live_feed.get(uid)
+        if state is None or len(state['log']) + len(block) + 120 > MATCH_LIVE_FEED_MAX_LEN:
+            try:
+                msg = await context.bot.send_message(uid, f'{_scoreboard()}\n\n{block}', parse_mode='HTML')
+                live_feed[uid] = {'message_id': msg.message_id, 'log': block, 'edited_at': time.monotonic()}
+            except Exception:
+                pass
+            return
+        wait = MATCH_LIVE_EDIT_INTERVAL - (time.monotonic() - state['edited_at'])
+        if wait > 0:
+            await asyncio.sleep(wait)
+        new_log = f"{state['log']}\n\n{block}"
+        try:
+            await context.bot.edit_message_text(
+                f'{_scoreboard()}\n\n{new_log}', chat_id=uid, message_id=state['message_id'], parse_mode='HTML'
+            )
+            state['log'] = new_log
+            state['edited_at'] = time.monotonic()
+        except Exception:
+            live_feed.pop(uid, None)
+            await feed(uid, block)
+
+    _coach_info = _snapshot_coach_info
+    coach_a_text, coach_b_text = _coach_info(snap_a), _coach_info(snap_b)
+    _short_team = _short_team_name
+
+    def _lineup_text(snap):
+        if not snap:
+            return 'Состав недоступен'
+        lines = []
+        if snap['gk']['ref']:
+            lines.append(f"🥅 Вратарь: {snap['gk']['name_html']} - сила {snap['gk']['power']}")
+        for slot in snap['field']:
+            lines.append(f"⚔️ Полевой игрок: {slot['name_html']} - сила {slot['power']}")
+        if snap['coach']:
+            lines.append(f"🧠 Тренер: {snap['coach']['name_html']} - {TACTIC_PLAIN.get(snap['tactic'], 'Баланс')} (бафф {snap['coach_bonus']}%)")
+        else:
+            lines.append("🧠 Тренер: без тренера")
+        return '\n'.join(lines)
+
+    lineup_a = _lineup_text(snap_a)
+    lineup_b = _lineup_text(snap_b)
+    ga = gb = 0
+
+    for uid in recipients:
+        if uid == user_a:
+            opponent_name, opponent_lineup = nb, lineup_b
+            my_name, my_lineup = na, lineup_a
+        else:
+            opponent_name, opponent_lineup = na, lineup_a
+            my_name, my_lineup = nb, lineup_b
+        await feed(
+            uid,
+            f'🏒 <b>Матч начался:</b> {na} 🆚 {nb}\n'
+            f'💪 Сила составов: {int(sa)} 🆚 {int(sb)}\n\n'
+            f'👀 <b>Состав соперника — {opponent_name}:</b>\n{opponent_lineup}\n\n'
+            f'🧊 <b>Ваш состав — {my_name}:</b>\n{my_lineup}\n\n'
+            f'🧠 <b>Тренеры:</b>\n▪️ {na}: {html.escape(coach_a_text)}\n▪️ {nb}: {html.escape(coach_b_text)}'
+        )
+    await asyncio.sleep(2.4)
+
+    # Текст событий, авторы голов и статистика — из того же сида, что и исход
+    story = narrate_match(outcome, snap_a, snap_b, name_a_raw, name_b_raw, match_rng)
+    for period, block in enumerate(story['periods'], 1):
+        ga, gb = block['score']
+        for uid in recipients:
+            await feed(uid, f'🏒 <b>Период {period}</b>\n' + '\n'.join(block['lines']) + f'\n\n📊 Счёт после периода: <b>{ga}:{gb}</b>')
+        await asyncio.sleep(3.0)
+
+    if story['finish']:
+        ga, gb = story['finish']['score']
+        for uid in recipients:
+            await feed(uid, story['finish']['text'])
+        await asyncio.sleep(story['finish']['pause'])
+    finish_suffix = story['finish_suffix']
+    period_scores = story['period_scores']
+    scorers = story['scorers']
+
+    # Весь расчёт итога — одной транзакцией по файлам
+    settlement = settle_rating_match(user_a, user_b, ga > gb, teams=(team_a, team_b if user_b else None),
+                                     strengths=(sa, sb), card_map=card_map)
+    _finish_live_match(context, match_id)
+    (ea, newa), (eb, newb) = settlement['elo']
+    winner, reward = settlement['winner'], settlement['reward']
+    goals_text = '\n'.join(
+        f"⏱ {m:02d}' — {html.escape(p)} ({html.escape(t)}) — {s}" for m, p, t, s in scorers
+    ) or '—'
+    stats_rows = story['stats']
     stats_text = '\n'.join(f'▫️ {label}: <b>{va}</b> — <b>{vb}</b>' for label, va, vb in stats_rows)
     ot_mark = finish_suffix
     # Подготавливаем общие данные для картинки
@@ -8732,9 +10087,26 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
     img_name_b = _short_team(name_b_raw) if team_b and team_b.get('name') else (name_b_raw.lstrip('@'))
     _img_kwargs = dict(
         scorers=scorers,
-        coaches=(_coach_info(team_a, plain=True), _coach_info(team_b, plain=True)),
+        coaches=(_coach_info(snap_a, plain=True), _coach_info(snap_b, plain=True)),
         stats=stats_rows,
     )
+    append_match_record({
+        "id": match_id,
+        "seed": match_seed,
+        "played_at": time.time(),
+        "a": user_a,
+        "b": user_b,
+        "names": [name_a_raw, name_b_raw],
+        "img_names": [img_name_a, img_name_b],
+        "snaps": [_compact_snapshot(snap_a), _compact_snapshot(snap_b)],
+        "engine": [sa, sb, outcome_ea, outcome_eb, list(snap_a['mods']), list(snap_b['mods'])],
+        "score": [ga, gb],
+        "finish": outcome['finish'],
+        "period_scores": period_scores,
+        "scorers": scorers,
+        "stats": stats_rows,
+        "elo": [[ea, newa], [eb, newb]],
+    })
     for uid, old, new, won in [(user_a, ea, newa, ga > gb)] + ([(user_b, eb, newb, gb > ga)] if user_b else []):
         delta = new - old
         delta_str = f'+{delta}' if delta >= 0 else str(delta)
@@ -8742,11 +10114,12 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
             f"{"🏆 ПОБЕДА!" if won else "😤 Поражение."} {na} <b>{ga}:{gb}</b>{ot_mark} {nb}\n"
             f"⭐ Рейтинг: {old} → <b>{new}</b> ({delta_str})"
             + (f'\n💰 Награда: +{reward}' if uid == winner and reward else '')
+            + f'\n🧾 Повтор матча: /match_replay {match_id}'
         )
         image = None
         try:
-            image = build_match_result_image(
-                img_name_a, img_name_b, ga, gb, period_scores,
+            image = await render_image(
+                "match_result", img_name_a, img_name_b, ga, gb, period_scores,
                 elo_old=old, elo_new=new, won=won,
                 **_img_kwargs,
             )
@@ -8762,6 +10135,8 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
                 await context.bot.send_message(uid, cap, parse_mode='HTML')
             except Exception:
                 pass
+    for uid, rewards in settlement['quest_rewards'].items():
+        await _notify_quest_rewards(context, uid, rewards)
 
     # Снимаем метку «в матче» — игроки снова могут искать
     _am = context.bot_data.setdefault("active_matches", set())
@@ -8772,8 +10147,8 @@ async def _simulate_match(context: ContextTypes.DEFAULT_TYPE, user_a: int, user_
     # Отправляем нейтральную картинку в чат (один раз, без ELO)
     if result_chat_id:
         try:
-            chat_img = build_match_result_image(
-                img_name_a, img_name_b, ga, gb, period_scores,
+            chat_img = await render_image(
+                "match_result", img_name_a, img_name_b, ga, gb, period_scores,
                 **_img_kwargs,
             )
             _winner_name = html.escape(img_name_a if ga > gb else img_name_b)
@@ -8802,13 +10177,141 @@ def _queue_result_chat_id(current_chat_id, opponent_chat_id):
     return curr_chat if curr_chat == opp_chat and curr_chat else (curr_chat or opp_chat)
 
 
+# ============================ ОЧЕРЕДЬ ПОДБОРА СОПЕРНИКОВ ============================
+# Ищущие хранятся в отсортированных по (elo, joined, user_id) списках: отдельный на каждый ранг
+# и общий для глобального поиска. Ближайший по рейтингу соперник находится бинарным поиском,
+# а сроки ожидания лежат в куче — один периодический тик вместо отдельной спящей задачи на игрока.
+MATCHMAKING_TICK_SECONDS = 1.0
+MATCHMAKING_ELO_WINDOW_START = 75    # допустимая разница рейтинга сразу после входа в поиск
+MATCHMAKING_ELO_WINDOW_GROWTH = 3.0  # +ELO к окну за каждую секунду ожидания
+
+
+def _matchmaking_elo_window(entry: dict, now: float) -> float:
+    """Окно допустимой разницы ELO: расширяется, пока игрок ждёт."""
+    waited = max(0.0, now - float(entry.get("joined", now)))
+    return MATCHMAKING_ELO_WINDOW_START + MATCHMAKING_ELO_WINDOW_GROWTH * waited
+
+
+class MatchmakingQueue:
+    """Очередь /find_match с индексами по рангу и ELO."""
+
+    def __init__(self):
+        self.entries = {}
+        self._by_rank = {}
+        self._global = []
+        self._deadlines = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries
+
+    @staticmethod
+    def _key(entry: dict):
+        return (entry["elo"], entry["joined"], entry["user_id"])
+
+    def _index(self, entry: dict) -> list:
+        if entry.get("scope") == "global":
+            return self._global
+        return self._by_rank.setdefault(entry["rank"], [])
+
+    def add(self, entry: dict) -> dict:
+        self.remove(entry["user_id"])
+        self.entries[entry["user_id"]] = entry
+        bisect.insort(self._index(entry), self._key(entry))
+        heapq.heappush(self._deadlines, (entry["deadline"], entry["user_id"]))
+        return entry
+
+    def remove(self, user_id: int):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return None
+        index = self._index(entry)
+        key = self._key(entry)
+        i = bisect.bisect_left(index, key)
+        if i < len(index) and index[i] == key:
+            del index[i]
+        return entry
+
+    def go_global(self, user_id: int, deadline: float):
+        """Переводит игрока из поиска по рангу в глобальный поиск."""
+        entry = self.remove(user_id)
+        if entry is None:
+            return None
+        entry["scope"] = "global"
+        entry["global_started"] = time.time()
+        entry["deadline"] = deadline
+        return self.add(entry)
+
+    def _nearest(self, index: list, elo: int, exclude: int):
+        """Ближайшая по ELO запись списка (кроме самого игрока) — O(log n)."""
+        i = bisect.bisect_left(index, (elo,))
+        left = i - 1
+        if left >= 0 and index[left][2] == exclude:
+            left -= 1
+        right = i
+        if right < len(index) and index[right][2] == exclude:
+            right += 1
+        cands = [index[j] for j in (left, right) if 0 <= j < len(index)]
+        if not cands:
+            return None
+        best = min(cands, key=lambda k: (abs(k[0] - elo), k[1]))
+        return self.entries.get(best[2])
+
+    def find_opponent(self, entry: dict, now: float):
+        """Подбирает соперника: глобальные ищущие согласны на любого, остальные — свой ранг в окне ELO."""
+        uid, elo = entry["user_id"], entry["elo"]
+        if entry.get("scope") == "global":
+            cands = [self._nearest(self._global, elo, uid)]
+            cands += [self._nearest(index, elo, uid) for index in self._by_rank.values()]
+            cands = [c for c in cands if c]
+            if not cands:
+                return None
+            return min(cands, key=lambda c: (abs(c["elo"] - elo), c["joined"]))
+        opponent = self._nearest(self._global, elo, uid)
+        if opponent:
+            return opponent
+        opponent = self._nearest(self._by_rank.get(entry["rank"], []), elo, uid)
+        if opponent and abs(opponent["elo"] - elo) <= max(_matchmaking_elo_window(entry, now), _matchmaking_elo_window(opponent, now)):
+            return opponent
+        return None
+
+    def pop_expired(self, now: float) -> list:
+        """Записи, у которых истёк срок текущей стадии поиска (из очереди не удаляются)."""
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, uid = heapq.heappop(self._deadlines)
+            entry = self.entries.get(uid)
+            if entry is not None and entry["deadline"] == deadline:
+                expired.append(entry)
+        return expired
+
+    def pair_waiting(self, now: float) -> list:
+        """Один проход по ожидающим (старшие первыми): окна ELO выросли — пробуем свести пары."""
+        pairs = []
+        for entry in list(self.entries.values()):
+            if self.entries.get(entry["user_id"]) is not entry:
+                continue
+            opponent = self.find_opponent(entry, now)
+            if opponent:
+                self.remove(entry["user_id"])
+                self.remove(opponent["user_id"])
+                pairs.append((entry, opponent))
+        return pairs
+
+
+def _matchmaking(bot_data: dict) -> MatchmakingQueue:
+    queue = bot_data.get("matchmaking")
+    if queue is None:
+        queue = bot_data["matchmaking"] = MatchmakingQueue()
+    return queue
+
+
 async def _start_ranked_match(context: ContextTypes.DEFAULT_TYPE, user_id: int, opponent_entry: dict, current_chat_id=None, match_label: str | None = None):
-    queue = context.bot_data.setdefault("rating_queue", [])
-    own_entry = next((q for q in queue if q.get("user_id") == user_id), None)
-    if own_entry and own_entry in queue:
-        queue.remove(own_entry)
-    if opponent_entry in queue:
-        queue.remove(opponent_entry)
+    queue = _matchmaking(context.bot_data)
+    queue.remove(user_id)
+    queue.remove(opponent_entry["user_id"])
 
     user_elo = get_rating_elo(user_id)
     opp_elo = get_rating_elo(opponent_entry["user_id"])
@@ -8832,71 +10335,72 @@ async def _start_ranked_match(context: ContextTypes.DEFAULT_TYPE, user_id: int,
         pass
 
     result_chat = _queue_result_chat_id(current_chat_id, opponent_entry.get("chat_id"))
-    asyncio.create_task(_simulate_match(context, user_id, opponent_entry["user_id"], result_chat_id=result_chat))
+    context.application.create_task(_simulate_match(context, user_id, opponent_entry["user_id"], result_chat_id=result_chat))
 
 
-async def _search_timeout_cancel(context: ContextTypes.DEFAULT_TYPE, user_id: int, wait_seconds: int = FIND_MATCH_TIMEOUT):
-    await asyncio.sleep(wait_seconds)
-    queue = context.bot_data.setdefault("rating_queue", [])
-    entry = next((q for q in queue if q.get("user_id") == user_id), None)
-    if not entry:
-        return
+async def _matchmaking_notify(context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str):
+    try:
+        await context.bot.send_message(user_id, text, parse_mode="HTML")
+    except Exception:
+        pass
+
 
-    if entry.get("scope") == "rank":
-        elo = int(entry.get("elo", get_rating_elo(user_id)))
-        if _is_low_rating_global_candidate(elo):
-            entry["scope"] = "global"
-            entry["global_started"] = time.time()
-            opponent_entry = next((q for q in queue if q.get("user_id") != user_id), None)
-            if opponent_entry:
-                await _start_ranked_match(
+def _matchmaking_tick(context: ContextTypes.DEFAULT_TYPE, now: float | None = None) -> int:
+    """Один тик подбора: истёкшие стадии поиска, затем сведение пар. Возвращает число начатых матчей."""
+    queue = _matchmaking(context.bot_data)
+    now = time.time() if now is None else now
+    started = 0
+    for entry in queue.pop_expired(now):
+        user_id = entry["user_id"]
+        if entry.get("scope") == "rank" and _is_low_rating_global_candidate(int(entry.get("elo", 0))):
+            entry = queue.go_global(user_id, now + FIND_MATCH_GLOBAL_TIMEOUT)
+            opponent = queue.find_opponent(entry, now)
+            if opponent:
+                queue.remove(user_id)
+                queue.remove(opponent["user_id"])
+                context.application.create_task(_start_ranked_match(
                     context,
                     user_id,
-                    opponent_entry,
+                    opponent,
                     current_chat_id=entry.get("chat_id"),
                     match_label="🌍 Включён глобальный поиск. Соперник найден!"
-                )
-                return
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    "🌍 <b>Локальный поиск завершён.</b>\n\n"
-                    "За 90 секунд соперник вашего ранга не нашёлся.\n"
-                    "Включаю глобальный поиск на 30 секунд — теперь ищем любого соперника.",
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
-            asyncio.create_task(_search_timeout_cancel(context, user_id, FIND_MATCH_GLOBAL_TIMEOUT))
-            return
+                ))
+                started += 1
+                continue
+            context.application.create_task(_matchmaking_notify(
+                context, user_id,
+                "🌍 <b>Локальный поиск завершён.</b>\n\n"
+                "За 90 секунд соперник вашего ранга не нашёлся.\n"
+                "Включаю глобальный поиск на 30 секунд — теперь ищем любого соперника.",
+            ))
+            continue
+
+        queue.remove(user_id)
+        if entry.get("scope") == "global":
+            text = ("😔 <b>Поиск отменён.</b>\n\n"
+                    "Глобальный поиск тоже никого не нашёл за 30 секунд.\n"
+                    "Попробуйте ещё раз позже: /find_match")
+        else:
+            text = ("😔 <b>Поиск отменён.</b>\n\n"
+                    "За 90 секунд не нашлось соперника вашего ранга.\n"
+                    "Попробуйте позже: /find_match")
+        context.application.create_task(_matchmaking_notify(context, user_id, text))
+
+    for entry, opponent in queue.pair_waiting(now):
+        context.application.create_task(_start_ranked_match(context, entry["user_id"], opponent, current_chat_id=entry.get("chat_id")))
+        started += 1
+    return started
 
-        if entry in queue:
-            queue.remove(entry)
-        try:
-            await context.bot.send_message(
-                user_id,
-                "😔 <b>Поиск отменён.</b>\n\n"
-                "За 90 секунд не нашлось соперника вашего ранга.\n"
-                "Попробуйте позже: /find_match",
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
-        return
 
-    if entry.get("scope") == "global":
-        if entry in queue:
-            queue.remove(entry)
+async def _matchmaking_worker(application: Application) -> None:
+    """Фоновый тик очереди /find_match — одна задача на всех ищущих."""
+    context = CallbackContext(application)
+    while True:
+        await asyncio.sleep(MATCHMAKING_TICK_SECONDS)
         try:
-            await context.bot.send_message(
-                user_id,
-                "😔 <b>Поиск отменён.</b>\n\n"
-                "Глобальный поиск тоже никого не нашёл за 30 секунд.\n"
-                "Попробуйте ещё раз позже: /find_match",
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
+            _matchmaking_tick(context)
+        except Exception as e:
+            logger.error(f"Ошибка тика подбора соперников: {e}")
 
 
 async def find_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -8911,12 +10415,12 @@ async def find_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("❌ У вас нет состава. Сначала используйте /rating_team.")
         return
 
-    queue = context.bot_data.setdefault("rating_queue", [])
+    queue = _matchmaking(context.bot_data)
     active_matches = context.bot_data.setdefault("active_matches", set())
     if user.id in active_matches:
         await update.message.reply_text("⚽ У вас уже идёт матч! Дождитесь его окончания, затем ищите снова.")
         return
-    if any(q.get("user_id") == user.id for q in queue):
+    if user.id in queue:
         await update.message.reply_text("⏳ Вы уже ищете соперника. Дождитесь результата поиска.")
         return
 
@@ -8933,34 +10437,474 @@ async def find_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     my_rank, rank_emoji, rank_name = get_rating_rank(my_elo)
     current_chat_id = update.effective_chat.id if update.effective_chat and update.effective_chat.id != user.id else None
 
-    global_entry = next((q for q in queue if q.get("user_id") != user.id and q.get("scope") == "global"), None)
-    if global_entry:
-        await update.message.reply_text("🌍 Найден соперник из глобального поиска. Матч начинается прямо сейчас...")
-        await _start_ranked_match(context, user.id, global_entry, current_chat_id=current_chat_id)
-        return
-
-    opponent_entry = next((q for q in queue if q.get("user_id") != user.id and q.get("rank") == my_rank and q.get("scope") == "rank"), None)
-    if opponent_entry:
-        await update.message.reply_text(f"⚔️ Соперник найден! Ранг: {rank_emoji} {rank_name}. Матч начинается прямо сейчас...")
-        await _start_ranked_match(context, user.id, opponent_entry, current_chat_id=current_chat_id)
-        return
-
-    queue.append({
+    entry = {
         "user_id": user.id,
         "joined": now,
         "rank": my_rank,
         "elo": my_elo,
         "scope": "rank",
         "chat_id": current_chat_id,
-    })
+        "deadline": now + FIND_MATCH_TIMEOUT,
+    }
+    opponent_entry = queue.find_opponent(entry, now)
+    if opponent_entry:
+        queue.remove(opponent_entry["user_id"])
+        if opponent_entry.get("scope") == "global":
+            await update.message.reply_text("🌍 Найден соперник из глобального поиска. Матч начинается прямо сейчас...")
+        else:
+            await update.message.reply_text(f"⚔️ Соперник найден! Ранг: {rank_emoji} {rank_name}. Матч начинается прямо сейчас...")
+        await _start_ranked_match(context, user.id, opponent_entry, current_chat_id=current_chat_id)
+        return
+
+    queue.add(entry)
     extra = "\n🌍 Для низкого рейтинга после 90 секунд автоматически включится глобальный поиск ещё на 30 секунд." if _is_low_rating_global_candidate(my_elo) else ""
     await update.message.reply_text(
         f"🔍 Ищем соперника вашего ранга: {rank_emoji} <b>{rank_name}</b> (рейтинг {my_elo})...\n\n"
-        "⚖️ Сначала ищем только игроков того же ранга.\n"
+        "⚖️ Сначала ищем только игроков того же ранга с близким рейтингом — чем дольше поиск, тем шире допуск.\n"
         "⏳ Локальный поиск длится 90 секунд." + extra,
         parse_mode="HTML",
     )
-    asyncio.create_task(_search_timeout_cancel(context, user.id, FIND_MATCH_TIMEOUT))
+
+
+# ============================ СОСТОЯНИЕ МАТЧМЕЙКИНГА ============================
+# Очередь поиска, идущие матчи, открытые дуэли и КД /find_match живут в bot_data,
+# поэтому переживают перезапуск только через MATCH_STATE_FILE. Файл переписывается
+# фоновым воркером, только когда состояние изменилось; начало и итог матча
+# сохраняются сразу. Идущий матч хранит сид и входные данные движка — после
+# перезапуска его исход досчитывается тем же simulate_match_core без трансляции.
+MATCH_STATE_FILE = "match_state.json"
+MATCH_STATE_FLUSH_INTERVAL = 5
+MATCH_STATE_REQUEUE_GRACE = 20  # минимум секунд поиска, который остаётся игроку после перезапуска
+_MATCH_STATE_WRITTEN = {"payload": None}
+
+
+def _match_state_snapshot(bot_data: dict) -> dict:
+    """Компактный снимок: только живые записи, просроченные КД отбрасываются. Дуэли
+    хранятся все открытые — даже истёкшие, пока воркер не вернул по ним ставку."""
+    now = time.time()
+    cooldowns = bot_data.get("find_match_cooldowns", {})
+    for uid in [uid for uid, ts in cooldowns.items() if now - ts >= FIND_MATCH_COOLDOWN]:
+        cooldowns.pop(uid, None)
+    return {
+        "saved_at": now,
+        "queue": list(_matchmaking(bot_data).entries.values()),
+        "live_matches": bot_data.get("live_matches", {}),
+        "duels": _duel_registry(bot_data).duels,
+        "cooldowns": {str(uid): ts for uid, ts in cooldowns.items()},
+    }
+
+
+def _flush_match_state(bot_data: dict, force: bool = False) -> None:
+    """Сохраняет состояние матчмейкинга, если оно изменилось с прошлой записи."""
+    state = _match_state_snapshot(bot_data)
+    payload = json.dumps({k: v for k, v in state.items() if k != "saved_at"}, sort_keys=True, ensure_ascii=False)
+    if not force and payload == _MATCH_STATE_WRITTEN["payload"]:
+        return
+    save_data(MATCH_STATE_FILE, state)
+    _MATCH_STATE_WRITTEN["payload"] = payload
+
+
+async def _match_state_flush_worker(application: Application) -> None:
+    """Периодически сохраняет очередь, матчи, дуэли и КД поиска."""
+    while True:
+        try:
+            await asyncio.sleep(MATCH_STATE_FLUSH_INTERVAL)
+            _flush_match_state(application.bot_data)
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("Ошибка сохранения состояния матчмейкинга")
+
+
+def _register_live_match(context, user_a: int, user_b, seed: int, engine_args, name_a: str, name_b: str,
+                         result_chat_id=None, snaps=None, teams=None) -> str:
+    """Запоминает начатый матч (сид + входы движка + составы) и сразу пишет его на диск.
+    Составы нужны досчёту после перезапуска, чтобы итог совпал с живым матчем."""
+    sa, sb, ea, eb, mods_a, mods_b = engine_args
+    match_id = f"{int(time.time() * 1000)}_{user_a}"
+    context.bot_data.setdefault("live_matches", {})[match_id] = {
+        "a": user_a,
+        "b": user_b,
+        "seed": seed,
+        "engine": [sa, sb, ea, eb, list(mods_a), list(mods_b)],
+        "names": [name_a, name_b],
+        "snaps": [_compact_snapshot(snap) for snap in snaps] if snaps else None,
+        "teams": list(teams) if teams else None,
+        "result_chat_id": result_chat_id,
+        "started": time.time(),
+    }
+    try:
+        _flush_match_state(context.bot_data)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить начатый матч: {e}")
+    return match_id
+
+
+def _finish_live_match(context, match_id: str) -> None:
+    """Матч рассчитан: убираем запись и сразу сохраняем, чтобы не рассчитать его повторно."""
+    if context.bot_data.get("live_matches", {}).pop(match_id, None) is None:
+        return
+    try:
+        _flush_match_state(context.bot_data)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить итог матча: {e}")
+
+
+def settle_rating_match(user_a: int, user_b, a_won: bool, teams=None, strengths=None, card_map=None) -> dict:
+    """Расчёт итога рейтингового матча одним проходом: ELO, история результатов,
+    счётчики, задания, травмы, монеты и история действий обеих сторон. Каждый файл
+    читается и пишется не больше одного раза. user_b=None — бот. teams=None — без
+    травм, strengths=None — без монетной награды.
+    Возвращает {'elo': [(старый, новый), ...], 'winner', 'reward', 'quest_rewards': {uid: (сумма, названия)}}."""
+    users = load_data(USERS_FILE, {})
+    players = [(user_a, a_won)] + ([(user_b, not a_won)] if user_b else [])
+    ea = users.get(str(user_a), {}).get("rating_elo", DEFAULT_RATING_ELO)
+    eb = users.get(str(user_b), {}).get("rating_elo", DEFAULT_RATING_ELO) if user_b else DEFAULT_RATING_ELO
+    newa, newb = rating_elo_update(ea, eb, a_won)
+    new_elo = {user_a: newa, user_b: newb}
+    for uid, won in players:
+        user_data = users.setdefault(str(uid), {})
+        user_data["rating_elo"] = new_elo[uid]
+        rating_stats = user_data.get("rating_stats", {"wins": 0, "losses": 0, "draws": 0})
+        key = "wins" if won else "losses"
+        rating_stats[key] = rating_stats.get(key, 0) + 1
+        user_data["rating_stats"] = rating_stats
+        stats = user_data.setdefault("stats", {})
+        stats["rating_matches"] = int(stats.get("rating_matches", 0)) + 1
+        if won:
+            stats["rating_wins"] = int(stats.get("rating_wins", 0)) + 1
+
+    quests = load_data(QUESTS_FILE, {})
+    quests_changed = False
+    coin_changes = {}
+    history = []
+    quest_rewards = {}
+    for uid, won in players:
+        total, names = 0, []
+        for stat in ("rating_matches",) + (("rating_wins",) if won else ()):
+            reward, done, changed = _apply_quest_progress(quests, users, uid, stat, 1)
+            quests_changed = quests_changed or changed
+            total += reward
+            names += done
+        if total:
+            coin_changes[uid] = coin_changes.get(uid, 0) + total
+            history.append((uid, 'quest_auto_claim', f"+{total}: {', '.join(names)}"))
+            quest_rewards[uid] = (total, names)
+
+    injuries = None
+    if teams:
+        for uid, team in zip((user_a, user_b), teams):
+            if uid and team and random.random() < 0.08:
+                refs = [team.get('gk')] + list(team.get('field', []))
+                ref = random.choice([r for r in refs if r])
+                name = _card_name(ref, card_map or {})
+                if injuries is None:
+                    injuries = load_data(INJURIES_FILE, {})
+                injuries.setdefault(str(uid), []).append({'ref': ref, 'name': name, 'until': time.time() + random.randint(60, 180) * 60})
+                history.append((uid, 'injury', name))
+
+    # Контролируемая награда: только 35% шанс, меньше за победу над слабым составом.
+    winner = user_a if a_won else user_b
+    reward = 0
+    if strengths and winner and random.random() < .35:
+        sa, sb = strengths
+        ws, ls = (sa, sb) if a_won else (sb, sa)
+        reward = 6 if ws > ls + 35 else (12 if ws >= ls - 35 else 18)
+        coin_changes[winner] = coin_changes.get(winner, 0) + reward
+
+    save_data(USERS_FILE, users)
+    if quests_changed:
+        save_data(QUESTS_FILE, quests)
+    update_coins_bulk(coin_changes)
+    if injuries is not None:
+        save_data(INJURIES_FILE, injuries)
+    log_actions(history)
+    return {
+        'elo': [(ea, newa), (eb, newb if user_b else None)],
+        'winner': winner,
+        'reward': reward,
+        'quest_rewards': quest_rewards,
+    }
+
+
+def _restore_match_state(application: Application) -> None:
+    """При старте: возвращает в bot_data очередь, КД, дуэли и незавершённые матчи."""
+    state = load_data(MATCH_STATE_FILE, {})
+    if not state:
+        return
+    bot_data = application.bot_data
+    now = time.time()
+    downtime = max(0.0, now - float(state.get("saved_at", now)))
+
+    cooldowns = bot_data.setdefault("find_match_cooldowns", {})
+    for uid, ts in state.get("cooldowns", {}).items():
+        if now - ts < FIND_MATCH_COOLDOWN:
+            cooldowns[int(uid)] = ts
+
+    # Только дуэли с удержанной ставкой; просроченные за время простоя вернёт воркер
+    duels = _duel_registry(bot_data)
+    for duel_id, duel in state.get("duels", {}).items():
+        if duel.get("escrow") and duel_id not in duels.duels:
+            duels.add(duel, duel_id)
+
+    live = bot_data.setdefault("live_matches", {})
+    live.update(state.get("live_matches", {}))
+    busy = set()
+    for record in live.values():
+        busy.add(record["a"])
+        if record.get("b"):
+            busy.add(record["b"])
+    bot_data.setdefault("active_matches", set()).update(busy)
+
+    queue = _matchmaking(bot_data)
+    requeued = []
+    for entry in state.get("queue", []):
+        if entry.get("user_id") in busy:
+            continue
+        # Время простоя не засчитываем в ожидание: окно ELO и сроки стадий сдвигаются
+        entry["joined"] = float(entry.get("joined", now)) + downtime
+        entry["deadline"] = max(float(entry.get("deadline", now)) + downtime, now + MATCH_STATE_REQUEUE_GRACE)
+        queue.add(entry)
+        requeued.append(entry["user_id"])
+    bot_data["match_state_requeued"] = requeued
+    logger.info(f"Восстановлено: в поиске {len(requeued)}, дуэлей {len(duels)}, незавершённых матчей {len(live)}.")
+
+
+async def _resolve_interrupted_matches(application: Application) -> None:
+    """Досчитывает матчи, прерванные перезапуском, по их сиду — без повторной трансляции."""
+    await asyncio.sleep(5)  # ждём пока Telegram-соединение установится
+    context = CallbackContext(application)
+    for uid in application.bot_data.pop("match_state_requeued", []):
+        if uid in _matchmaking(application.bot_data):
+            try:
+                await context.bot.send_message(uid, "🔄 Бот перезапускался — поиск соперника продолжается.")
+            except Exception:
+                pass
+
+    live = application.bot_data.get("live_matches", {})
+    active = application.bot_data.setdefault("active_matches", set())
+    for match_id, record in list(live.items()):
+        try:
+            sa, sb, ea, eb, mods_a, mods_b = record["engine"]
+            rng = random.Random(record["seed"])
+            outcome = simulate_match_core(sa, sb, ea, eb, tuple(mods_a), tuple(mods_b), rng=rng)
+            ga, gb = outcome["ga"], outcome["gb"]
+            user_a, user_b = record["a"], record.get("b")
+            # Те же составы и силы, что у живого матча: травмы и монетная награда не зависят от перезапуска
+            teams = record.get("teams")
+            card_map = {c['id']: c for c in load_data(CARDS_FILE, [])} if teams else None
+            settlement = settle_rating_match(user_a, user_b, ga > gb, teams=tuple(teams) if teams else None,
+                                             strengths=(sa, sb), card_map=card_map)
+            (old_a, new_a), (old_b, new_b) = settlement['elo']
+            _finish_live_match(context, match_id)
+            if record.get("snaps"):
+                story = narrate_match(outcome, *record["snaps"], *record["names"], rng)
+                append_match_record({
+                    "id": match_id, "seed": record["seed"], "played_at": time.time(),
+                    "a": user_a, "b": user_b, "names": record["names"],
+                    "img_names": [_short_team_name(n.lstrip('@')) for n in record["names"]],
+                    "snaps": record["snaps"], "engine": record["engine"], "score": [ga, gb],
+                    "finish": outcome["finish"], "period_scores": story["period_scores"],
+                    "scorers": story["scorers"], "stats": story["stats"],
+                    "elo": [[old_a, new_a], [old_b, new_b]], "recovered": True,
+                })
+        except Exception as e:
+            logger.error(f"Не удалось досчитать прерванный матч {match_id}: {e}")
+            live.pop(match_id, None)
+            continue
+        finally:
+            active.discard(record["a"])
+            if record.get("b"):
+                active.discard(record["b"])
+
+        na, nb = (html.escape(n) for n in record["names"])
+        mark = {"ot": " (ОТ)", "so": " (БУЛ)"}.get(outcome["finish"], "")
+        score = f"{na} <b>{ga}:{gb}</b>{mark} {nb}"
+        for uid, old, new, won in [(user_a, old_a, new_a, ga > gb)] + ([(user_b, old_b, new_b, gb > ga)] if user_b else []):
+            delta = new - old
+            try:
+                await context.bot.send_message(
+                    uid,
+                    "🔄 Бот перезапускался во время матча — итог досчитан по сохранённому сиду.\n\n"
+                    f"{'🏆 ПОБЕДА!' if won else '😤 Поражение.'} {score}\n"
+                    f"⭐ Рейтинг: {old} → <b>{new}</b> ({'+' if delta >= 0 else ''}{delta})"
+                    + (f"\n💰 Награда за победу: +{settlement['reward']} монет" if won and settlement['reward'] else ""),
+                    parse_mode="HTML",
+                )
+            except Exception:
+                pass
+        if record.get("result_chat_id"):
+            try:
+                await context.bot.send_message(record["result_chat_id"], "Хоккейные карточки\n" + score, parse_mode="HTML")
+            except Exception:
+                pass
+        for uid, rewards in settlement['quest_rewards'].items():
+            await _notify_quest_rewards(context, uid, rewards)
+
+
+# ============================ ЖУРНАЛ МАТЧЕЙ ============================
+# Каждый рейтинговый матч дописывается одной строкой в MATCH_LOG_FILE: сид, входы
+# движка, компактные снимки составов и итог. /match_replay прогоняет по записи тот же
+# simulate_match_core и narrate_match и получает тот же текст событий и постер —
+# без повторной трансляции и без изменения рейтинга.
+MATCH_LOG_FILE = "match_log.jsonl"
+MATCH_REPLAY_TEXT_LIMIT = 3800
+
+
+def _compact_snapshot(snap: dict) -> dict:
+    """Снимок состава без служебных полей — ровно то, что нужно рассказу матча."""
+    def slot(s):
+        return {'name': s['name'], 'name_html': s['name_html'], 'power': s['power']}
+    return {
+        'gk': slot(snap['gk']),
+        'field': [slot(s) for s in snap['field']],
+        'coach': {'name': snap['coach']['name'], 'name_html': snap['coach']['name_html']} if snap['coach'] else None,
+        'coach_bonus': snap['coach_bonus'],
+        'tactic': snap['tactic'],
+        'mods': list(snap['mods']),
+    }
+
+
+# Индекс журнала: {id матча: смещение строки} и последний матч каждого игрока. Файл
+# целиком читается один раз (лениво, при первом поиске), дальше индекс дополняется при
+# записи, а поиск дочитывает только строки, появившиеся после прошлого прохода.
+_MATCH_LOG_INDEX = {"size": 0, "by_id": {}, "last_by_user": {}}
+_MATCH_LOG_LOCK = threading.Lock()
+
+
+def _index_match_line(offset: int, record: dict) -> None:
+    _MATCH_LOG_INDEX["by_id"][record.get("id")] = offset
+    for uid in (record.get("a"), record.get("b")):
+        if uid:
+            _MATCH_LOG_INDEX["last_by_user"][uid] = offset
+
+
+def _refresh_match_log_index() -> None:
+    """Дочитывает в индекс новые строки журнала (вызывать под _MATCH_LOG_LOCK)."""
+    index = _MATCH_LOG_INDEX
+    try:
+        size = os.path.getsize(MATCH_LOG_FILE)
+    except OSError:
+        size = 0
+    if size < index["size"]:
+        # Журнал заменили или обрезали — строим заново
+        index.update(size=0, by_id={}, last_by_user={})
+    if size == index["size"]:
+        return
+    offset = index["size"]
+    with open(MATCH_LOG_FILE, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # строка ещё дописывается — возьмём в следующий раз
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict):
+                _index_match_line(offset, record)
+            offset += len(line)
+    index["size"] = offset
+
+
+def append_match_record(record: dict) -> None:
+    """Дописывает запись матча в журнал (файл только растёт, старые строки не трогаются)."""
+    line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    try:
+        with open(MATCH_LOG_FILE, "ab") as f:
+            offset = f.tell()
+            f.write(line)
+    except Exception as e:
+        logger.warning(f"Не удалось записать матч в журнал: {e}")
+        return
+    # Event loop не ждёт поток поиска: если индекс занят, строку дочитает следующий поиск
+    if _MATCH_LOG_LOCK.acquire(blocking=False):
+        try:
+            if _MATCH_LOG_INDEX["size"] == offset:
+                _index_match_line(offset, record)
+                _MATCH_LOG_INDEX["size"] = offset + len(line)
+        finally:
+            _MATCH_LOG_LOCK.release()
+
+
+def find_match_record(match_id: str | None = None, user_id: int | None = None):
+    """Запись по id или последний матч игрока: поиск по индексу и одно чтение строки."""
+    with _MATCH_LOG_LOCK:
+        _refresh_match_log_index()
+        if match_id is not None:
+            offset = _MATCH_LOG_INDEX["by_id"].get(match_id)
+        else:
+            offset = _MATCH_LOG_INDEX["last_by_user"].get(user_id)
+    if offset is None:
+        return None
+    try:
+        with open(MATCH_LOG_FILE, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def replay_match_record(record: dict) -> dict:
+    """Заново рассказывает матч по записи. 'consistent' — совпал ли счёт с сохранённым."""
+    sa, sb, ea, eb, mods_a, mods_b = record["engine"]
+    rng = random.Random(record["seed"])
+    outcome = simulate_match_core(sa, sb, ea, eb, tuple(mods_a), tuple(mods_b), rng=rng)
+    snap_a, snap_b = record["snaps"]
+    name_a, name_b = record["names"]
+    story = narrate_match(outcome, snap_a, snap_b, name_a, name_b, rng)
+    story["consistent"] = [story["ga"], story["gb"]] == list(record.get("score", []))
+    return story
+
+
+async def match_replay_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/match_replay [id] — повтор рейтингового матча из журнала (по умолчанию последний свой)."""
+    user = update.effective_user
+    if is_banned(user.id):
+        await update.message.reply_text("❌ Вы заблокированы в этом боте.")
+        return
+    match_id = context.args[0] if context.args else None
+    record = await asyncio.to_thread(find_match_record, match_id, None if match_id else user.id)
+    if not record:
+        await update.message.reply_text("❌ Матч не найден. Использование: /match_replay [id матча]")
+        return
+    if user.id not in (record.get("a"), record.get("b")) and not is_moderator(user.id):
+        await update.message.reply_text("❌ Повтор доступен только участникам матча.")
+        return
+
+    story = replay_match_record(record)
+    na, nb = (html.escape(n) for n in record["names"])
+    ga, gb = story["ga"], story["gb"]
+    played = datetime.fromtimestamp(record.get("played_at", 0)).strftime("%d.%m.%Y %H:%M")
+    blocks = [f"🧾 <b>Повтор матча</b> #{html.escape(record['id'])} от {played}\n{na} 🆚 {nb}"]
+    for period, block in enumerate(story["periods"], 1):
+        blocks.append(f"🏒 <b>Период {period}</b>\n" + "\n".join(block["lines"]))
+    if story["finish"]:
+        blocks.append(story["finish"]["text"])
+    blocks.append(f"📺 <b>{na} {ga}:{gb}{story['finish_suffix']} {nb}</b>")
+    if not story["consistent"]:
+        blocks.append("⚠️ Движок матча с тех пор менялся — счёт повтора отличается от сохранённого "
+                      f"({record['score'][0]}:{record['score'][1]}).")
+
+    chunk = ""
+    for block in blocks:
+        if chunk and len(chunk) + len(block) + 2 > MATCH_REPLAY_TEXT_LIMIT:
+            await update.message.reply_text(chunk, parse_mode="HTML")
+            chunk = ""
+        chunk = f"{chunk}\n\n{block}" if chunk else block
+    if chunk:
+        await update.message.reply_text(chunk, parse_mode="HTML")
+
+    snap_a, snap_b = record["snaps"]
+    img_a, img_b = record.get("img_names") or [_short_team_name(n.lstrip('@')) for n in record["names"]]
+    image = await render_image(
+        "match_result", img_a, img_b, ga, gb, story["period_scores"],
+        scorers=story["scorers"],
+        coaches=(_snapshot_coach_info(snap_a, plain=True), _snapshot_coach_info(snap_b, plain=True)),
+        stats=story["stats"],
+    )
+    if image:
+        await update.message.reply_photo(photo=image)
 
 
 async def _run_locked_action(context: ContextTypes.DEFAULT_TYPE, user_id: int, action_name: str, runner, busy_message: str, on_busy=None):
@@ -9480,6 +11424,189 @@ async def show_collection_with_ids(user_id: int) -> str:
     return message
 
 
+# ============================ КОЛЛЕКЦИЯ: ПОСТРАНИЧНЫЙ ПРОСМОТР ============================
+# /my_cards больше не собирает всю коллекцию в одну огромную HTML-строку: по инвентарю
+# строится компактный индекс (группы по редкостям), а текст собирается только для
+# запрошенной страницы. Индекс кэшируется по «подписи» инвентаря и пересобирается,
+# только когда у игрока изменились карты, прокачка, лоты, база карточек или редкостей.
+COLLECTION_PAGE_SIZE = 25
+_COLLECTION_INDEX_CACHE = {}
+
+
+def _collection_signature(user_data: dict, locked: list) -> tuple:
+    mtimes = []
+    for path in (CARDS_FILE, RARITIES_FILE):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(0)
+    return (
+        hash(tuple(user_data.get("cards", []))),
+        hash(tuple(sorted((user_data.get("card_upgrades") or {}).items()))),
+        hash(tuple(locked)),
+        *mtimes,
+    )
+
+
+def _collection_index(user_id: int) -> dict:
+    """Сгруппированный индекс коллекции: {"rarities": [(редкость, кол-во копий)], "rows": [...], ...}.
+    rows — строки (редкость, card_id, имя, копий, уровень) в порядке показа,
+    locked — недоступные карты (редкость, card_id, имя, копий)."""
+    user_data, normal_cards, _ = _collect_user_inventory(user_id)
+    locked = get_locked_card_ids(user_id)
+    sig = _collection_signature(user_data, locked)
+    cached = _COLLECTION_INDEX_CACHE.get(user_id)
+    if cached and cached[0] == sig:
+        return cached[1]
+    card_map = {c["id"]: c for c in load_data(CARDS_FILE, [])}
+    rarity_info = {r["name"]: r for r in load_data(RARITIES_FILE, [])}
+
+    def _sort_key(rarity_name):
+        info = rarity_info.get(rarity_name, {})
+        droppable = info.get("droppable", rarity_name != "Эксклюзивная")
+        chance = get_rarity_drop_chance(rarity_name)
+        if chance <= 0:
+            chance = 1.0
+        return (0 if not droppable else 1, chance, rarity_name)
+
+    upgrades = user_data.get("card_upgrades", {}) or {}
+    grouped = {}
+    for cid, count in Counter(normal_cards).items():
+        card = card_map.get(cid)
+        if not card:
+            continue
+        grouped.setdefault(card.get("rarity", "Обычная"), []).append((cid, card.get("name", "?"), count))
+    rarities, rows = [], []
+    for rarity in sorted(grouped, key=_sort_key):
+        items = sorted(grouped[rarity], key=lambda x: x[0])
+        rarities.append((rarity, sum(count for _, _, count in items)))
+        for cid, name, count in items:
+            rows.append((rarity, cid, name, count, int(upgrades.get(str(cid), 0))))
+    locked_rows = [(card_map.get(cid, {}).get("rarity"), cid, card_map.get(cid, {}).get("name", f"ID {cid}"), cnt)
+                   for cid, cnt in sorted(Counter(locked).items())]
+    index = {"rarities": rarities, "rows": rows, "locked": locked_rows, "total": len(normal_cards)}
+    _COLLECTION_INDEX_CACHE[user_id] = (sig, index)
+    return index
+
+
+def _build_collection_page(user_id: int, page: int, rarity_idx: int = -1):
+    """Одна страница /my_cards. rarity_idx — номер редкости в индексе (-1 — все)."""
+    index = _collection_index(user_id)
+    if not index["rows"] and not index["locked"]:
+        return "📭 Ваша коллекция пуста!", None
+    rarities = index["rarities"]
+    if not (0 <= rarity_idx < len(rarities)):
+        rarity_idx = -1
+    rarity_name = None if rarity_idx < 0 else rarities[rarity_idx][0]
+    rows = [r for r in index["rows"] if rarity_name is None or r[0] == rarity_name]
+    locked = [r for r in index["locked"] if rarity_name is None or r[0] == rarity_name]
+    # Недоступные карты листаются в той же пагинации, следом за обычными
+    entries = [(False, r) for r in rows] + [(True, r) for r in locked]
+    total_pages = max(1, (len(entries) + COLLECTION_PAGE_SIZE - 1) // COLLECTION_PAGE_SIZE)
+    page = max(0, min(page, total_pages - 1))
+    title = "все редкости" if rarity_idx < 0 else f"{get_rarity_emoji(rarity_name)} {html.escape(rarity_name)}"
+    lines = [f"🃏 <b>Ваша коллекция</b> — {title}, стр. {page + 1}/{total_pages}\n"]
+    current_group = None
+    for is_locked, row in entries[page * COLLECTION_PAGE_SIZE:(page + 1) * COLLECTION_PAGE_SIZE]:
+        if is_locked:
+            _, cid, name, count = row
+            if current_group != "locked":
+                gap = "\n" if current_group is not None else ""
+                current_group = "locked"
+                lines.append(f"{gap}🔒 <b>Недоступны</b> ({sum(r[3] for r in locked)} — на маркете или в работе):")
+            count_text = f" (x{count})" if count > 1 else ""
+            lines.append(f"   • {html.escape(name)}{count_text} [ID: {cid}]")
+            continue
+        rarity, cid, name, count, lvl = row
+        if rarity != current_group:
+            current_group = rarity
+            lines.append(f"{get_rarity_emoji(rarity)} <b>{html.escape(rarity)}</b>:")
+        lvl_text = f" ⭐ур.{lvl}" if lvl > 0 else ""
+        count_text = f" (x{count})" if count > 1 else ""
+        lines.append(f"   • {html.escape(name)}{lvl_text}{count_text} [ID: {cid}]")
+    lines.append(f"\n📚 <b>Карточек: {index['total']}</b>")
+    lines.append("💡 Лот на маркете: <code>/sell card_id цена</code>")
+
+    keyboard = []
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"mycards_{user_id}_{rarity_idx}_{page - 1}"))
+    if page < total_pages - 1:
+        nav.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"mycards_{user_id}_{rarity_idx}_{page + 1}"))
+    if nav:
+        keyboard.append(nav)
+    if len(rarities) > 1:
+        filters_row = [InlineKeyboardButton(("• " if rarity_idx < 0 else "") + "Все", callback_data=f"mycards_{user_id}_-1_0")]
+        for i, (rarity, count) in enumerate(rarities):
+            mark = "• " if i == rarity_idx else ""
+            filters_row.append(InlineKeyboardButton(f"{mark}{get_rarity_emoji(rarity)} {count}", callback_data=f"mycards_{user_id}_{i}_0"))
+        for i in range(0, len(filters_row), 4):
+            keyboard.append(filters_row[i:i + 4])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+async def show_collection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if is_banned(user.id):
+        await update.message.reply_text("❌ Вы заблокированы в этом боте.")
+        return
+    if not await is_subscribed(user.id, context):
+        await update.message.reply_text(subscription_required_text())
+        return
+    # /my_cards Легендарная — сразу открыть фильтр по редкости
+    rarity_idx = -1
+    if context.args:
+        wanted = " ".join(context.args).strip().lower()
+        names = [r for r, _ in _collection_index(user.id)["rarities"]]
+        rarity_idx = next((i for i, r in enumerate(names) if r.lower() == wanted), -1)
+    text, reply_markup = _build_collection_page(user.id, 0, rarity_idx)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
+
+async def my_cards_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Перелистывание страниц и фильтры редкости в /my_cards."""
+    query = update.callback_query
+    try:
+        _, owner_id, rarity_idx, page = query.data.split("_")
+        owner_id, rarity_idx, page = int(owner_id), int(rarity_idx), int(page)
+    except ValueError:
+        await query.answer()
+        return
+    if query.from_user.id != owner_id:
+        await query.answer("Это не ваша коллекция. Откройте свою: /my_cards", show_alert=True)
+        return
+    await query.answer()
+    text, reply_markup = _build_collection_page(owner_id, page, rarity_idx)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
+    except Exception:
+        # Содержимое не изменилось (та же страница) — игнорируем.
+        pass
+
+
+def _framed_card_cache_name(card: dict):
+    """Имя файла рамки в FRAMED_CARDS_DIR: id, редкость, mtime фото и подпись из
+    имени/силы — после правки карточки имя меняется и старый файл уходит при прогреве."""
+    src_path = os.path.join(CARDS_IMAGE_DIR, card.get("image", ""))
+    if not card.get("image") or not os.path.exists(src_path):
+        return None
+    try:
+        pwr = get_card_power(card)
+    except Exception:
+        pwr = 0
+    sig = hashlib.sha1(f"{card.get('name', '')}|{pwr}".encode("utf-8")).hexdigest()[:8]
+    cache_key = f"hockey_{card['id']}_{card.get('rarity','')}_{int(os.path.getmtime(src_path))}_{sig}.{_image_output_ext('framed_card')}"
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', cache_key)
+
+
+# hockey_{id}_{rarity}_{mtime}_{sig8}.{ext} после замены недопустимых символов на "_";
+# подпись sig8 необязательна, чтобы уборка узнавала и рамки прежнего формата без неё,
+# а вторая ветка — самые старые {id}_{mtime}_{сумма}.png
+_FRAMED_CACHE_NAME_RE = re.compile(r'^(?:hockey_[A-Za-z0-9.-]+_.*_\d+(?:_[0-9a-f]{8})?\.[A-Za-z0-9]+|\d+_\d+_\d+\.png)$')
+# недописанные временные файлы ({имя}.{pid}.tmp) старше этого срока удаляются уборкой
+FRAMED_TMP_MAX_AGE = 300
+
+
 def get_framed_card_photo(card: dict, mutation_instance: dict | None = None):
     """Красивая хоккейная карточка: ледовая арена, шайба/линии льда, премиальная рамка редкости."""
     if not PIL_AVAILABLE:
@@ -9489,23 +11616,15 @@ def get_framed_card_photo(card: dict, mutation_instance: dict | None = None):
         return None
     try:
         os.makedirs(FRAMED_CARDS_DIR, exist_ok=True)
-        mtime = int(os.path.getmtime(src_path))
-        cache_key = f"hockey_{card['id']}_{card.get('rarity','')}_{mtime}.png"
-        cache_key = re.sub(r'[^A-Za-z0-9_.-]+', '_', cache_key)
-        cache_path = os.path.join(FRAMED_CARDS_DIR, cache_key)
+        cache_path = os.path.join(FRAMED_CARDS_DIR, _framed_card_cache_name(card))
         if os.path.exists(cache_path):
             return open(cache_path, "rb")
 
         W, H = 720, 1024
         main, light = _rarity_frame_colors(card.get("rarity", "Обычная"))
-        canvas = Image.new("RGBA", (W, H), (5, 12, 28, 255))
-        d = ImageDraw.Draw(canvas)
-
         # ледовый градиент / арена
-        for y in range(H):
-            t = y / max(1, H - 1)
-            r = int(6 + 20 * t); g = int(18 + 48 * t); b = int(42 + 78 * t)
-            d.line((0, y, W, y), fill=(r, g, b, 255))
+        canvas = _gradient_tile((W, H), (6, 18, 42), (26, 66, 120)).convert("RGBA")
+        d = ImageDraw.Draw(canvas)
         # свет прожекторов
         glow = Image.new("RGBA", (W, H), (0,0,0,0)); gd = ImageDraw.Draw(glow)
         for cx in (120, W-120, W//2):
@@ -9537,9 +11656,8 @@ def get_framed_card_photo(card: dict, mutation_instance: dict | None = None):
             d.line(pts, fill=corner, width=5, joint='curve')
 
         # фото игрока
-        img = Image.open(src_path).convert("RGBA")
         photo_w, photo_h = 548, 590
-        img = ImageOps.fit(img, (photo_w, photo_h), centering=(0.5, 0.25))
+        img = _fitted_photo(src_path, (photo_w, photo_h), centering=(0.5, 0.25), mode="RGBA")
         mask = Image.new('L', (photo_w, photo_h), 0); md = ImageDraw.Draw(mask)
         md.rounded_rectangle((0,0,photo_w,photo_h), radius=30, fill=255)
         px, py = 86, 118
@@ -9574,58 +11692,113 @@ def get_framed_card_photo(card: dict, mutation_instance: dict | None = None):
         d.ellipse((W//2-42, 934, W//2+42, 970), fill=(8,12,20,255), outline=(*light,200), width=3)
         d.arc((W//2-34, 936, W//2+34, 966), 190, 350, fill=(210,235,255,120), width=2)
 
-        canvas.convert("RGB").save(cache_path, quality=95)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(encode_image(canvas, "framed_card").getvalue())
+        os.replace(tmp, cache_path)
         return open(cache_path, "rb")
     except Exception as e:
         logger.error(f"Не удалось построить hockey card photo: {e}")
         return None
 
 
+# Анимация особой версии: всё, что не зависит от карточки (фон со сканлайнами,
+# размытое свечение, рамка с нарастающей прозрачностью и подписи), считается один
+# раз на тип мутации; на карточку остаётся наложить фото в шести кадрах. Кадры
+# квантуются в одну общую палитру, готовый GIF кэшируется на диск по (карта, мутация).
+MUTATION_REVEAL_VERSION = 1
+MUTATION_REVEAL_CACHE_DIR = os.path.join("render_cache", "mutations")
+MUTATION_REVEAL_ALPHAS = (60, 100, 145, 190, 235, 255)
+MUTATION_REVEAL_SIZE = 640
+_MUTATION_REVEAL_LAYERS = {}
+
+
+def _mutation_reveal_layers(mutation_key: str, meta: dict):
+    """Неизменные слои анимации для мутации: фон, подписи и по кадру (свечение, рамка)."""
+    key = (mutation_key, os.stat(meta["frame_path"]).st_mtime_ns)
+    layers = _MUTATION_REVEAL_LAYERS.get(key)
+    if layers is not None:
+        return layers
+    S = MUTATION_REVEAL_SIZE
+    bg = Image.new("RGBA", (S, S), (10, 12, 20, 255))
+    d = ImageDraw.Draw(bg)
+    for y in range(0, S, 10):
+        d.line((0, y, S, y), fill=(12, 18, 34, 255), width=1)
+    # Свечение размываем один раз на каждую уникальную яркость
+    glows = {}
+    for alpha in set(min(180, a) for a in MUTATION_REVEAL_ALPHAS):
+        glow = Image.new("RGBA", (S, S), (0, 0, 0, 0))
+        ImageDraw.Draw(glow).ellipse((120, 110, 520, 510), fill=(*meta["glow"], alpha))
+        glows[alpha] = glow.filter(ImageFilter.GaussianBlur(radius=32))
+    frame = _fitted_photo(meta["frame_path"], (420, 420), centering=None, mode="RGBA")
+    frame_alpha = frame.getchannel('A')
+    steps = []
+    for alpha in MUTATION_REVEAL_ALPHAS:
+        ramp = frame
+        if alpha < 255:
+            ramp = frame.copy()
+            ramp.putalpha(frame_alpha.point([int(p * alpha / 255) for p in range(256)]))
+        steps.append((glows[min(180, alpha)], ramp))
+    text = Image.new("RGBA", (S, S), (0, 0, 0, 0))
+    td = ImageDraw.Draw(text)
+    title_font = _load_team_font(36)
+    small_font = _load_team_font(24)
+    line1 = f"{meta['emoji']} МУТАЦИЯ"
+    line2 = meta["label"].upper()
+    line3 = f"+{meta['power_bonus']} к силе"
+    td.text(((S - td.textlength(line1, font=title_font)) / 2, 22), line1, font=title_font, fill=(*meta["glow"], 255))
+    td.text(((S - td.textlength(line2, font=title_font)) / 2, 500), line2, font=title_font, fill=(245, 247, 252, 255))
+    td.text(((S - td.textlength(line3, font=small_font)) / 2, 548), line3, font=small_font, fill=(*meta["color"], 255))
+    layers = {"bg": bg, "steps": steps, "text": text}
+    _MUTATION_REVEAL_LAYERS[key] = layers
+    return layers
+
+
 def _build_mutation_reveal_animation(card: dict, mutation_instance: dict):
     if not PIL_AVAILABLE:
         return None
     try:
         _ensure_mutation_assets()
-        meta = _get_mutation_meta(mutation_instance.get("mutation"))
+        mutation_key = mutation_instance.get("mutation")
+        meta = _get_mutation_meta(mutation_key)
         if not meta:
             return None
         src_path = os.path.join(CARDS_IMAGE_DIR, card.get("image", ""))
         if not os.path.exists(src_path):
             return None
-        base = Image.open(src_path).convert("RGBA")
-        base = ImageOps.fit(base, (420, 420), centering=(0.5, 0.35))
-        frame = Image.open(meta["frame_path"]).convert("RGBA").resize((420, 420))
-        frames = []
-        title_font = _load_team_font(36)
-        small_font = _load_team_font(24)
-        for idx, alpha in enumerate((60, 100, 145, 190, 235, 255)):
-            canvas = Image.new("RGBA", (640, 640), (10, 12, 20, 255))
-            d = ImageDraw.Draw(canvas)
-            for y in range(0, 640, 10):
-                d.line((0, y, 640, y), fill=(12, 18, 34, 255), width=1)
-            glow = Image.new("RGBA", (640, 640), (0, 0, 0, 0))
-            gd = ImageDraw.Draw(glow)
-            gd.ellipse((120, 110, 520, 510), fill=(*meta["glow"], min(180, alpha)))
-            glow = glow.filter(ImageFilter.GaussianBlur(radius=32))
-            canvas = Image.alpha_composite(canvas, glow)
+        name = f"mutation_{mutation_instance.get('mutation','card')}.gif"
+        cache_key = re.sub(r'[^A-Za-z0-9_.-]+', '_', (
+            f"reveal_{card.get('id')}_{mutation_key}_{int(os.path.getmtime(src_path))}_"
+            f"{int(os.path.getmtime(meta['frame_path']))}_v{MUTATION_REVEAL_VERSION}.gif"))
+        cache_path = os.path.join(MUTATION_REVEAL_CACHE_DIR, cache_key)
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                bio = io.BytesIO(f.read())
+            bio.name = name
+            return bio
+        layers = _mutation_reveal_layers(mutation_key, meta)
+        base = _fitted_photo(src_path, (420, 420), centering=(0.5, 0.35), mode="RGBA")
+        rgb_frames = []
+        for glow, ramp in layers["steps"]:
+            canvas = Image.alpha_composite(layers["bg"], glow)
             canvas.alpha_composite(base, (110, 80))
-            animated_frame = frame.copy()
-            if alpha < 255:
-                animated_frame.putalpha(animated_frame.getchannel('A').point(lambda p: int(p * alpha / 255)))
-            canvas.alpha_composite(animated_frame, (110, 80))
-            line1 = f"{meta['emoji']} МУТАЦИЯ"
-            line2 = meta["label"].upper()
-            line3 = f"+{meta['power_bonus']} к силе"
-            w1 = d.textlength(line1, font=title_font)
-            w2 = d.textlength(line2, font=title_font)
-            w3 = d.textlength(line3, font=small_font)
-            d.text(((640 - w1) / 2, 22), line1, font=title_font, fill=(*meta["glow"], 255))
-            d.text(((640 - w2) / 2, 500), line2, font=title_font, fill=(245, 247, 252, 255))
-            d.text(((640 - w3) / 2, 548), line3, font=small_font, fill=(*meta["color"], 255))
-            frames.append(canvas.convert("P", palette=Image.ADAPTIVE))
+            canvas.alpha_composite(ramp, (110, 80))
+            canvas.alpha_composite(layers["text"])
+            rgb_frames.append(canvas.convert("RGB"))
+        # Одна палитра на всю анимацию — по последнему, самому насыщенному кадру
+        palette = rgb_frames[-1].quantize(colors=256)
+        frames = [f.quantize(palette=palette) for f in rgb_frames]
         bio = io.BytesIO()
-        bio.name = f"mutation_{mutation_instance.get('mutation','card')}.gif"
+        bio.name = name
         frames[0].save(bio, format="GIF", save_all=True, append_images=frames[1:], duration=130, loop=0)
+        try:
+            os.makedirs(MUTATION_REVEAL_CACHE_DIR, exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(bio.getvalue())
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить GIF особой версии в кэш: {e}")
         bio.seek(0)
         return bio
     except Exception as e:
@@ -9633,6 +11806,450 @@ def _build_mutation_reveal_animation(card: dict, mutation_instance: dict):
         return None
 
 
+# ============================ СЕРВИС РЕНДЕРА КАРТИНОК ============================
+# Тяжёлые Pillow-картинки (профиль, состав, постер матча, карточки) рисуются в пуле
+# процессов: пока строится постер 1800×2200 с размытиями, event loop бота свободен.
+# Задача — имя построителя + аргументы (всё пиклится), результат — байты PNG/GIF.
+# Если пул перегружен или задача не уложилась во время — отвечаем текстом без картинки.
+RENDER_POOL_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+RENDER_QUEUE_LIMIT = RENDER_POOL_WORKERS * 4  # задач в работе + в очереди
+RENDER_JOB_TIMEOUT = 30  # секунд на одну картинку
+RENDER_JOBS = {
+    "profile": ("build_profile_card", "profile.png"),
+    "rating_team": ("build_rating_team_image", "rating_team.png"),
+    "match_result": ("build_match_result_image", "match.png"),
+    "framed_card": ("get_framed_card_photo", "card.png"),
+    "mutation_reveal": ("_build_mutation_reveal_animation", "mutation.gif"),
+}
+_RENDER_POOL = None
+_RENDER_INFLIGHT = 0
+
+
+def _render_job(kind: str, args: tuple, kwargs: dict):
+    """Выполняется в процессе пула: строит картинку и возвращает её байты (или None)."""
+    builder = globals()[RENDER_JOBS[kind][0]]
+    result = builder(*args, **kwargs)
+    if result is None:
+        return None
+    try:
+        return result.read()
+    finally:
+        try:
+            result.close()
+        except Exception:
+            pass
+
+
+def _get_render_pool():
+    global _RENDER_POOL
+    if _RENDER_POOL is None:
+        # spawn: дочерние процессы не наследуют event loop и потоки бота
+        _RENDER_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=RENDER_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _RENDER_POOL
+
+
+def _shutdown_render_pool() -> None:
+    global _RENDER_POOL
+    if _RENDER_POOL is not None:
+        _RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+        _RENDER_POOL = None
+
+
+def _release_render_slot(job) -> None:
+    """Колбэк завершения задачи рендера: место в пуле освобождается, когда процесс
+    действительно закончил рисовать, а не когда вызывающая сторона перестала ждать."""
+    global _RENDER_INFLIGHT
+    _RENDER_INFLIGHT -= 1
+    if not job.cancelled():
+        job.exception()  # забираем ошибку брошенной по таймауту задачи, чтобы asyncio не ругался
+
+
+async def render_image(kind: str, *args, **kwargs):
+    """Асинхронный рендер картинки вне event loop. Возвращает BytesIO или None —
+    тогда вызывающая сторона отправляет текст без картинки."""
+    global _RENDER_INFLIGHT, _RENDER_POOL
+    if not PIL_AVAILABLE or kind not in RENDER_JOBS:
+        return None
+    if _RENDER_INFLIGHT >= RENDER_QUEUE_LIMIT:
+        logger.warning(f"Рендер {kind}: пул занят ({_RENDER_INFLIGHT} задач), отвечаем текстом")
+        return None
+    try:
+        job = asyncio.get_running_loop().run_in_executor(_get_render_pool(), _render_job, kind, args, kwargs)
+    except Exception as e:
+        # Пул не поднялся (нет прав на процессы и т.п.) — рисуем хотя бы не в event loop
+        logger.warning(f"Пул рендера недоступен, рисую в потоке: {e}")
+        job = asyncio.ensure_future(asyncio.to_thread(_render_job, kind, args, kwargs))
+    _RENDER_INFLIGHT += 1
+    job.add_done_callback(_release_render_slot)
+    try:
+        # shield: по таймауту перестаём ждать, но задача дорисовывается и держит место
+        data = await asyncio.wait_for(asyncio.shield(job), RENDER_JOB_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Рендер {kind}: превышено время {RENDER_JOB_TIMEOUT} сек")
+        return None
+    except concurrent.futures.process.BrokenProcessPool:
+        logger.error(f"Рендер {kind}: пул процессов упал, пересоздаю")
+        _RENDER_POOL = None
+        return None
+    except Exception as e:
+        logger.warning(f"Рендер {kind} не удался: {e}")
+        return None
+    if not data:
+        return None
+    bio = io.BytesIO(data)
+    bio.name = RENDER_JOBS[kind][1]
+    if kind in IMAGE_OUTPUT:
+        bio.name = f"{os.path.splitext(bio.name)[0]}.{_image_output_ext(kind)}"
+    return bio
+
+
+# ============================ ПРОГРЕВ КЭША КАРТОЧЕК ============================
+# Рамки карточек рисуются заранее фоновой задачей: при старте бота и после
+# добавления/изменения карточки. Задача идёт через полосу массовых задач и рисует по
+# одной картинке, пропуская ход, пока пул рендера занят запросами игроков. Заодно из
+# cards_images_framed удаляются файлы, которые больше не соответствуют ни одной карточке.
+FRAMED_WARMUP_START_DELAY = 15  # секунд после старта бота
+FRAMED_WARMUP_BUSY_SLEEP = 0.5
+_FRAMED_WARMUP = {"running": False, "pending": False}
+
+
+def _warm_framed_card(card: dict):
+    """Выполняется в процессе пула: рисует рамку в кэш, байты обратно не гоняем."""
+    fh = get_framed_card_photo(card)
+    if fh:
+        fh.close()
+    return None
+
+
+RENDER_JOBS["framed_card_warm"] = ("_warm_framed_card", "card.png")
+
+
+def _gc_framed_cards(cards: list) -> int:
+    """Удаляет из FRAMED_CARDS_DIR рамки, не совпадающие с текущими id/редкостью/mtime.
+    Трогает только файлы с именем по схеме кэша — чужие файлы в папке остаются."""
+    if not os.path.isdir(FRAMED_CARDS_DIR):
+        return 0
+    keep = {_framed_card_cache_name(c) for c in cards}
+    removed = 0
+    now = time.time()
+    for fname in os.listdir(FRAMED_CARDS_DIR):
+        if fname.endswith(".tmp"):
+            # Остаток упавшей записи; свежий tmp может дописываться прямо сейчас
+            stem = fname[:-4].rsplit(".", 1)
+            if len(stem) != 2 or not stem[1].isdigit() or not _FRAMED_CACHE_NAME_RE.match(stem[0]):
+                continue
+            try:
+                if now - os.path.getmtime(os.path.join(FRAMED_CARDS_DIR, fname)) < FRAMED_TMP_MAX_AGE:
+                    continue
+            except OSError:
+                continue
+        elif fname in keep or not _FRAMED_CACHE_NAME_RE.match(fname):
+            continue
+        try:
+            os.remove(os.path.join(FRAMED_CARDS_DIR, fname))
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {fname} из кэша рамок: {e}")
+    return removed
+
+
+async def _warm_framed_cards() -> str:
+    cards = load_data(CARDS_FILE, [])
+    removed = _gc_framed_cards(cards)
+    rendered = failed = 0
+    for card in cards:
+        name = _framed_card_cache_name(card)
+        if not name or os.path.exists(os.path.join(FRAMED_CARDS_DIR, name)):
+            continue
+        # низкий приоритет: ждём, пока в пуле освободится место для запросов игроков
+        while _RENDER_INFLIGHT >= max(1, RENDER_POOL_WORKERS - 1):
+            await asyncio.sleep(FRAMED_WARMUP_BUSY_SLEEP)
+        await render_image("framed_card_warm", card)
+        if os.path.exists(os.path.join(FRAMED_CARDS_DIR, name)):
+            rendered += 1
+        else:
+            failed += 1
+    return f"🖼 Кэш карточек: нарисовано {rendered}, ошибок {failed}, удалено устаревших {removed}"
+
+
+def schedule_framed_card_warmup(context) -> None:
+    """Ставит прогрев кэша рамок в фон. Если прогрев уже идёт — он повторится после."""
+    if not PIL_AVAILABLE:
+        return
+    if _FRAMED_WARMUP["running"]:
+        _FRAMED_WARMUP["pending"] = True
+        return
+    _FRAMED_WARMUP["running"] = True
+
+    async def _run():
+        try:
+            while True:
+                _FRAMED_WARMUP["pending"] = False
+                summary = await _warm_framed_cards()
+                logger.info(summary)
+                if not _FRAMED_WARMUP["pending"]:
+                    return None
+        finally:
+            _FRAMED_WARMUP["running"] = False
+
+    start_bulk_job(context, "прогрев кэша карточек", _run)
+
+
+# ============================ БЕНЧМАРК РЕНДЕРА ============================
+# /bench_render — замер построителей картинок прямо на сервере бота: сколько стоил
+# построчный градиент, сколько стоит векторный и кэшированный, и время полного рендера
+# каждого построителя при пустых кэшах процесса («холодный») и повторном вызове.
+# Бенчмарки подменяют папки кэшей и чистят кэши в памяти, поэтому идут в отдельном
+# spawn-процессе: глобальное состояние работающего бота они не трогают.
+BENCH_RENDER_GRADIENTS = {
+    "profile": ((1600, 1050), (7, 12, 24), (22, 55, 95)),
+    "framed_card": ((720, 1024), (6, 18, 42), (26, 66, 120)),
+}
+
+
+def _bench_line_gradient(size, top_color, bottom_color):
+    """Прежний способ: одна d.line на каждую строку — только для сравнения в бенчмарке."""
+    w, h = size
+    img = Image.new('RGB', (w, h))
+    d = ImageDraw.Draw(img)
+    for y in range(h):
+        t = y / max(1, h - 1)
+        d.line((0, y, w, y), fill=tuple(int(a + (b - a) * t) for a, b in zip(top_color, bottom_color)))
+    return img
+
+
+def _run_bench_process(fn, *args):
+    """Выполняет функцию бенчмарка в отдельном одноразовом процессе и возвращает её результат."""
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def _bench_ms(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) * 1000 / max(1, rounds)
+
+
+def _bench_render_builders(user_id: int, rounds: int = 3) -> list:
+    """Строки отчёта бенчмарка (только в процессе _run_bench_process)."""
+    global FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR
+    if multiprocessing.parent_process() is None:
+        raise RuntimeError("бенчмарк подменяет папки кэшей — запускается только через _run_bench_process")
+    import tempfile
+    lines = []
+    for name, (size, top, bottom) in BENCH_RENDER_GRADIENTS.items():
+        line_ms = _bench_ms(lambda: _bench_line_gradient(size, top, bottom), rounds)
+        vector_ms = _bench_ms(lambda: _render_vertical_gradient(size, top, bottom), rounds)
+        _gradient_tile(size, top, bottom)
+        cached_ms = _bench_ms(lambda: _gradient_tile(size, top, bottom), rounds)
+        lines.append(
+            f"🎨 {name} {size[0]}×{size[1]}: построчно {line_ms:.1f} мс → "
+            f"массивом {vector_ms:.1f} мс → из кэша {cached_ms:.1f} мс"
+        )
+    cards = load_data(CARDS_FILE, [])
+    card = next((c for c in cards if os.path.exists(os.path.join(CARDS_IMAGE_DIR, c.get("image", "")))), None)
+    builders = [
+        ("rating_team", lambda: build_rating_team_image(user_id)),
+    ]
+    saved_dirs = FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def uncached(render, cache_dir):
+            # Готовые картинки кэшируются на диск — здесь каждый прогон рисуем заново
+            def run():
+                if os.path.isdir(cache_dir):
+                    for f in os.listdir(cache_dir):
+                        os.remove(os.path.join(cache_dir, f))
+                out = render()
+                if out:
+                    out.close()
+            return run
+
+        builders.insert(0, ("profile", uncached(lambda: build_profile_card(user_id, "Bench"), os.path.join(tmp_dir, "profiles"))))
+        builders.insert(1, ("profile (из кэша)", lambda: build_profile_card(user_id, "Bench")))
+        # повторные прогоны постера — как картинка второго игрока: тело уже в памяти
+        builders.append(("match_result", uncached(lambda: build_match_result_image(
+            "Команда A", "Команда B", 3, 2, ["1:0", "1:1", "1:1"],
+            scorers=[(12, "Игрок", "Команда A", "1:0")], elo_old=1000, elo_new=1012, won=True), os.path.join(tmp_dir, "matches"))))
+        if card:
+            builders.append(("framed_card", uncached(lambda: get_framed_card_photo(card), os.path.join(tmp_dir, "framed"))))
+        FRAMED_CARDS_DIR = os.path.join(tmp_dir, "framed")
+        PROFILE_RENDER_CACHE_DIR = os.path.join(tmp_dir, "profiles")
+        MATCH_POSTER_CACHE_DIR = os.path.join(tmp_dir, "matches")
+        try:
+            for name, fn in builders:
+                _GRADIENT_CACHE.clear()
+                _FONT_CACHE.clear()
+                _ARENA_BG_CACHE.clear()
+                _PROFILE_BASE_CACHE.clear()
+                _clear_card_photo_cache()
+                _MATCH_POSTER_BODIES.clear()
+                try:
+                    cold_ms = _bench_ms(fn, 1)
+                    warm_ms = _bench_ms(fn, rounds)
+                    lines.append(f"🖼 {name}: холодный {cold_ms:.0f} мс, повторный {warm_ms:.0f} мс")
+                except Exception as e:
+                    lines.append(f"🖼 {name}: ошибка {e}")
+        finally:
+            FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR = saved_dirs
+    return lines
+
+
+async def bench_render_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ: /bench_render [повторов] — замер рендера картинок."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    if not PIL_AVAILABLE:
+        await update.message.reply_text("❌ Pillow не установлен — картинки не рисуются.")
+        return
+    try:
+        rounds = max(1, min(20, int(context.args[0]))) if context.args else 3
+    except ValueError:
+        rounds = 3
+    await update.message.reply_text(f"⏱ Замеряю рендер ({rounds} повт.)...")
+    try:
+        lines = await asyncio.to_thread(_run_bench_process, _bench_render_builders, update.effective_user.id, rounds)
+    except Exception as e:
+        logger.error(f"Бенчмарк рендера не удался: {e}")
+        await update.message.reply_text(f"❌ Бенчмарк не удался: {e}")
+        return
+    backend = "NumPy" if NUMPY_AVAILABLE else "Image.linear_gradient"
+    await update.message.reply_text("📊 Бенчмарк рендера (" + backend + ")\n\n" + "\n".join(lines))
+
+
+# /bench_encode — сравнение кодеков на настоящих картинках построителей: время
+# кодирования, размер и время загрузки на локальный HTTP-заглушку, которая
+# принимает тело запроса со скоростью BENCH_UPLOAD_MBIT (как канал до Telegram).
+BENCH_UPLOAD_MBIT = 10
+BENCH_ENCODE_VARIANTS = [
+    ("PNG исходник", {"format": "PNG", "max_side": 0}),
+    ("JPEG q85", {"format": "JPEG", "quality": 85}),
+    ("JPEG q90", {"format": "JPEG", "quality": 90}),
+    ("WEBP q80", {"format": "WEBP", "quality": 80}),
+]
+
+
+class _BenchUploadHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        left = int(self.headers.get("Content-Length", 0))
+        bytes_per_sec = self.server.upload_mbit * 1_000_000 / 8
+        while left > 0:
+            chunk = self.rfile.read(min(left, 64 * 1024))
+            if not chunk:
+                break
+            left -= len(chunk)
+            time.sleep(len(chunk) / bytes_per_sec)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _bench_upload_ms(server, data: bytes) -> float:
+    import http.client
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=60)
+    started = time.perf_counter()
+    try:
+        conn.request("POST", "/sendPhoto", body=data, headers={"Content-Type": "application/octet-stream"})
+        conn.getresponse().read()
+    finally:
+        conn.close()
+    return (time.perf_counter() - started) * 1000
+
+
+def _bench_encode_outputs(user_id: int, upload_mbit: float) -> list:
+    """Строки отчёта /bench_encode (только в процессе _run_bench_process)."""
+    global FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR, encode_image
+    if multiprocessing.parent_process() is None:
+        raise RuntimeError("бенчмарк подменяет папки кэшей — запускается только через _run_bench_process")
+    import tempfile
+    cards = load_data(CARDS_FILE, [])
+    card = next((c for c in cards if _framed_card_cache_name(c)), None)
+    builders = [
+        ("profile", lambda: build_profile_card(user_id, "Bench")),
+        ("rating_team", lambda: build_rating_team_image(user_id)),
+        ("match_result", lambda: build_match_result_image("Команда A", "Команда B", 3, 2, ["1:0", "1:1", "1:1"],
+                                                          scorers=[(12, "Игрок", "Команда A", "1:0")], elo_old=1000, elo_new=1012, won=True)),
+    ]
+    if card:
+        builders.append(("framed_card", lambda: get_framed_card_photo(card)))
+    # Перехватываем картинки до кодирования, чтобы кодировать один и тот же исходник:
+    # построители зовут encode_image по имени модуля, подменяем его на время прогона
+    sources = []
+    captured = []
+    real_encode = encode_image
+
+    def capturing_encode(img, kind, *args, **kwargs):
+        captured.append(img.copy())
+        return real_encode(img, kind, *args, **kwargs)
+
+    saved_dirs = FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        FRAMED_CARDS_DIR = os.path.join(tmp_dir, "framed")
+        PROFILE_RENDER_CACHE_DIR = os.path.join(tmp_dir, "profiles")
+        MATCH_POSTER_CACHE_DIR = os.path.join(tmp_dir, "matches")
+        encode_image = capturing_encode
+        try:
+            for kind, fn in builders:
+                del captured[:]
+                out = fn()
+                if out:
+                    out.close()
+                if captured:
+                    sources.append((kind, captured[-1]))
+        finally:
+            encode_image = real_encode
+            FRAMED_CARDS_DIR, PROFILE_RENDER_CACHE_DIR, MATCH_POSTER_CACHE_DIR = saved_dirs
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _BenchUploadHandler)
+    server.upload_mbit = upload_mbit
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    lines = [f"Канал заглушки: {upload_mbit:g} Мбит/с"]
+    try:
+        for kind, img in sources:
+            current = _image_output(kind)
+            lines.append(f"\n🖼 {kind} {img.size[0]}×{img.size[1]} (сейчас: {current['format']} q{current['quality']}, ≤{current['max_side'] or '—'}px)")
+            for label, opts in BENCH_ENCODE_VARIANTS:
+                started = time.perf_counter()
+                out = encode_image(img, kind, fmt=opts["format"], quality=opts.get("quality"), max_side=opts.get("max_side"))
+                encode_ms = (time.perf_counter() - started) * 1000
+                data = out.getvalue()
+                upload_ms = _bench_upload_ms(server, data)
+                lines.append(f"• {label}: {len(data) / 1024:.0f} КБ, кодирование {encode_ms:.0f} мс, загрузка {upload_ms:.0f} мс")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return lines
+
+
+async def bench_encode_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ: /bench_encode [Мбит/с] — размер, кодирование и загрузка картинок по кодекам."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    if not PIL_AVAILABLE:
+        await update.message.reply_text("❌ Pillow не установлен — картинки не рисуются.")
+        return
+    try:
+        upload_mbit = max(0.5, min(1000.0, float(context.args[0]))) if context.args else BENCH_UPLOAD_MBIT
+    except ValueError:
+        upload_mbit = BENCH_UPLOAD_MBIT
+    await update.message.reply_text("⏱ Сравниваю кодеки...")
+    try:
+        lines = await asyncio.to_thread(_run_bench_process, _bench_encode_outputs, update.effective_user.id, upload_mbit)
+    except Exception as e:
+        logger.error(f"Бенчмарк кодирования не удался: {e}")
+        await update.message.reply_text(f"❌ Бенчмарк не удался: {e}")
+        return
+    await update.message.reply_text("📦 Бенчмарк кодирования\n\n" + "\n".join(lines))
+
+
 def get_player_card_power(user_id:int, card_id:int, card_map:dict)->int:
     card = card_map.get(card_id,{})
     base = get_card_power(card)
@@ -9685,7 +12302,7 @@ async def card_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if lvl > 0:
         caption += f" (⭐ ур. {lvl})"
     caption += "\n"
-    photo = get_framed_card_photo(card)
+    photo = await render_image("framed_card", card)
     if photo:
         await update.message.reply_photo(photo=photo, caption=caption, parse_mode="HTML")
     else:
@@ -9808,7 +12425,7 @@ async def _get_card_with_mutation_core(update: Update, context: ContextTypes.DEF
 
     image_path = os.path.join(CARDS_IMAGE_DIR, card.get("image", ""))
     if os.path.exists(image_path):
-        photo = get_framed_card_photo(card) or open(image_path, "rb")
+        photo = await render_image("framed_card", card) or open(image_path, "rb")
         await update.message.reply_photo(photo=photo, caption=caption)
     else:
         await update.message.reply_text(caption)
@@ -10750,20 +13367,507 @@ async def claim_quests_cmd(update, context):
             await update.message.reply_text("⌛ Награды заданий уже проверяются. Подождите пару секунд.")
     await _run_locked_action(context, user.id, "claim_quests", lambda: _original_claim_quests_cmd_final(update, context), "", on_busy=_busy)
 
-_original_duel_callback_final = duel_callback
-async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    user = query.from_user if query else None
-    if not user:
-        return await _original_duel_callback_final(update, context)
-    duel_id = str(query.data or "")
-    async def _busy():
+
+# ============================ ТУРНИРЫ ============================
+# Турнир на выбывание: игроки записываются (/tournament_join), при старте сеются
+# по ELO (первый сеяный встречается с последним, свободные места — проходы дальше),
+# и раунды разыгрываются целиком через simulate_match_core без трансляции событий.
+# В чат турнира уходит одна сводка и один постер на раунд. Состояние пишется в
+# TOURNAMENT_FILE после каждого раунда; после перезапуска турнир продолжается с
+# того же места, а сид турнира делает исход каждого матча воспроизводимым.
+# Турнирные матчи не меняют рейтинговый ELO.
+TOURNAMENT_FILE = "tournament.json"
+TOURNAMENT_MIN_PLAYERS = 2
+TOURNAMENT_MAX_PLAYERS = 256
+TOURNAMENT_ROUND_PAUSE = 20        # секунд между раундами
+TOURNAMENT_SUMMARY_ROWS = 20       # матчей в текстовой сводке раунда
+TOURNAMENT_POSTER_ROWS = 32        # матчей на постере раунда (две колонки)
+IMAGE_OUTPUT["tournament_round"] = {"format": "JPEG", "quality": 86, "max_side": 1600}
+
+
+def _bracket_order(size: int) -> list:
+    """Порядок посевов в сетке: [1, 8, 4, 5, 2, 7, 3, 6] для 8 мест."""
+    order = [1]
+    while len(order) < size:
+        order = [s for seed in order for s in (seed, len(order) * 2 + 1 - seed)]
+    return order
+
+
+def _tournament_round_label(players_left: int) -> str:
+    if players_left <= 2:
+        return "Финал"
+    if players_left == 4:
+        return "Полуфинал"
+    return f"1/{players_left // 2} финала"
+
+
+def _tournament_first_pairs(players: list) -> list:
+    """Пары первого раунда по посеву; None — свободное место (проход дальше)."""
+    seeded = sorted(players, key=lambda p: (-p["elo"], p["joined"]))
+    size = 1
+    while size < len(seeded):
+        size *= 2
+    slots = [seeded[seed - 1]["user_id"] if seed <= len(seeded) else None for seed in _bracket_order(size)]
+    return [[slots[i], slots[i + 1]] for i in range(0, size, 2)]
+
+
+def _play_tournament_round(tournament: dict, pairs: list) -> list:
+    """Разыгрывает раунд (выполняется в потоке). Состав берётся актуальный; без состава —
+    техническое поражение. Возвращает [{a, b, ga, gb, finish, winner}]."""
+    card_map = {c['id']: c for c in load_data(CARDS_FILE, [])}
+    elo = {p["user_id"]: p["elo"] for p in tournament["players"]}
+    round_no = len(tournament["rounds"]) + 1
+    results = []
+    for index, (user_a, user_b) in enumerate(pairs):
+        if user_a is None or user_b is None:
+            results.append({"a": user_a, "b": user_b, "ga": None, "gb": None, "finish": "bye",
+                            "winner": user_a if user_a is not None else user_b})
+            continue
+        snap_a = get_team_snapshot(user_a, None, card_map)
+        snap_b = get_team_snapshot(user_b, None, card_map)
+        if not snap_a or not snap_b:
+            winner = user_a if snap_a or not snap_b else user_b
+            results.append({"a": user_a, "b": user_b, "ga": None, "gb": None, "finish": "forfeit", "winner": winner})
+            continue
+        rng = random.Random(f"{tournament['seed']}:{round_no}:{index}")
+        outcome = simulate_match_core(snap_a['strength'], snap_b['strength'], elo.get(user_a, DEFAULT_RATING_ELO),
+                                      elo.get(user_b, DEFAULT_RATING_ELO), snap_a['mods'], snap_b['mods'], rng, narrate=False)
+        results.append({"a": user_a, "b": user_b, "ga": outcome["ga"], "gb": outcome["gb"], "finish": outcome["finish"],
+                        "winner": user_a if outcome["ga"] > outcome["gb"] else user_b})
+    return results
+
+
+def _tournament_score(match: dict) -> str:
+    if match["finish"] == "bye":
+        return "проход"
+    if match["finish"] == "forfeit":
+        return "тех."
+    mark = {"ot": " ОТ", "so": " Б"}.get(match["finish"], "")
+    return f"{match['ga']}:{match['gb']}{mark}"
+
+
+def build_tournament_round_image(title: str, round_label: str, rows: list, hidden: int = 0):
+    """Постер раунда: rows — (игрок A, игрок B, счёт, победитель 'a'|'b')."""
+    if not PIL_AVAILABLE:
+        return None
+    per_col = (min(len(rows), TOURNAMENT_POSTER_ROWS) + 1) // 2
+    W, row_h, top = 1600, 58, 230
+    H = top + max(1, per_col) * row_h + 130
+    img = _gradient_tile((W, H), (10, 22, 58), (4, 8, 24))
+    draw = ImageDraw.Draw(img)
+    F = _load_team_font
+
+    def center(text, cx, y, font, fill):
+        draw.text((cx - draw.textlength(text, font=font) / 2, y), text, font=font, fill=fill)
+
+    def trim(text, font, max_w):
+        text = str(text)
+        while text and draw.textlength(text, font=font) > max_w:
+            text = text[:-1]
+        return text
+
+    center(title, W // 2, 50, F(54), (255, 205, 70))
+    center(round_label, W // 2, 130, F(38), (150, 205, 255))
+    col_w = (W - 120) // 2
+    for i, (name_a, name_b, score, side) in enumerate(rows[:TOURNAMENT_POSTER_ROWS]):
+        col, row = divmod(i, per_col)
+        x, y = 60 + col * col_w, top + row * row_h
+        draw.rounded_rectangle((x + 8, y, x + col_w - 8, y + row_h - 10), radius=14, fill=(18, 34, 78))
+        name_w = (col_w - 190) // 2
+        font = F(24)
+        win, lose = (255, 255, 255), (140, 155, 185)
+        draw.text((x + 26, y + 12), trim(name_a, font, name_w), font=font, fill=win if side == 'a' else lose)
+        name_b_text = trim(name_b, font, name_w)
+        draw.text((x + col_w - 26 - draw.textlength(name_b_text, font=font), y + 12), name_b_text, font=font,
+                  fill=win if side == 'b' else lose)
+        center(score, x + col_w // 2, y + 12, F(26), (255, 205, 70))
+    footer = f"и ещё {hidden} матчей — в сводке турнира" if hidden else "Хоккейные карточки"
+    center(footer, W // 2, H - 80, F(26), (170, 185, 215))
+    return encode_image(img, "tournament_round")
+
+
+RENDER_JOBS["tournament_round"] = ("build_tournament_round_image", "tournament.png")
+
+
+def _load_tournament() -> dict:
+    return load_data(TOURNAMENT_FILE, {})
+
+
+def _tournament_name_of(tournament: dict, user_id) -> str:
+    if user_id is None:
+        return "—"
+    for p in tournament["players"]:
+        if p["user_id"] == user_id:
+            return p["name"]
+    return f"Игрок {user_id}"
+
+
+def _tournament_next_pairs(tournament: dict) -> list:
+    """Пары следующего раунда: первый — по посеву, дальше — победители предыдущего попарно."""
+    if not tournament["rounds"]:
+        return _tournament_first_pairs(tournament["players"])
+    winners = [m["winner"] for m in tournament["rounds"][-1]]
+    return [[winners[i], winners[i + 1]] for i in range(0, len(winners), 2)]
+
+
+async def _run_tournament(application: Application) -> None:
+    """Разыгрывает оставшиеся раунды турнира; одна сводка и один постер на раунд."""
+    context = CallbackContext(application)
+    while True:
+        tournament = _load_tournament()
+        if tournament.get("status") != "running":
+            return
+        pairs = _tournament_next_pairs(tournament)
+        label = _tournament_round_label(len(pairs) * 2)
+        results = await asyncio.to_thread(_play_tournament_round, tournament, pairs)
+        tournament["rounds"].append(results)
+        finished = len(results) == 1
+        if finished:
+            tournament["status"] = "finished"
+            tournament["champion"] = results[0]["winner"]
+            tournament["finished_at"] = time.time()
+        save_data(TOURNAMENT_FILE, tournament)
+
+        def name(uid):
+            return _tournament_name_of(tournament, uid)
+
+        played = [m for m in results if m["finish"] != "bye"]
+        lines = [f"🏆 <b>{html.escape(tournament['name'])}</b> — {label}", f"Сыграно матчей: {len(played)}\n"]
+        for m in played[:TOURNAMENT_SUMMARY_ROWS]:
+            a, b = html.escape(name(m["a"])), html.escape(name(m["b"]))
+            a, b = (f"<b>{a}</b>", b) if m["winner"] == m["a"] else (a, f"<b>{b}</b>")
+            lines.append(f"▫️ {a} {_tournament_score(m)} {b}")
+        if len(played) > TOURNAMENT_SUMMARY_ROWS:
+            lines.append(f"… и ещё {len(played) - TOURNAMENT_SUMMARY_ROWS}")
+        if finished:
+            lines.append(f"\n👑 Победитель турнира: <b>{html.escape(name(tournament['champion']))}</b>")
+        else:
+            lines.append(f"\n⏳ Следующий раунд через {TOURNAMENT_ROUND_PAUSE} сек. Сетка: /tournament")
+        rows = [(name(m["a"]), name(m["b"]), _tournament_score(m), 'a' if m["winner"] == m["a"] else 'b') for m in played]
+        image = await render_image("tournament_round", tournament["name"], label, rows,
+                                   hidden=max(0, len(rows) - TOURNAMENT_POSTER_ROWS))
+        chat_id = tournament.get("chat_id")
         try:
-            await query.answer("Дуэль уже обрабатывается", show_alert=True)
-        except Exception:
-            pass
-    await _run_locked_action(context, user.id, f"duel_callback:{duel_id}", lambda: _original_duel_callback_final(update, context), "", on_busy=_busy)
+            if image:
+                await context.bot.send_photo(chat_id, photo=image)
+            await context.bot.send_message(chat_id, "\n".join(lines), parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сводку раунда турнира: {e}")
+        if finished:
+            try:
+                await context.bot.send_message(tournament["champion"], f"👑 Вы выиграли турнир «{tournament['name']}»!")
+            except Exception:
+                pass
+            return
+        await asyncio.sleep(TOURNAMENT_ROUND_PAUSE)
+
+
+def _ensure_tournament_runner(application: Application) -> None:
+    task = application.bot_data.get("tournament_task")
+    if task is None or task.done():
+        application.bot_data["tournament_task"] = application.create_task(_run_tournament(application))
+
+
+async def tournament_new_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ: /tournament_new <макс. участников> [название] — открыть запись в этом чате."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    current = _load_tournament()
+    if current.get("status") in ("registration", "running"):
+        await update.message.reply_text("❌ Уже идёт турнир. Завершите его или отмените: /tournament_cancel")
+        return
+    try:
+        size = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text(f"ℹ️ Использование: /tournament_new <участников {TOURNAMENT_MIN_PLAYERS}-{TOURNAMENT_MAX_PLAYERS}> [название]")
+        return
+    if not TOURNAMENT_MIN_PLAYERS <= size <= TOURNAMENT_MAX_PLAYERS:
+        await update.message.reply_text(f"❌ Участников: от {TOURNAMENT_MIN_PLAYERS} до {TOURNAMENT_MAX_PLAYERS}.")
+        return
+    name = " ".join(context.args[1:]).strip() or "Турнир выходного дня"
+    save_data(TOURNAMENT_FILE, {
+        "id": int(time.time()),
+        "name": name[:60],
+        "status": "registration",
+        "size": size,
+        "chat_id": update.effective_chat.id,
+        "created_by": update.effective_user.id,
+        "seed": random.getrandbits(48),
+        "players": [],
+        "rounds": [],
+    })
+    await update.message.reply_text(
+        f"🏆 <b>{html.escape(name)}</b>\n\nОткрыта запись на турнир: до {size} участников.\n"
+        "Записаться: /tournament_join (нужен рейтинговый состав).\n"
+        "Посев по рейтингу ELO, матчи идут без трансляции — в чат приходят итоги раундов.",
+        parse_mode="HTML",
+    )
+
+
+async def tournament_join_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if is_banned(user.id):
+        await update.message.reply_text("❌ Вы заблокированы в этом боте.")
+        return
+    if not await is_subscribed(user.id, context):
+        await update.message.reply_text(subscription_required_text())
+        return
+    tournament = _load_tournament()
+    if tournament.get("status") != "registration":
+        await update.message.reply_text("ℹ️ Сейчас нет открытой записи на турнир.")
+        return
+    if not get_rating_team(user.id):
+        await update.message.reply_text("❌ У вас нет состава. Сначала используйте /rating_team.")
+        return
+    if any(p["user_id"] == user.id for p in tournament["players"]):
+        await update.message.reply_text("✅ Вы уже записаны на турнир.")
+        return
+    if len(tournament["players"]) >= tournament["size"]:
+        await update.message.reply_text("❌ Все места на турнир заняты.")
+        return
+    tournament["players"].append({
+        "user_id": user.id,
+        "name": f"@{user.username}" if user.username else (user.first_name or f"Игрок {user.id}"),
+        "elo": get_rating_elo(user.id),
+        "joined": time.time(),
+    })
+    save_data(TOURNAMENT_FILE, tournament)
+    await update.message.reply_text(
+        f"✅ Вы записаны на турнир «{html.escape(tournament['name'])}». "
+        f"Участников: {len(tournament['players'])}/{tournament['size']}.",
+        parse_mode="HTML",
+    )
+
+
+async def tournament_start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ: закрыть запись, посеять участников и запустить раунды."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    tournament = _load_tournament()
+    if tournament.get("status") != "registration":
+        await update.message.reply_text("ℹ️ Нет турнира с открытой записью.")
+        return
+    if len(tournament["players"]) < TOURNAMENT_MIN_PLAYERS:
+        await update.message.reply_text(f"❌ Нужно минимум {TOURNAMENT_MIN_PLAYERS} участника.")
+        return
+    tournament["status"] = "running"
+    tournament["started_at"] = time.time()
+    save_data(TOURNAMENT_FILE, tournament)
+    await update.message.reply_text(
+        f"🏁 Турнир «{html.escape(tournament['name'])}» начался: {len(tournament['players'])} участников, "
+        "посев по ELO. Итоги раундов придут в чат турнира.",
+        parse_mode="HTML",
+    )
+    _ensure_tournament_runner(context.application)
+
+
+async def tournament_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда доступна только администратору!")
+        return
+    tournament = _load_tournament()
+    if tournament.get("status") not in ("registration", "running"):
+        await update.message.reply_text("ℹ️ Активного турнира нет.")
+        return
+    tournament["status"] = "cancelled"
+    save_data(TOURNAMENT_FILE, tournament)
+    task = context.application.bot_data.pop("tournament_task", None)
+    if task and not task.done():
+        task.cancel()
+    await update.message.reply_text("❌ Турнир отменён.")
+
+
+async def tournament_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Статус турнира: запись, текущая сетка или победитель."""
+    tournament = _load_tournament()
+    status = tournament.get("status")
+    if not status or status == "cancelled":
+        await update.message.reply_text("ℹ️ Турниров сейчас нет.")
+        return
+    title = f"🏆 <b>{html.escape(tournament['name'])}</b>"
+    if status == "registration":
+        names = ", ".join(html.escape(p["name"]) for p in tournament["players"][:40]) or "пока никого"
+        await update.message.reply_text(
+            f"{title}\n📝 Идёт запись: {len(tournament['players'])}/{tournament['size']}\n{names}\n\nЗаписаться: /tournament_join",
+            parse_mode="HTML",
+        )
+        return
+    def name(uid):
+        return html.escape(_tournament_name_of(tournament, uid))
+
+    lines = [title]
+    if status == "finished":
+        lines.append(f"👑 Победитель: <b>{name(tournament.get('champion'))}</b>")
+    user_id = update.effective_user.id
+    for number, results in enumerate(tournament["rounds"], 1):
+        own = next((m for m in results if user_id in (m["a"], m["b"])), None)
+        label = _tournament_round_label(len(results) * 2)
+        line = f"▫️ {label}: матчей {len(results)}"
+        if own:
+            line += f" — ваш: {name(own['a'])} {_tournament_score(own)} {name(own['b'])}"
+        lines.append(line)
+    if status == "running":
+        pairs = _tournament_next_pairs(tournament)
+        lines.append(f"\n⏳ Следующий раунд: {_tournament_round_label(len(pairs) * 2)}, пар: {len(pairs)}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+# ============================ СИМУЛЯТОР БАЛАНСА ============================
+# Массовая проверка модели матча без Telegram:
+#   python bot.py simulate --a 123456 --b bot --matches 1000000 --workers 4
+#   python bot.py simulate --a cards:12,5,8,9,31:attack --b cards:3,4,6,7 --a-elo 1200
+# Состав: ID игрока (его рейтинговый состав и прокачка), bot — случайная бот-команда,
+# cards:gk,f1,f2,f3[,coach][:tactic] — карточки из cards.json без прокачки.
+# Считает шанс победы, распределение счёта, долю ОТ/буллитов и дрейф ELO в серии матчей.
+SIM_BATCH_SIZE = 50_000
+SIM_ELO_CHAIN_LEN = 200
+
+
+def _sim_team_spec(spec: str, card_map: dict):
+    """Разбирает --a/--b. Возвращает (состав, владелец или None, подпись)."""
+    spec = str(spec).strip()
+    if spec == "bot":
+        team = pick_bot_team()
+        return team, None, f"бот «{team.get('name', 'Бот')}»"
+    if spec.startswith("cards:"):
+        ids, _, tactic = spec[len("cards:"):].partition(":")
+        refs = [int(x) for x in ids.split(",") if x.strip()]
+        if len(refs) < 4:
+            raise ValueError(f"{spec}: нужно минимум 4 карточки (вратарь и трое полевых)")
+        team = {"gk": refs[0], "field": refs[1:4], "tactic": tactic or "balanced"}
+        if len(refs) > 4:
+            team["coach"] = refs[4]
+        return team, None, f"карточки {ids}"
+    uid = int(spec)
+    team = get_rating_team(uid)
+    if not team or not team.get("gk"):
+        raise ValueError(f"у игрока {uid} не собран рейтинговый состав")
+    return team, uid, f"игрок {uid}"
+
+
+def _sim_worker(job: tuple) -> dict:
+    """Пачка матчей в процессе пула. Только числа на входе и на выходе."""
+    sa, sb, ea, eb, mods_a, mods_b, matches, chains, chain_len, seed = job
+    rng = random.Random(seed)
+    wins_a = ot = so = goals_a = goals_b = 0
+    scores = Counter()
+    for _ in range(matches):
+        r = simulate_match_core(sa, sb, ea, eb, mods_a, mods_b, rng, narrate=False)
+        wins_a += r["ga"] > r["gb"]
+        ot += r["finish"] == "ot"
+        so += r["finish"] == "so"
+        goals_a += r["ga"]
+        goals_b += r["gb"]
+        scores[(r["ga"], r["gb"])] += 1
+    drift = []
+    for _ in range(chains):
+        cur_a, cur_b = ea, eb
+        for _ in range(chain_len):
+            r = simulate_match_core(sa, sb, cur_a, cur_b, mods_a, mods_b, rng, narrate=False)
+            cur_a, cur_b = rating_elo_update(cur_a, cur_b, r["ga"] > r["gb"])
+        drift.append(cur_a - ea)
+    return {"matches": matches, "wins_a": wins_a, "ot": ot, "so": so,
+            "goals_a": goals_a, "goals_b": goals_b, "scores": scores, "drift": drift}
+
+
+def run_match_simulation(sa, sb, ea, eb, mods_a=(0.0, 0.0), mods_b=(0.0, 0.0), matches=1_000_000,
+                         workers=None, seed=None, drift_chains=1000, chain_len=SIM_ELO_CHAIN_LEN) -> dict:
+    """Раскладывает матчи пачками по процессам и сводит результат."""
+    workers = max(1, workers or os.cpu_count() or 1)
+    matches, drift_chains = max(0, int(matches)), max(0, int(drift_chains))
+    base_seed = random.randrange(1 << 30) if seed is None else int(seed)
+    n_jobs = max(workers, -(-int(matches) // SIM_BATCH_SIZE), 1)
+    jobs = []
+    for i in range(n_jobs):
+        n = matches // n_jobs + (i < matches % n_jobs)
+        c = drift_chains // n_jobs + (i < drift_chains % n_jobs)
+        if n or c:
+            jobs.append((sa, sb, ea, eb, tuple(mods_a), tuple(mods_b), n, c, chain_len, base_seed + i))
+    started = time.perf_counter()
+    if workers == 1:
+        parts = [_sim_worker(job) for job in jobs]
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            parts = list(pool.map(_sim_worker, jobs))
+    total = {"matches": 0, "wins_a": 0, "ot": 0, "so": 0, "goals_a": 0, "goals_b": 0,
+             "scores": Counter(), "drift": []}
+    for part in parts:
+        for key in ("matches", "wins_a", "ot", "so", "goals_a", "goals_b"):
+            total[key] += part[key]
+        total["scores"].update(part["scores"])
+        total["drift"].extend(part["drift"])
+    total["seconds"] = time.perf_counter() - started
+    total["workers"] = workers
+    total["seed"] = base_seed
+    return total
+
+
+def _format_sim_report(res: dict, label_a: str, label_b: str, sa, sb, ea, eb, chain_len) -> str:
+    n = max(1, res["matches"])
+    lines = [
+        f"A: {label_a} — сила {sa:.0f}, ELO {ea}",
+        f"B: {label_b} — сила {sb:.0f}, ELO {eb}",
+        f"Матчей: {res['matches']:,} за {res['seconds']:.1f} сек "
+        f"({res['matches'] / max(1e-9, res['seconds']):,.0f}/сек, процессов {res['workers']}, seed {res['seed']})",
+        "",
+        f"Победа A: {res['wins_a'] / n:.2%}   Победа B: {1 - res['wins_a'] / n:.2%}",
+        f"Овертайм: {res['ot'] / n:.2%}   Буллиты: {res['so'] / n:.2%}",
+        f"Голов за матч: A {res['goals_a'] / n:.2f}, B {res['goals_b'] / n:.2f}",
+        "",
+        "Счёт (A:B):",
+    ]
+    for (ga, gb), cnt in res["scores"].most_common(15):
+        lines.append(f"  {ga}:{gb}  {cnt / n:6.2%}  {'█' * max(1, round(cnt / n * 100))}")
+    drift = res["drift"]
+    if drift:
+        drift = sorted(drift)
+        mean = sum(drift) / len(drift)
+        lines += [
+            "",
+            f"Дрейф ELO A за {chain_len} матчей подряд ({len(drift)} серий): "
+            f"среднее {mean:+.1f}, медиана {drift[len(drift) // 2]:+.0f}, "
+            f"5% {drift[int(len(drift) * .05)]:+.0f}, 95% {drift[min(len(drift) - 1, int(len(drift) * .95))]:+.0f}",
+        ]
+    return "\n".join(lines)
+
+
+def simulate_cli(argv) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="bot.py simulate", description="Массовая симуляция рейтинговых матчей")
+    parser.add_argument("--a", required=True, help="ID игрока, bot или cards:gk,f1,f2,f3[,coach][:tactic]")
+    parser.add_argument("--b", default="bot", help="так же, как --a (по умолчанию bot)")
+    parser.add_argument("--a-elo", type=int, help="ELO стороны A (по умолчанию — текущий рейтинг игрока)")
+    parser.add_argument("--b-elo", type=int, help="ELO стороны B")
+    parser.add_argument("--matches", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=None, help="процессов (по умолчанию — все ядра)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--drift-chains", type=int, default=1000, help="серий для замера дрейфа ELO (0 — не считать)")
+    parser.add_argument("--chain-len", type=int, default=SIM_ELO_CHAIN_LEN)
+    args = parser.parse_args(argv)
+    card_map = {c["id"]: c for c in load_data(CARDS_FILE, [])}
+    try:
+        team_a, owner_a, label_a = _sim_team_spec(args.a, card_map)
+        team_b, owner_b, label_b = _sim_team_spec(args.b, card_map)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+    sa = _team_strength(team_a, card_map, owner_a)
+    sb = _team_strength(team_b, card_map, owner_b)
+    ea = args.a_elo if args.a_elo is not None else (get_rating_elo(owner_a) if owner_a else DEFAULT_RATING_ELO)
+    eb = args.b_elo if args.b_elo is not None else (get_rating_elo(owner_b) if owner_b else DEFAULT_RATING_ELO)
+    mods_a = _team_tactic_mods(team_a, card_map)
+    mods_b = _team_tactic_mods(team_b, card_map)
+    res = run_match_simulation(sa, sb, ea, eb, mods_a, mods_b, args.matches, args.workers, args.seed,
+                               args.drift_chains, args.chain_len)
+    print(_format_sim_report(res, label_a, label_b, sa, sb, ea, eb, args.chain_len))
+    return 0
+
 
 if __name__ == "__main__":
+    if HEADLESS_RUN:
+        sys.exit(simulate_cli(sys.argv[2:]))
     _run_bot_main()
 